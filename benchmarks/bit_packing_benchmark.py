@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares bitwiseio.pack_bits with packing through BitWriter.
+
+Packs the vertex and strip indices of a stereo VR180 mesh, two meshes of
+--grid x --grid cells, both ways and checks that the bytes are the same.
+
+    python benchmarks/bit_packing_benchmark.py --grid 39 --repeat 20
+"""
+
+import argparse
+import io
+import math
+import os
+import sys
+import time
+
+path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(path, '..'))
+from spatialmedia.mpeg import bitwiseio
+from spatialmedia.mpeg import mesh
+
+
+def fields(grid):
+    """Returns the (values, width) fields packed for a stereo mesh."""
+    details = mesh.gen_mesh(grid, 1, 0.0, 1.0, 0.0, 1.0, [0.0] * 4)
+    vertices = details["vertices"]
+    strip = details["triangles"][0]["list"]
+    vertex_width = int(math.ceil(math.log(len(details["coordinates"]) * 2,
+                                          2.0)))
+    strip_width = int(math.ceil(math.log(len(vertices) // 5 * 2, 2.0)))
+    eye = [(mesh.encode_deltas(vertices, 5), vertex_width),
+           (mesh.encode_deltas(strip), strip_width)]
+    return eye * 2
+
+
+def bit_writer(fields):
+    packed = []
+    for values, width in fields:
+        out = io.BytesIO()
+        writer = bitwiseio.BitWriter(out)
+        for value in values:
+            writer.writebits(value, width)
+        writer.flush()
+        packed.append(out.getvalue())
+        # Keep the flush done when the writer is deleted out of the output.
+        writer.out = io.BytesIO()
+    return packed
+
+
+def pack_bits(fields):
+    return [bitwiseio.pack_bits(values, width) for values, width in fields]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--grid", type=int, default=39,
+                        help="cells per row and column of each mesh")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="times each packer is run, the best is shown")
+    args = parser.parse_args()
+
+    mesh_fields = fields(args.grid)
+    count = sum(len(values) for values, _ in mesh_fields)
+    print("{0} values in {1} fields".format(count, len(mesh_fields)))
+
+    expected = None
+    for name, pack in [("BitWriter", bit_writer), ("pack_bits", pack_bits)]:
+        best = None
+        for _ in range(args.repeat):
+            start = time.time()
+            packed = pack(mesh_fields)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if expected is None:
+            expected = packed
+        print("{0:10} {1:9.2f} ms {2:8.0f} ns/value {3:8d} bytes {4}".format(
+            name, best * 1e3, best / count * 1e9,
+            sum(len(data) for data in packed),
+            "bytes ok" if packed == expected else "BYTES DIFFER"))
+
+
+if __name__ == "__main__":
+    main()
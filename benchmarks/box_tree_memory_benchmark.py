@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the memory held by the box tree of a file with many boxes.
+
+Writes a synthetic file whose moov box holds about --boxes boxes, video
+tracks with a full sample table each, loads it with mpeg.load, parses
+every container and reports the memory traced while the tree is alive.
+Each tree is measured in its own process. Use --tree to measure other
+checkouts next to this one, for example one from before a change:
+
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/box_tree_memory_benchmark.py --tree /tmp/before
+"""
+
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+path = os.path.dirname(os.path.abspath(__file__))
+TREE = os.path.join(path, "..")
+
+# Boxes in each track written by video_trak.
+BOXES_PER_TRACK = 16
+
+
+def write_box(name, payload):
+    return struct.pack(">I", 8 + len(payload)) + name.encode("latin1") + payload
+
+
+def full_box(name, payload, flags=0):
+    return write_box(name, struct.pack(">I", flags) + payload)
+
+
+def video_trak():
+    """Returns a video trak box with BOXES_PER_TRACK boxes."""
+    entry = (b"\0" * 6 + struct.pack(">H", 1) + b"\0" * 16 +
+             struct.pack(">HH", 1920, 1080) +
+             struct.pack(">II", 0x480000, 0x480000) + b"\0" * 4 +
+             struct.pack(">H", 1) + b"\0" * 32 + struct.pack(">Hh", 24, -1))
+    avc1 = write_box("avc1", entry + write_box("avcC", b"\x01\x64\x00\x28"))
+    stbl = write_box("stbl", b"".join([
+        full_box("stsd", struct.pack(">I", 1) + avc1),
+        full_box("stts", struct.pack(">III", 1, 1, 1000)),
+        full_box("stsc", struct.pack(">IIII", 1, 1, 1, 1)),
+        full_box("stsz", struct.pack(">III", 16, 1, 0)),
+        full_box("stco", struct.pack(">II", 1, 0))]))
+    minf = write_box("minf", b"".join([
+        full_box("vmhd", b"\0" * 8, flags=1),
+        write_box("dinf", b""),
+        stbl]))
+    mdia = write_box("mdia", b"".join([
+        full_box("mdhd", b"\0" * 20),
+        full_box("hdlr", b"\0" * 4 + b"vide" + b"\0" * 12 + b"Video\0"),
+        minf]))
+    return write_box("trak", full_box("tkhd", b"\0" * 80) + mdia)
+
+
+def write_source(filename, tracks):
+    with open(filename, "wb") as fh:
+        fh.write(write_box("ftyp", b"isom\0\0\0\0isom"))
+        fh.write(write_box("moov", video_trak() * tracks))
+        fh.write(write_box("mdat", b"\0" * 16))
+
+
+def count_boxes(element):
+    """Counts element and the boxes inside it, parsing all containers."""
+    count = 0
+    stack = [element]
+    while stack:
+        element = stack.pop()
+        count += 1
+        if isinstance(element.contents, list):
+            stack.extend(element.contents)
+    return count
+
+
+def measure(filename):
+    """Loads filename with the spatialmedia package on sys.path.
+
+    Returns:
+      Dict with the number of boxes, traced memory and load time.
+    """
+    from spatialmedia import mpeg
+
+    with open(filename, "rb") as fh:
+        # Tracing slows allocations down, time a separate load.
+        start = time.time()
+        count_boxes(mpeg.load(fh))
+        elapsed = time.time() - start
+
+        tracemalloc.start()
+        mpeg4 = mpeg.load(fh)
+        boxes = count_boxes(mpeg4) - 1
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"boxes": boxes, "bytes": current, "peak": peak,
+            "seconds": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", type=int, default=100000,
+                        help="approximate number of boxes in the file")
+    parser.add_argument("--dir", default=None,
+                        help="directory for the temporary file")
+    parser.add_argument("--tree", action="append", default=[],
+                        help="other checkout to measure, can be repeated")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        json.dump(measure(args.measure), sys.stdout)
+        return
+
+    tracks = max(1, args.boxes // BOXES_PER_TRACK)
+    handle, source = tempfile.mkstemp(suffix=".mp4", dir=args.dir)
+    os.close(handle)
+    try:
+        write_source(source, tracks)
+        print("{0} tracks, {1} bytes".format(tracks, os.path.getsize(source)))
+        for tree in [TREE] + args.tree:
+            environment = dict(os.environ)
+            environment["PYTHONPATH"] = os.path.abspath(tree)
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 "--measure", source], env=environment)
+            result = json.loads(output.decode("utf-8"))
+            print("{0:40} {1:7d} boxes {2:8.1f} MB {3:6.1f} bytes/box "
+                  "{4:8.1f} MB peak {5:6.2f} s".format(
+                      os.path.abspath(tree)[-40:], result["boxes"],
+                      result["bytes"] / 1e6,
+                      result["bytes"] / float(result["boxes"]),
+                      result["peak"] / 1e6, result["seconds"]))
+    finally:
+        os.remove(source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares box.index_copy with shifting the chunk offsets one at a time.
+
+Copies stco and co64 boxes of --entries chunk offsets, unchanged and
+shifted up and down, both ways and checks that the bytes are the same.
+
+    python benchmarks/index_copy_benchmark.py --entries 1000000 --repeat 5
+"""
+
+import argparse
+import array
+import io
+import os
+import struct
+import sys
+import time
+
+path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(path, '..'))
+from spatialmedia.mpeg import box
+
+
+def make_box(name, entries):
+    """Returns a stco/co64 box holding entries, cached in its contents."""
+    entry = "I" if name == "stco" else "Q"
+    index_box = box.Box()
+    index_box.name = name
+    index_box.header_size = 8
+    index_box.contents = (struct.pack(">II", 0, len(entries)) +
+                          struct.pack(">%d%s" % (len(entries), entry),
+                                      *entries))
+    index_box.content_size = len(index_box.contents)
+    return index_box
+
+
+def entry_loop_copy(index_box, mode_length, delta):
+    """Shifts the entries with a Python loop, as index_copy used to."""
+    out_fh = io.BytesIO()
+    header, entries, trailer = box.read_index(None, index_box, mode_length)
+    entries = array.array(entries.typecode,
+                          [entry + delta for entry in entries])
+    if sys.byteorder == "little":
+        entries.byteswap()
+    out_fh.write(struct.pack(">II", header, len(entries)) +
+                 entries.tobytes() + trailer)
+    return out_fh.getvalue()
+
+
+def index_copy(index_box, mode_length, delta):
+    out_fh = io.BytesIO()
+    box.index_copy(None, out_fh, index_box, mode_length, delta)
+    return out_fh.getvalue()
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=1000000,
+                        help="chunk offsets in each box")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="copies timed, the best is reported")
+    args = parser.parse_args()
+
+    for name, mode_length in (("stco", 4), ("co64", 8)):
+        entries = [1000000 + i * 1021 for i in range(args.entries)]
+        index_box = make_box(name, entries)
+        for delta in (0, 65536, -1000):
+            loop_time, expected = best_time(
+                lambda: entry_loop_copy(index_box, mode_length, delta),
+                args.repeat)
+            copy_time, result = best_time(
+                lambda: index_copy(index_box, mode_length, delta),
+                args.repeat)
+            print("{0} delta {1:7d}: loop {2:8.2f} ms index_copy {3:8.2f} ms"
+                  " {4:6.1f}x {5}".format(
+                      name, delta, loop_time * 1000, copy_time * 1000,
+                      loop_time / copy_time,
+                      "same" if result == expected else "MISMATCH"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares box.tag_copy with the plain Python copy loop.
+
+Writes a multi-GB source file and times copying it with the 64 MB
+read/write loop tag_copy used before, the buffered copy, the pipelined
+copy with kernel copies disabled, the parallel range copy and tag_copy.
+Every output is hashed and compared with the output of the old loop.
+
+    python benchmarks/tag_copy_benchmark.py --size-gb 4 --dir /mnt/media
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(path, '..'))
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import transfer
+
+BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def write_source(filename, size, sparse):
+    """Writes size bytes of data, or a single data block and a hole."""
+    block = os.urandom(BLOCK_SIZE)
+    with open(filename, "wb") as fh:
+        if sparse:
+            fh.write(block)
+            fh.truncate(size)
+            return
+        remaining = size
+        while remaining > 0:
+            fh.write(block[:min(remaining, BLOCK_SIZE)])
+            remaining -= BLOCK_SIZE
+
+
+def file_hash(filename):
+    """Returns the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_write_loop(in_fh, out_fh, size):
+    """The copy loop of tag_copy before transfer.copy, the baseline."""
+    # On 32-bit systems reading / writing is limited to 2GB chunks.
+    # To prevent overflow, read/write 64 MB chunks.
+    block_size = 64 * 1024 * 1024
+    while (size > block_size):
+        contents = in_fh.read(block_size)
+        out_fh.write(contents)
+        size = size - block_size
+
+    contents = in_fh.read(size)
+    out_fh.write(contents)
+
+
+def time_copy(copy, source, destination, size):
+    with open(source, "rb") as in_fh:
+        with open(destination, "wb") as out_fh:
+            start = time.time()
+            copy(in_fh, out_fh, size)
+            out_fh.flush()
+            os.fsync(out_fh.fileno())
+            elapsed = time.time() - start
+    assert os.path.getsize(destination) == size
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-gb", type=float, default=2.0,
+                        help="size of the copied file in GB")
+    parser.add_argument("--dir", default=None,
+                        help="directory for the temporary files")
+    parser.add_argument("--sparse", action="store_true",
+                        help="copy a sparse file that is mostly a hole")
+    parser.add_argument("--buffer-count", type=int, default=4,
+                        help="buffers used by the pipelined copy")
+    parser.add_argument("--buffer-mb", type=int, default=16,
+                        help="size of each pipelined copy buffer in MB")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="threads used by the parallel copy")
+    parser.add_argument("--range-mb", type=int, default=32,
+                        help="size of the ranges copied in parallel in MB")
+    args = parser.parse_args()
+
+    size = int(args.size_gb * 1024 * 1024 * 1024)
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    source = os.path.join(work_dir, "source.bin")
+    destination = os.path.join(work_dir, "destination.bin")
+    try:
+        write_source(source, size, args.sparse)
+        options = transfer.CopyOptions(args.buffer_count,
+                                       args.buffer_mb * 1024 * 1024,
+                                       kernel_copy=False)
+
+        parallel_options = transfer.CopyOptions(
+            threads=args.threads, range_size=args.range_mb * 1024 * 1024,
+            kernel_copy=False)
+
+        def pipelined(in_fh, out_fh, size):
+            transfer.copy(in_fh, out_fh, size, options)
+
+        def parallel(in_fh, out_fh, size):
+            transfer.copy(in_fh, out_fh, size, parallel_options)
+
+        expected_hash = None
+        for name, copy in [("python loop", read_write_loop),
+                           ("buffered", transfer.buffered_copy),
+                           ("pipelined", pipelined),
+                           ("parallel", parallel),
+                           ("tag_copy", box.tag_copy)]:
+            elapsed = time_copy(copy, source, destination, size)
+            allocated = os.stat(destination).st_blocks * 512
+            output_hash = file_hash(destination)
+            if expected_hash is None:
+                expected_hash = output_hash
+            print("{0:12} {1:8.2f} s {2:10.1f} MB/s {3:12d} bytes allocated"
+                  " {4}".format(name, elapsed, size / elapsed / 1e6, allocated,
+                               "hash ok" if output_hash == expected_hash
+                               else "HASH MISMATCH"))
+            os.remove(destination)
+    finally:
+        if os.path.exists(source):
+            os.remove(source)
+        os.rmdir(work_dir)
+
+
+if __name__ == "__main__":
+    main()
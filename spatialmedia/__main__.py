@@ -27,7 +27,9 @@ import sys
 path = os.path.dirname(sys.modules[__name__].__file__)
 path = os.path.join(path, '..')
 sys.path.insert(0, path)
+from spatialmedia import batch
 from spatialmedia import metadata_utils
+from spatialmedia.mpeg import transfer
 from argparse import RawTextHelpFormatter
 
 
@@ -41,15 +43,27 @@ def main():
   parser = argparse.ArgumentParser(
       formatter_class=RawTextHelpFormatter,
       usage=
-      "%(prog)s [options] [files...]\n\nBy default prints out spatial media "
-      "metadata from specified files.")
+      "%(prog)s [options] [files...]\n"
+      "       %(prog)s --batch [-h] [manifest]\n\nBy default prints out "
+      "spatial media metadata from specified files. --batch injects "
+      "metadata\ninto many files at once.")
+  parser.add_argument(
+      "--batch",
+      nargs=argparse.REMAINDER,
+      metavar="BATCH-ARGS",
+      help=
+      "injects metadata into the files of a manifest or glob, see --batch -h."
+      "\nThe arguments after it are passed to the batch command")
   parser.add_argument(
       "-i",
       "--inject",
       action="store_true",
       help=
       "injects spatial media metadata into the first file specified (.mp4 or "
-      ".mov) and saves the result to the second file specified")
+      ".mov) and saves the result to the second file specified.\n"
+      "If both are the same file it is updated in place when possible. That "
+      "is not atomic,\nan interrupted update is undone from a journal the "
+      "next time the file is injected.")
   parser.add_argument(
       "-b",
       "--show-atoms",
@@ -155,6 +169,22 @@ def main():
       "The right hand image starts 20 pixels in so the u_min for the right eye is 0.005, the rest of the value match the left eye"
       )
 
+  video_group.add_argument(
+      "--mesh-tolerance",
+      type=float,
+      dest="mesh_tolerance",
+      metavar="TOLERANCE",
+      default=0.0,
+      help="merge mesh coordinates closer than TOLERANCE, e.g. 0.0001, to "
+      "shrink the mesh projection. Equal coordinates are always merged")
+
+  video_group.add_argument(
+      "--mesh-cache",
+      action="store",
+      dest="mesh_cache",
+      metavar="CACHE-FILE",
+      help="SQLite file caching generated mesh projections between runs")
+
   audio_group = parser.add_argument_group("Spatial Audio")
   audio_group.add_argument(
       "-a",
@@ -163,10 +193,49 @@ def main():
       help=
       "spatial audio. First-order periphonic ambisonics with ACN channel "
       "ordering and SN3D normalization")
-  parser.add_argument("file", nargs="+", help="input/output files")
+  copy_group = parser.add_argument_group("Copying")
+  copy_group.add_argument(
+      "--copy-threads",
+      type=int,
+      default=1,
+      help=
+      "number of threads copying ranges of the media data concurrently when "
+      "injecting. Several I/Os in flight help NVMe and parallel filesystems")
+  copy_group.add_argument(
+      "--copy-range-mb",
+      type=int,
+      default=32,
+      help="size in MB of the ranges copied concurrently")
+  copy_group.add_argument(
+      "--copy-buffers",
+      type=int,
+      default=4,
+      help=
+      "number of buffers in flight between reading and writing when the "
+      "data is copied\nthrough Python, i.e. when the kernel cannot copy it "
+      "(other platforms, pipes).\n1 reads and writes in turn")
+  copy_group.add_argument(
+      "--copy-buffer-mb",
+      type=int,
+      default=None,
+      help="size in MB of each copy buffer, by default derived from the "
+      "block size of the files")
+  parser.add_argument("file", nargs="*", help="input/output files")
 
   args = parser.parse_args()
 
+  if args.batch is not None:
+    # The batch command has its own options, the others would be ignored.
+    others = [dest for dest, value in vars(args).items()
+              if dest not in ("batch", "file")
+              and value != parser.get_default(dest)]
+    if others or args.file:
+      parser.error("--batch cannot be combined with other options or files, "
+                   "give them after --batch")
+    sys.exit(batch.main(args.batch))
+  if not args.file:
+    parser.error("the following arguments are required: file")
+
   if args.inject:
     if len(args.file) != 2:
       console("Injecting metadata requires both an input file and output file.")
@@ -203,6 +272,9 @@ def main():
     if args.uv_offsets:
         metadata.uv_offsets = [float(x) for x in args.uv_offsets.split(':')]
 
+    metadata.mesh_tolerance = args.mesh_tolerance
+    metadata.mesh_cache = args.mesh_cache
+
     if args.field_of_view:
       metadata.fov = [float(x) for x in args.field_of_view.split('x')]
       if metadata.fov[0] == 0 or metadata.fov[1] == 0 :
@@ -220,8 +292,15 @@ def main():
 
     if metadata.stereo or metadata.spherical or metadata.audio:
       metadata.orientation = {"yaw": args.yaw, "pitch": args.pitch, "roll": args.roll}
+      copy_options = transfer.CopyOptions(
+          buffer_count=args.copy_buffers,
+          buffer_size=(args.copy_buffer_mb * 1024 * 1024
+                       if args.copy_buffer_mb else None),
+          threads=args.copy_threads,
+          range_size=args.copy_range_mb * 1024 * 1024)
       metadata_utils.inject_metadata(args.file[0], args.file[1], metadata,
-                                     console, args.force_v1_360_equi_metadata)
+                                     console, args.force_v1_360_equi_metadata,
+                                     copy_options)
     else:
       console("Failed to generate metadata.")
     return
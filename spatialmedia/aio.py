@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asyncio entry points for probing and injecting files.
+
+The blocking work runs on a bounded thread pool so the event loop is never
+stalled:
+
+    metadata = await aio.probe("clip.mp4")
+    await aio.inject("in.mp4", "out.mp4", metadata)
+    async for result in aio.probe_many(paths, concurrency=16):
+        ...
+
+Messages are collected while a file is processed and passed to console on
+the event loop thread once it is done.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import functools
+import os
+import threading
+
+from spatialmedia import metadata_utils
+from spatialmedia.mpeg import transfer
+
+DEFAULT_CONCURRENCY = 8
+
+ProbeResult = collections.namedtuple("ProbeResult",
+                                     "path metadata messages error")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the shared executor running file I/O.
+
+    The pool is created on first use with min(32, cpu count + 4) threads.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                min(32, (os.cpu_count() or 1) + 4),
+                thread_name_prefix="spatialmedia")
+        return _executor
+
+
+def _replay(messages, console):
+    if console is not None:
+        for message in messages:
+            console(message)
+
+
+async def probe(path, console=None, cache=None, executor=None,
+                limits=None):
+    """Parses the spatial media metadata of a file.
+
+    Args:
+      path: string, path of the file.
+      console: function or None, receives messages.
+      cache: probe_cache.ProbeCache or None, cache of probe results.
+      executor: concurrent.futures.Executor or None for the shared pool.
+      limits: mpeg.ParseLimits or None, bounds on parsing untrusted files.
+
+    Returns:
+      ParsedMetadata or None.
+    """
+    loop = asyncio.get_running_loop()
+    messages = list()
+    try:
+        return await loop.run_in_executor(
+            executor or get_executor(),
+            functools.partial(metadata_utils.parse_metadata, path,
+                              messages.append, cache, limits))
+    finally:
+        _replay(messages, console)
+
+
+async def inject(src, dest, metadata, console=None,
+                 force_v1_360_equi_metadata=False, copy_options=None,
+                 executor=None):
+    """Injects metadata into a file.
+
+    Cancelling the calling task stops a running copy at its next block,
+    the partially written output is removed before CancelledError is
+    raised.
+
+    Args:
+      src: string, path of the input file.
+      dest: string, path of the output file, src to update it in place.
+      metadata: Metadata, metadata to inject.
+      console: function or None, receives messages.
+      force_v1_360_equi_metadata: bool, also inject v1 metadata.
+      copy_options: transfer.CopyOptions or None for the defaults.
+      executor: concurrent.futures.Executor or None for the shared pool.
+
+    Returns:
+      Bool, False if the file was not saved with all of the metadata.
+    """
+    loop = asyncio.get_running_loop()
+    options = copy.copy(copy_options or transfer.CopyOptions())
+    options.cancel = threading.Event()
+    messages = list()
+    future = loop.run_in_executor(
+        executor or get_executor(),
+        functools.partial(metadata_utils.inject_metadata, src, dest,
+                          metadata, messages.append,
+                          force_v1_360_equi_metadata, options))
+    try:
+        injected = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        options.cancel.set()
+        try:
+            await future
+        except transfer.CopyCancelled:
+            pass
+        raise
+    finally:
+        _replay(messages, console)
+    return injected
+
+
+async def probe_many(paths, concurrency=DEFAULT_CONCURRENCY, cache=None,
+                     executor=None, limits=None):
+    """Parses the spatial media metadata of many files.
+
+    At most concurrency files are processed at a time. Results are yielded
+    as files finish, not in the order of paths. A failing file is reported
+    in its result and does not stop the others.
+
+    Args:
+      paths: iterable of strings, paths of the files.
+      concurrency: int, number of files processed at a time.
+      cache: probe_cache.ProbeCache or None, cache of probe results.
+      executor: concurrent.futures.Executor or None for the shared pool.
+      limits: mpeg.ParseLimits or None, bounds on parsing untrusted files.
+
+    Yields:
+      ProbeResult(path, metadata, messages, error), error is the exception
+      raised while parsing or None.
+    """
+    async def run(path):
+        messages = list()
+        try:
+            metadata = await probe(path, messages.append, cache, executor,
+                                   limits)
+        except Exception as error:
+            return ProbeResult(path, None, messages, error)
+        return ProbeResult(path, metadata, messages, None)
+
+    paths = iter(paths)
+    pending = set()
+    try:
+        while True:
+            for path in paths:
+                pending.add(asyncio.ensure_future(run(path)))
+                if len(pending) >= concurrency:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,404 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch injection of spatial media metadata.
+
+Injects metadata into many files from one process pool. Files are listed in
+a manifest of JSON lines, one object per file:
+
+    {"src": "in.mp4", "dest": "out.mp4", "stereo": "top-bottom",
+     "spherical": "equirectangular"}
+
+or selected with a glob and given the same metadata fields with --fields.
+Besides src and dest (which defaults to src, injecting in place) a record
+holds fields of metadata_utils.Metadata: stereo, spherical, orientation,
+clip_left_right, fisheye_correction, uv_offsets, fov, mesh_tolerance,
+mesh_cache, audio and v1_xml.
+As on the command line, "degrees" sets clip_left_right for equirectangular
+video, "spatial_audio" derives the audio metadata from the audio track and
+"force_v1_360_equi_metadata" adds v1 metadata.
+
+A JSON result record with timings is written for every file, a failing
+file does not stop the run.
+"""
+
+import argparse
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import glob
+import io
+import json
+import itertools
+import os
+import re
+import sys
+import time
+import traceback
+
+from spatialmedia import metadata_utils
+from spatialmedia.mpeg import transfer
+
+# Characters starting a wildcard in glob patterns.
+GLOB_MAGIC = re.compile("[*?[]")
+
+METADATA_FIELDS = ("stereo", "spherical", "orientation", "clip_left_right",
+                   "fisheye_correction", "uv_offsets", "fov",
+                   "mesh_tolerance", "mesh_cache", "audio", "v1_xml")
+
+
+def metadata_from_record(record, console):
+    """Builds the metadata to inject from a manifest record.
+
+    Args:
+      record: dict, manifest record.
+      console: function, receives messages.
+
+    Returns:
+      Metadata or None if no metadata could be generated.
+    """
+    metadata = metadata_utils.Metadata()
+    metadata.fov = None
+    for field in METADATA_FIELDS:
+        if field in record:
+            setattr(metadata, field, record[field])
+
+    if metadata.orientation is None:
+        metadata.orientation = {"yaw": 0, "pitch": 0, "roll": 0}
+    if (metadata.spherical == "equirectangular" and
+            "clip_left_right" not in record):
+        degrees = str(record.get("degrees", 180))
+        metadata.clip_left_right = 0 if degrees == "360" else 1073741823
+    if not metadata.fov or 0 in metadata.fov:
+        if metadata.spherical == "full-frame":
+            metadata.fov = [16.0, 9.0]
+        else:
+            metadata.fov = [180, 180]
+
+    if record.get("spatial_audio") and not metadata.audio:
+        parsed_metadata = metadata_utils.parse_metadata(record["src"],
+                                                        console)
+        if parsed_metadata is None:
+            return None
+        description = metadata_utils.get_spatial_audio_description(
+            parsed_metadata.num_audio_channels)
+        if not description.is_supported:
+            console("Error, audio has %d channel(s) and is not a supported "
+                    "spatial audio format." %
+                    parsed_metadata.num_audio_channels)
+            return None
+        metadata.audio = metadata_utils.get_spatial_audio_metadata(
+            description.order, description.has_head_locked_stereo)
+
+    if record.get("force_v1_360_equi_metadata") and not metadata.v1_xml:
+        metadata.v1_xml = metadata_utils.generate_spherical_xml(
+            metadata.stereo)
+
+    if not (metadata.stereo or metadata.spherical or metadata.audio):
+        console("Error, failed to generate metadata.")
+        return None
+    return metadata
+
+
+def inject_record(record, copy_settings=None, submitted=None):
+    """Injects the metadata of one manifest record.
+
+    Runs in the worker processes, all errors are reported in the result.
+    The status is decided by whether the file was injected, messages
+    printed by the mpeg package are captured into the result log, standard
+    output only carries result records.
+
+    Args:
+      record: dict, manifest record.
+      copy_settings: dict, keyword arguments for transfer.CopyOptions.
+      submitted: float, time the record was queued at.
+
+    Returns:
+      Dict, result record.
+    """
+    started = time.time()
+    messages = list()
+    result = {"src": record.get("src"), "dest": record.get("dest"),
+              "status": "ok"}
+    if "line" in record:
+        result["line"] = record["line"]
+    if submitted is not None:
+        result["wait_seconds"] = round(started - submitted, 6)
+
+    output = io.StringIO()
+    injected = False
+    try:
+        with contextlib.redirect_stdout(output):
+            if not record.get("src"):
+                raise ValueError("record has no src")
+            result["dest"] = record.get("dest") or record["src"]
+            metadata = metadata_from_record(record, messages.append)
+            if metadata:
+                injected = metadata_utils.inject_metadata(
+                    record["src"], result["dest"], metadata, messages.append,
+                    bool(record.get("force_v1_360_equi_metadata")),
+                    transfer.CopyOptions(**(copy_settings or {})))
+    except Exception as error:
+        messages.append("Error, %s: %s" % (type(error).__name__, error))
+        result["traceback"] = traceback.format_exc()
+    printed = [line for line in output.getvalue().splitlines() if line]
+
+    if injected:
+        result["bytes"] = os.path.getsize(result["dest"])
+    else:
+        # Reported errors explain the failure better than errors printed
+        # while parsing, which are often recovered from.
+        errors = [str(message) for message in messages + printed
+                  if str(message).startswith("Error")]
+        result["status"] = "error"
+        result["error"] = (errors[0] if errors else
+                           "Error, failed to inject metadata")
+    messages.extend(printed)
+    result["seconds"] = round(time.time() - started, 6)
+    result["log"] = [str(message) for message in messages]
+    return result
+
+
+def read_manifest(fh):
+    """Yields the records of a JSON lines manifest.
+
+    Lines that are not JSON objects are yielded as error results instead of
+    stopping the run.
+    """
+    for line_number, line in enumerate(fh, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as error:
+            yield {"line": line_number, "status": "error",
+                   "error": "Error, invalid manifest line: %s" % error}
+            continue
+        record["line"] = line_number
+        yield record
+
+
+def glob_root(pattern):
+    """Returns the directory of a glob pattern above its first wildcard."""
+    root = os.path.dirname(pattern)
+    while GLOB_MAGIC.search(root):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+
+def glob_records(pattern, output_dir, fields):
+    """Yields a record for every file matching pattern.
+
+    Files are written below output_dir at their path relative to the
+    directory the pattern starts from, so files of the same name in
+    different directories matched by ** do not overwrite each other.
+
+    Args:
+      pattern: string, glob pattern, ** matches directories recursively.
+      output_dir: string, directory to write to or None to inject in place.
+      fields: dict, metadata fields for all files.
+    """
+    root = glob_root(pattern)
+    for src in sorted(glob.glob(pattern, recursive=True)):
+        if not os.path.isfile(src):
+            continue
+        record = dict(fields)
+        record["src"] = src
+        if output_dir:
+            record["dest"] = os.path.join(output_dir,
+                                          os.path.relpath(src, root))
+            os.makedirs(os.path.dirname(record["dest"]), exist_ok=True)
+        yield record
+
+
+def run(records, jobs, emit, copy_settings=None):
+    """Injects metadata for all records on a pool of worker processes.
+
+    Records are read as workers become free, at most two per worker are
+    queued, and results are emitted as they finish. A worker process that
+    dies takes the other records it was working on with it, those are
+    retried one at a time in a fresh process so only the record that killed
+    it fails. The remaining records continue on a new pool.
+
+    Args:
+      records: iterable of manifest records.
+      jobs: int, number of worker processes.
+      emit: function, receives a result record for each record.
+      copy_settings: dict, keyword arguments for transfer.CopyOptions.
+
+    Returns:
+      Int, number of records that failed.
+    """
+    failures = [0]
+
+    def report(result):
+        if result["status"] != "ok":
+            failures[0] += 1
+        emit(result)
+
+    records = iter(records)
+    max_pending = jobs * 2
+    crashed = list()
+    more = True
+    while more:
+        broken = False
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = dict()
+            while True:
+                while more and not broken and len(futures) < max_pending:
+                    record = next(records, None)
+                    if record is None:
+                        more = False
+                    elif record.get("status") == "error":
+                        report(record)
+                    else:
+                        try:
+                            future = executor.submit(
+                                inject_record, record, copy_settings,
+                                time.time())
+                        except concurrent.futures.process.BrokenProcessPool:
+                            # Submitted again on the new pool.
+                            records = itertools.chain([record], records)
+                            broken = True
+                            break
+                        futures[future] = record
+                if not futures:
+                    break
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    record = futures.pop(future)
+                    try:
+                        report(future.result())
+                    except concurrent.futures.process.BrokenProcessPool:
+                        crashed.append(record)
+                        broken = True
+
+    for record in crashed:
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            future = executor.submit(inject_record, record, copy_settings,
+                                     time.time())
+            try:
+                report(future.result())
+            except concurrent.futures.process.BrokenProcessPool:
+                report({"src": record.get("src"), "dest": record.get("dest"),
+                        "line": record.get("line"), "status": "error",
+                        "error": "Error, worker process died"})
+    return failures[0]
+
+
+def main(argv=None):
+    """Batch command line, returns the exit status."""
+    parser = argparse.ArgumentParser(
+        prog="spatialmedia --batch",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    parser.add_argument(
+        "manifest", nargs="?",
+        help="JSON lines manifest of files to inject, - reads stdin")
+    parser.add_argument(
+        "-g", "--glob", dest="pattern",
+        help="inject all files matching a glob pattern instead of a manifest")
+    parser.add_argument(
+        "-o", "--output-dir",
+        help="directory for files selected with --glob")
+    parser.add_argument(
+        "--in-place", action="store_true",
+        help="inject files selected with --glob in place instead of writing "
+        "them to --output-dir")
+    parser.add_argument(
+        "-f", "--fields", default="{}",
+        help="JSON object of metadata fields for files selected with --glob")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="number of worker processes")
+    parser.add_argument(
+        "--results",
+        help="file to write the JSON result records to, default stdout")
+    parser.add_argument(
+        "--mesh-cache",
+        help="SQLite file caching generated mesh projections across worker "
+        "processes and runs, used by records without a mesh_cache field")
+    parser.add_argument(
+        "--copy-threads", type=int, default=1,
+        help="number of threads copying ranges of the media data of a file")
+    parser.add_argument(
+        "--copy-range-mb", type=int, default=32,
+        help="size in MB of the ranges copied concurrently")
+    parser.add_argument(
+        "--copy-buffers", type=int, default=4,
+        help="number of buffers in flight between reading and writing when "
+        "the data is copied through Python, i.e. when the kernel cannot copy "
+        "it")
+    parser.add_argument(
+        "--copy-buffer-mb", type=int, default=None,
+        help="size in MB of each copy buffer, by default derived from the "
+        "block size of the files")
+    args = parser.parse_args(argv)
+
+    if bool(args.manifest) == bool(args.pattern):
+        parser.error("give either a manifest or --glob")
+
+    if args.pattern:
+        # Rewriting every matching file is never the default.
+        if bool(args.output_dir) == args.in_place:
+            parser.error("--glob needs either --output-dir or --in-place")
+        try:
+            fields = json.loads(args.fields)
+        except ValueError as error:
+            parser.error("invalid --fields: %s" % error)
+        if args.output_dir and not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        records = glob_records(args.pattern, args.output_dir, fields)
+        manifest_fh = None
+    elif args.manifest == "-":
+        manifest_fh = sys.stdin
+        records = read_manifest(manifest_fh)
+    else:
+        manifest_fh = open(args.manifest)
+        records = read_manifest(manifest_fh)
+
+    if args.mesh_cache:
+        records = (dict({"mesh_cache": args.mesh_cache}, **record)
+                   for record in records)
+
+    results_fh = open(args.results, "w") if args.results else sys.stdout
+
+    def emit(result):
+        results_fh.write(json.dumps(result, sort_keys=True) + "\n")
+        results_fh.flush()
+
+    copy_settings = {"buffer_count": args.copy_buffers,
+                     "threads": args.copy_threads,
+                     "range_size": args.copy_range_mb * 1024 * 1024}
+    if args.copy_buffer_mb:
+        copy_settings["buffer_size"] = args.copy_buffer_mb * 1024 * 1024
+    try:
+        failures = run(records, max(args.jobs, 1), emit, copy_settings)
+    finally:
+        if manifest_fh not in (None, sys.stdin):
+            manifest_fh.close()
+        if results_fh is not sys.stdout:
+            results_fh.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,7 +21,9 @@ import collections
 import os
 import re
 import io
+import shutil
 import struct
+import tempfile
 import traceback
 
 from spatialmedia import mpeg
@@ -29,6 +31,9 @@ from spatialmedia import v1_metadata
 
 MPEG_FILE_EXTENSIONS = [".mp4", ".mov"]
 
+# Saved next to a file updated in place, until the update is complete.
+JOURNAL_SUFFIX = ".spatialmedia-journal"
+
 class Metadata(object):
     def __init__(self):
         self.stereo = None
@@ -39,6 +44,9 @@ class Metadata(object):
         self.clip_left_right = 0
         self.fisheye_correction = [0.0, 0.0, 0.0, 0.0]
         self.uv_offsets = [0, 1, 0, 1, 0, 1, 0, 1]
+        self.mesh_tolerance = 0.0
+        # Path of the store shared by mesh_cache, None caches in memory.
+        self.mesh_cache = None
         self.v1_xml = None
 
 class ParsedMetadata(object):
@@ -76,50 +84,18 @@ def mpeg4_add_spherical_v2(mpeg4_file, in_fh, spherical_metadata, console):
       in_fh: file handle, Source for uncached file contents.
       spherical_metadata: dictionary.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4).decode() == mpeg.constants.TAG_VIDE:
-                        return inject_spherical_atom(in_fh, sub_element, spherical_metadata, console)
+    for track in mpeg4_file.tracks:
+        if track.is_video():
+            return inject_spherical_atom(in_fh, track, spherical_metadata, console)
     return False
 
-def inject_spherical_atom(in_fh, video_media_atom, spherical_metadata, console):
-    for atom in video_media_atom.contents:
-        if atom.name != mpeg.constants.TAG_MINF:
-            continue
-        for element in atom.contents:
-            if element.name != mpeg.constants.TAG_STBL:
-                continue
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_STSD:
-                    continue
-                for sample_description in sub_element.contents:
-                    if sample_description.name in\
-                            mpeg.constants.VIDEO_SAMPLE_DESCRIPTIONS:
-                        in_fh.seek(sample_description.position +
-                                   sample_description.header_size + 16)
-
-                        sv3d_atom = mpeg.sv3dBox.create(spherical_metadata)
-                        
-                        old_atom_index = -1
-                        
-                        for idx, old_atom in enumerate(sample_description.contents):
-                            if old_atom.name == 'sv3d':
-                                old_atom_index = idx
-                        
-                        if old_atom_index > -1:
-                            sample_description.contents[old_atom_index] = sv3d_atom
-                        else:
-                            sample_description.contents.append(sv3d_atom)
-                        return True
-    return False
+def inject_spherical_atom(in_fh, video_track, spherical_metadata, console):
+    sample_descriptions = video_track.video_entries()
+    if not sample_descriptions:
+        return False
+    sv3d_atom = mpeg.sv3dBox.create(spherical_metadata)
+    video_track.set_sample_entry_box(sample_descriptions[0], sv3d_atom)
+    return True
 
 def mpeg4_add_stereo(mpeg4_file, in_fh, stereo_metadata, console):
     """Adds stereo-mode metadata to the first video track of the input
@@ -130,51 +106,18 @@ def mpeg4_add_stereo(mpeg4_file, in_fh, stereo_metadata, console):
       in_fh: file handle, Source for uncached file contents.
       stereo_metadata: string.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4).decode() == mpeg.constants.TAG_VIDE:
-                        return inject_stereo_mode_atom(in_fh, sub_element, stereo_metadata, console)
+    for track in mpeg4_file.tracks:
+        if track.is_video():
+            return inject_stereo_mode_atom(in_fh, track, stereo_metadata, console)
     return False
 
-def inject_stereo_mode_atom(in_fh, video_media_atom, stereo_metadata, console):
-    for atom in video_media_atom.contents:
-        if atom.name != mpeg.constants.TAG_MINF:
-            continue
-        for element in atom.contents:
-            if element.name != mpeg.constants.TAG_STBL:
-                continue
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_STSD:
-                    continue
-                for sample_description in sub_element.contents:
-                    if sample_description.name in\
-                            mpeg.constants.VIDEO_SAMPLE_DESCRIPTIONS:
-                        in_fh.seek(sample_description.position +
-                                   sample_description.header_size + 16)
-
-                        st3d_atom = mpeg.st3dBox.create(stereo_metadata)
-                        
-                        old_atom_index = -1
-                        
-                        for idx, old_atom in enumerate(sample_description.contents):
-                            if old_atom.name == 'st3d':
-                                old_atom_index = idx
-                        
-                        if old_atom_index > -1:
-                            sample_description.contents[old_atom_index] = st3d_atom
-                        else:
-                            sample_description.contents.append(st3d_atom)
-
-                        return True
-    return False
+def inject_stereo_mode_atom(in_fh, video_track, stereo_metadata, console):
+    sample_descriptions = video_track.video_entries()
+    if not sample_descriptions:
+        return False
+    st3d_atom = mpeg.st3dBox.create(stereo_metadata)
+    video_track.set_sample_entry_box(sample_descriptions[0], st3d_atom)
+    return True
 
 def mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console):
     """Adds spatial audio metadata to the first audio track of the input
@@ -187,19 +130,11 @@ def mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console):
       'ambisonic_order': int, 'head_locked_stereo': Bool),
       Supports 'periphonic' ambisonic type only.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4).decode() == mpeg.constants.TAG_SOUN:
-                        return inject_spatial_audio_atom(
-                            in_fh, sub_element, audio_metadata, console)
+    for track in mpeg4_file.tracks:
+        if track.is_audio():
+            return inject_spatial_audio_atom(
+                mpeg4_file.moov_source(in_fh), track, audio_metadata,
+                console)
     return True
 
 def mpeg4_add_audio_metadata(mpeg4_file, in_fh, audio_metadata, console):
@@ -211,57 +146,32 @@ def mpeg4_add_audio_metadata(mpeg4_file, in_fh, audio_metadata, console):
     return mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console)
 
 def inject_spatial_audio_atom(
-    in_fh, audio_media_atom, audio_metadata, console):
-    for atom in audio_media_atom.contents:
-        if atom.name != mpeg.constants.TAG_MINF:
-            continue
-        for element in atom.contents:
-            if element.name != mpeg.constants.TAG_STBL:
-                continue
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_STSD:
-                    continue
-                for sample_description in sub_element.contents:
-                    if sample_description.name in\
-                            mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-                        in_fh.seek(sample_description.position +
-                                   sample_description.header_size + 16)
-                        num_channels = get_num_audio_channels(
-                            sub_element, in_fh)
-                        expected_num_channels = \
-                            get_expected_num_audio_channels(
-                                audio_metadata["ambisonic_type"],
-                                audio_metadata["ambisonic_order"],
-                                audio_metadata["head_locked_stereo"])
-                        if num_channels != expected_num_channels:
-                            head_locked_stereo_msg = (" with head-locked stereo" if
-                                            audio_metadata["head_locked_stereo"] else "")
-                            err_msg = "Error: Found %d audio channel(s). "\
-                                  "Expected %d channel(s) for %s ambisonics "\
-                                  "of order %d%s."\
-                                % (num_channels,
-                                   expected_num_channels,
-                                   audio_metadata["ambisonic_type"],
-                                   audio_metadata["ambisonic_order"],
-                                   head_locked_stereo_msg)
-                            console(err_msg)
-                            return False
-
-                            
-                        sa3d_atom = mpeg.SA3DBox.create(
-                            num_channels, audio_metadata)
-
-                        old_atom_index = -1
-                            
-                        for idx, old_atom in enumerate(sample_description.contents):
-                            if old_atom.name == mpeg.constants.TAG_SA3D:
-                                old_atom_index = idx
-                        
-                        if old_atom_index > -1:
-                            sample_description.contents[old_atom_index] = sa3d_atom
-                        else:
-                            sample_description.contents.append(sa3d_atom)
-                            
+    in_fh, audio_track, audio_metadata, console):
+    for sample_description in audio_track.audio_entries():
+        num_channels = get_num_audio_channels(audio_track.stsd, in_fh)
+        expected_num_channels = \
+            get_expected_num_audio_channels(
+                audio_metadata["ambisonic_type"],
+                audio_metadata["ambisonic_order"],
+                audio_metadata["head_locked_stereo"])
+        if num_channels != expected_num_channels:
+            head_locked_stereo_msg = (" with head-locked stereo" if
+                            audio_metadata["head_locked_stereo"] else "")
+            err_msg = "Error: Found %d audio channel(s). "\
+                  "Expected %d channel(s) for %s ambisonics "\
+                  "of order %d%s."\
+                % (num_channels,
+                   expected_num_channels,
+                   audio_metadata["ambisonic_type"],
+                   audio_metadata["ambisonic_order"],
+                   head_locked_stereo_msg)
+            console(err_msg)
+            return False
+
+        sa3d_atom = mpeg.SA3DBox.create(
+            num_channels, audio_metadata)
+        audio_track.set_sample_entry_box(sample_description, sa3d_atom)
+
     return True
 
 def parse_spherical_mpeg4(mpeg4_file, fh, console):
@@ -275,80 +185,115 @@ def parse_spherical_mpeg4(mpeg4_file, fh, console):
       Dictionary stored as (trackName, metadataDictionary)
     """
     metadata = ParsedMetadata()
-    track_num = 0
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            trackName = "Track %d" % track_num
-            console("\t%s" % trackName)
-            track_num += 1
-
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_MINF:
-                        continue
-                    for stbl_elem in mdia_sub_element.contents:
-                        if stbl_elem.name != mpeg.constants.TAG_STBL:
-                            continue
-                        for stsd_elem in stbl_elem.contents:
-                            if stsd_elem.name != mpeg.constants.TAG_STSD:
-                                continue
-                            for container_elem in stsd_elem.contents:
-                                if container_elem.name in \
-                                        mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-                                    metadata.num_audio_channels = \
-                                        get_num_audio_channels(stsd_elem, fh)
-                                    for sa3d_elem in container_elem.contents:
-                                        if sa3d_elem.name == mpeg.constants.TAG_SA3D:
-                                            sa3d_elem.print_box(console)
-                                            metadata.audio = sa3d_elem
-                                elif container_elem.name in \
-                                        mpeg.constants.VIDEO_SAMPLE_DESCRIPTIONS:
-                                    for stsd_subelem in container_elem.contents:
-                                        if stsd_subelem.name == mpeg.constants.TAG_ST3D:
-                                            stsd_subelem.print_box(console)
-                                            metadata.stereo[trackName] = stsd_subelem
-                                        elif stsd_subelem.name == mpeg.constants.TAG_SV3D:
-                                            stsd_subelem.print_box(console)
-                                            metadata.video[trackName] = stsd_subelem
+    moov_fh = mpeg4_file.moov_source(fh)
+    for track in mpeg4_file.tracks:
+        trackName = track.name
+        console("\t%s" % trackName)
+
+        for container_elem in track.sample_entries:
+            if container_elem.name in \
+                    mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
+                metadata.num_audio_channels = \
+                    get_num_audio_channels(track.stsd, moov_fh)
+                for sa3d_elem in container_elem.contents:
+                    if sa3d_elem.name == mpeg.constants.TAG_SA3D:
+                        sa3d_elem.print_box(console)
+                        metadata.audio = sa3d_elem
+            elif container_elem.name in \
+                    mpeg.constants.VIDEO_SAMPLE_DESCRIPTIONS:
+                for stsd_subelem in container_elem.contents:
+                    if stsd_subelem.name == mpeg.constants.TAG_ST3D:
+                        stsd_subelem.print_box(console)
+                        metadata.stereo[trackName] = stsd_subelem
+                    elif stsd_subelem.name == mpeg.constants.TAG_SV3D:
+                        stsd_subelem.print_box(console)
+                        metadata.video[trackName] = stsd_subelem
     return metadata
 
-def parse_mpeg4(input_file, console):
-    with open(input_file, "rb") as in_fh:
-        mpeg4_file = mpeg.load(in_fh)
+def parse_mpeg4(input_file, console, limits=None):
+    return probe_mpeg4(input_file, console, limits)[0]
+
+def probe_mpeg4(input_file, console, limits=None):
+    """Returns the spherical metadata and the track summary of a file.
+
+    Args:
+      input_file: string, path of the mp4/mov file.
+      console: function, receives messages.
+      limits: mpeg.ParseLimits or None, bounds on parsing untrusted files.
+
+    Returns:
+      Tuple (ParsedMetadata, list of track summaries), (None, None) if the
+      file could not be loaded.
+    """
+    try:
+        in_fh = open(input_file, "rb")
+    except OSError:
+        console("Error \"" + input_file + "\" does not exist or do not have "
+                "permission.")
+        return None, None
+    with in_fh:
+        try:
+            mpeg4_file = mpeg.load(in_fh, limits)
+        except mpeg.ParseError as error:
+            console("Error, file rejected: %s" % error)
+            return None, None
         if mpeg4_file is None:
             console("Error, file could not be opened.")
-            return
+            return None, None
 
         console("Loaded file...")
-        return parse_spherical_mpeg4(mpeg4_file, in_fh, console)
+        metadata = parse_spherical_mpeg4(mpeg4_file, in_fh, console)
+        return metadata, get_track_summary(mpeg4_file, in_fh)
+
 
-    console("Error \"" + input_file + "\" does not exist or do not have "
-            "permission.")
+def inject_mpeg4(input_file, output_file, metadata, console, force_v1_360_equi_metadata=False,
+                 copy_options=None):
+    """Injects metadata into an mp4/mov file.
 
+    Metadata that cannot be inserted is reported and the file is saved
+    without it.
 
-def inject_mpeg4(input_file, output_file, metadata, console, force_v1_360_equi_metadata=False):
-    with open(input_file, "rb") as in_fh:
+    Returns:
+      Bool, True if the file was saved with all of the metadata.
+    """
+    in_place = input_file == output_file
+    if (not in_place and os.path.exists(output_file) and
+            os.path.samefile(input_file, output_file)):
+        console("Error, input and output cannot be the same")
+        return False
+    journal = input_file + JOURNAL_SUFFIX
+    temp_file = None
+    injected = True
+    with open(input_file, "r+b" if in_place else "rb") as in_fh:
+        if in_place and os.path.exists(journal):
+            console("Restoring \"%s\" from an interrupted in place update" %
+                    input_file)
+            if not mpeg.mpeg4_container.restore_journal(in_fh, journal):
+                console("Error, cannot restore from \"%s\"" % journal)
+                return False
 
         mpeg4_file = mpeg.load(in_fh)
         if mpeg4_file is None:
             console("Error file could not be opened.")
+            return False
 
         if metadata.stereo:
             if not mpeg4_add_stereo(
                 mpeg4_file, in_fh, metadata.stereo, console):
                     console("Error failed to insert stereoscopic data")
+                    injected = False
 
         if metadata.spherical:
             if not mpeg4_add_spherical_v2(
                 mpeg4_file, in_fh, metadata, console):
                     console("Error failed to insert spherical data")
+                    injected = False
         
         if force_v1_360_equi_metadata:            
             if not mpeg4_add_spherical_v1(
                 mpeg4_file, in_fh, metadata):
                     console("Error failed to force insert v1 spherical data")
+                    injected = False
 
 
 
@@ -356,61 +301,109 @@ def inject_mpeg4(input_file, output_file, metadata, console, force_v1_360_equi_m
             if not mpeg4_add_audio_metadata(
                 mpeg4_file, in_fh, metadata.audio, console):
                     console("Error failed to insert spatial audio data")
+                    injected = False
 
         console("Saved file settings")
         parse_spherical_mpeg4(mpeg4_file, in_fh, console)
 
-        with open(output_file, "wb") as out_fh:
-            mpeg4_file.save(in_fh, out_fh)
-        return
+        if in_place:
+            if mpeg4_file.save_in_place(in_fh, journal):
+                console("Updated file in place")
+                return injected
+            console("Metadata does not fit in place, rewriting file")
+            out_fd, temp_file = tempfile.mkstemp(
+                suffix=os.path.splitext(output_file)[1],
+                dir=os.path.dirname(output_file))
+            try:
+                with os.fdopen(out_fd, "wb") as out_fh:
+                    mpeg4_file.save(in_fh, out_fh, copy_options)
+            except BaseException:
+                os.remove(temp_file)
+                raise
+        else:
+            try:
+                with open(output_file, "wb") as out_fh:
+                    mpeg4_file.save(in_fh, out_fh, copy_options)
+            except BaseException:
+                # Failed or cancelled saves leave no partial file behind.
+                os.remove(output_file)
+                raise
+            return injected
+
+    shutil.copymode(input_file, temp_file)
+    os.replace(temp_file, output_file)
+    return injected
+
+def parse_metadata(src, console, cache=None, limits=None):
+    """Parses the spatial media metadata of a file.
 
-    console("Error file: \"" + input_file + "\" does not exist or do not have "
-            "permission.")
+    Args:
+      src: string, path of the file.
+      console: function, receives messages.
+      cache: probe_cache.ProbeCache or None, answers files that did not
+          change since they were last parsed without opening them.
+      limits: mpeg.ParseLimits or None, bounds on parsing untrusted files.
 
-def parse_metadata(src, console):
+    Returns:
+      ParsedMetadata or None.
+    """
     infile = os.path.abspath(src)
 
+    if cache is not None:
+        cached = cache.get(infile)
+        if cached is not None:
+            console("Processing: " + infile)
+            cached.replay(console)
+            return cached.metadata
+
     try:
         in_fh = open(infile, "rb")
         in_fh.close()
     except:
         console("Error: " + infile +
                 " does not exist or we do not have permission")
+        return None
 
     console("Processing: " + infile)
     extension = os.path.splitext(infile)[1].lower()
 
     if extension in MPEG_FILE_EXTENSIONS:
-        return parse_mpeg4(infile, console)
+        if cache is not None:
+            return cache.probe(infile, console, limits)
+        return parse_mpeg4(infile, console, limits)
 
     console("Unknown file type")
     return None
 
 
-def inject_metadata(src, dest, metadata, console, force_v1_360_equi_metadata=False):
+def inject_metadata(src, dest, metadata, console, force_v1_360_equi_metadata=False,
+                    copy_options=None):
+    """Injects metadata into a file, see inject_mpeg4.
+
+    Returns:
+      Bool, True if dest was saved with all of the metadata.
+    """
     infile = os.path.abspath(src)
     outfile = os.path.abspath(dest)
 
-    if infile == outfile:
-        return "Input and output cannot be the same"
-
     try:
         in_fh = open(infile, "rb")
         in_fh.close()
     except:
         console("Error: " + infile +
                 " does not exist or we do not have permission")
-        return
+        return False
 
     console("Processing: " + infile)
 
     extension = os.path.splitext(infile)[1].lower()
 
     if (extension in MPEG_FILE_EXTENSIONS):
-        inject_mpeg4(infile, outfile, metadata, console, force_v1_360_equi_metadata)
-        return
+        return inject_mpeg4(infile, outfile, metadata, console,
+                            force_v1_360_equi_metadata, copy_options)
 
     console("Unknown file type")
+    return False
 
 
 def get_descriptor_length(in_fh):
@@ -544,20 +537,24 @@ def get_aac_num_channels(box, in_fh):
 
 def get_num_audio_tracks(mpeg4_file, in_fh):
     """ Returns the number of audio track in the input mpeg4 file. """
-    num_audio_tracks = 0
-    for element in mpeg4_file.moov_box.contents:
-        if (element.name == mpeg.constants.TAG_TRAK):
-            for sub_element in element.contents:
-                if (sub_element.name != mpeg.constants.TAG_MDIA):
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if (mdia_sub_element.name != mpeg.constants.TAG_HDLR):
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if (in_fh.read(4).decode() == mpeg.constants.TAG_SOUN):
-                        num_audio_tracks += 1
-    return num_audio_tracks
+    return len([track for track in mpeg4_file.tracks if track.is_audio()])
+
+def get_track_summary(mpeg4_file, in_fh):
+    """ Returns the handler type and the spatial media boxes of each track
+        in the input mpeg4 file, as a list of dictionaries. """
+    summary = list()
+    for track in mpeg4_file.tracks:
+        boxes = list()
+        for sample_description in track.sample_entries:
+            for element in sample_description.contents:
+                if element.name in (mpeg.constants.TAG_ST3D,
+                                    mpeg.constants.TAG_SV3D,
+                                    mpeg.constants.TAG_SA3D):
+                    boxes.append(element.name)
+        summary.append({"track": track.name,
+                        "handler": track.handler_type,
+                        "boxes": boxes})
+    return summary
 
 def get_spatial_audio_metadata(ambisonic_order, head_locked_stereo):
     num_channels = get_expected_num_audio_channels(
@@ -582,26 +579,11 @@ def mpeg4_add_spherical_v1(mpeg4_file, in_fh, metadata):
       in_fh: file handle, Source for uncached file contents.
       metadata: string, xml metadata to inject into spherical tag.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            added = False
-            element.remove(mpeg.constants.TAG_UUID)
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4).decode() == mpeg.constants.TRAK_TYPE_VIDE:
-                        added = True
-                        break
-
-                if added:
-                    if not element.add(spherical_uuid(metadata)):
-                        return False
-                    break
+    for track in mpeg4_file.tracks:
+        track.trak.remove(mpeg.constants.TAG_UUID)
+        if track.handler_type == mpeg.constants.TRAK_TYPE_VIDE:
+            if not track.trak.add(spherical_uuid(metadata)):
+                return False
 
     return True
 
@@ -19,9 +19,14 @@ import spatialmedia.mpeg.sa3d
 import spatialmedia.mpeg.st3d
 import spatialmedia.mpeg.sv3d
 import spatialmedia.mpeg.box
+import spatialmedia.mpeg.box_index
+import spatialmedia.mpeg.bufferio
 import spatialmedia.mpeg.constants
 import spatialmedia.mpeg.container
+import spatialmedia.mpeg.mesh_cache
 import spatialmedia.mpeg.mpeg4_container
+import spatialmedia.mpeg.parse_limits
+import spatialmedia.mpeg.track
 
 load = mpeg4_container.load
 
@@ -31,5 +36,11 @@ st3dBox = st3d.st3dBox
 sv3dBox = sv3d.sv3dBox
 Container = container.Container
 Mpeg4Container = mpeg4_container.Mpeg4Container
+MappedFile = bufferio.MappedFile
+Track = track.Track
+BoxIndex = box_index.BoxIndex
+ParseLimits = parse_limits.ParseLimits
+ParseError = parse_limits.ParseError
+MeshCache = mesh_cache.MeshCache
 
 __all__ = ["box", "mpeg4", "container", "constants", "sa3d", "st3d", "sv3d"]
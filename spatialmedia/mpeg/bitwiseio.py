@@ -34,6 +34,94 @@ class BitWriter(object):
         self.bcount = 0
 
 
+# Values packed into one int before it is converted to bytes. A multiple
+# of 8, so every chunk ends on a byte boundary.
+PACK_CHUNK = 64
+
+
+def pack_bits(values, width):
+    """Packs values as width bit fields, most significant bit first.
+
+    Returns the bytes BitWriter writes for writebits(value, width) on each
+    value followed by a flush: only the low width bits of each value are
+    kept, the last byte is zero padded and an empty list gives one zero
+    byte. Values are combined in Python ints PACK_CHUNK at a time instead
+    of one bit per call.
+
+    Args:
+      values: sequence of non-negative ints.
+      width: int, bits per value.
+
+    Returns:
+      Bytes, the packed values.
+    """
+    count = len(values)
+    if count == 0 or width == 0:
+        return bytes(1)
+    mask = (1 << width) - 1
+    chunk_bytes = PACK_CHUNK * width // 8
+    packed = []
+    for start in range(0, count, PACK_CHUNK):
+        accumulator = 0
+        for value in values[start:start + PACK_CHUNK]:
+            accumulator = (accumulator << width) | (value & mask)
+        if start + PACK_CHUNK <= count:
+            packed.append(accumulator.to_bytes(chunk_bytes, "big"))
+        else:
+            bits = (count - start) * width
+            padding = -bits % 8
+            packed.append((accumulator << padding).to_bytes(
+                (bits + padding) // 8, "big"))
+    return b"".join(packed)
+
+
+def packed_size(count, width):
+    """Returns the number of bytes pack_bits writes for count values."""
+    return max(1, (count * width + 7) // 8)
+
+
+def unpack_bits(data, width, count):
+    """Unpacks count width bit fields, most significant bit first.
+
+    The inverse of pack_bits. Fields are read from Python ints converted
+    from PACK_CHUNK fields worth of bytes at a time.
+
+    Args:
+      data: bytes, packed fields, at least (count * width + 7) // 8 bytes.
+      width: int, bits per value.
+      count: int, number of values.
+
+    Returns:
+      List of ints.
+
+    Raises:
+      ValueError: data is too short.
+    """
+    if count == 0 or width == 0:
+        return [0] * count
+    if len(data) * 8 < count * width:
+        raise ValueError("%d bytes hold fewer than %d %d bit values" %
+                         (len(data), count, width))
+    mask = (1 << width) - 1
+    chunk_bytes = PACK_CHUNK * width // 8
+    shifts = range((PACK_CHUNK - 1) * width, -1, -width)
+    values = []
+    for start in range(0, count, PACK_CHUNK):
+        offset = start // PACK_CHUNK * chunk_bytes
+        if start + PACK_CHUNK <= count:
+            accumulator = int.from_bytes(
+                data[offset:offset + chunk_bytes], "big")
+            values.extend([(accumulator >> shift) & mask for shift in shifts])
+        else:
+            bits = (count - start) * width
+            padding = -bits % 8
+            accumulator = int.from_bytes(
+                data[offset:offset + (bits + padding) // 8], "big") >> padding
+            values.extend([(accumulator >> shift) & mask
+                           for shift in range(bits - width, -1, -width)])
+    return values
+
+
 class BitReader(object):
     def __init__(self, f):
         self.input = f
@@ -20,10 +20,14 @@
 Tool for loading mpeg4 files and manipulating atoms.
 """
 
-import io 
+import array
+import io
 import struct
+import sys
 
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import schema
+from spatialmedia.mpeg import transfer
 
 def load(fh, position, end):
     """Loads the box located at a position in a mp4 file.
@@ -41,7 +45,8 @@ def load(fh, position, end):
     fh.seek(position)
     header_size = 8
     size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4).decode('latin1')
+    # Few distinct names, share one string per name between boxes.
+    name = sys.intern(fh.read(4).decode('latin1'))
 
     if size == 1:
         size = struct.unpack(">Q", fh.read(8))[0]
@@ -65,15 +70,46 @@ def load(fh, position, end):
     return new_box
 
 
+def slot_descriptors(cls):
+    """Yields the slot descriptors of cls and its base classes."""
+    for klass in cls.__mro__:
+        for name in klass.__dict__.get("__slots__", ()):
+            yield klass.__dict__[name]
+
+
 class Box(object):
     """MPEG4 box contents and behaviour true for all boxes."""
 
+    # Files can hold many thousands of boxes, slots instead of a __dict__
+    # per box keep the tree small. Subclasses declare their own attributes.
+    __slots__ = ("name", "position", "header_size", "content_size",
+                 "contents", "parent")
+
     def __init__(self):
         self.name = ""
         self.position = 0
         self.header_size = 0
         self.content_size = 0
         self.contents = None
+        self.parent = None
+
+    def __getstate__(self):
+        """Boxes are pickled without the tree they are attached to."""
+        state = dict()
+        for slot in slot_descriptors(type(self)):
+            try:
+                state[slot.__name__] = slot.__get__(self)
+            except AttributeError:
+                # Not set on this box.
+                pass
+        state["parent"] = None
+        return state
+
+    def __setstate__(self, state):
+        slots = dict((slot.__name__, slot)
+                     for slot in slot_descriptors(type(self)))
+        for name, value in state.items():
+            slots[name].__set__(self, value)
 
     def content_start(self):
         return self.position + self.header_size
@@ -86,13 +122,7 @@ class Box(object):
           out_fh: file handle, destination for written box contents.
           delta: int, index update amount.
         """
-        if self.header_size == 16:
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(self.name.encode('latin1'))
-            out_fh.write(struct.pack(">Q", self.size()))
-        elif self.header_size == 8:
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name.encode('latin1'))
+        self.save_header(out_fh)
 
         if self.content_start():
             in_fh.seek(self.content_start())
@@ -106,10 +136,26 @@ class Box(object):
         else:
             tag_copy(in_fh, out_fh, self.content_size)
 
+    def save_header(self, out_fh):
+        """Writes the box size and name.
+
+        Args:
+          out_fh: file handle, destination for written box header.
+        """
+        out_fh.write(schema.pack_header(self.name, self.size(),
+                                        self.header_size))
+
     def set(self, new_contents):
         """Sets / overwrites the box contents."""
         self.contents = new_contents
-        self.content_size = len(contents)
+        self.content_size = len(new_contents)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        """Marks the containers holding this box for resizing after its
+        size changed, see Container.resize."""
+        if self.parent is not None:
+            self.parent.mark_dirty()
 
     def size(self):
         """Total size of a box.
@@ -134,47 +180,144 @@ def tag_copy(in_fh, out_fh, size):
       out_fh: file handle, destination for saved file.
       size: int, amount of data to copy.
     """
+    transfer.copy(in_fh, out_fh, size)
 
-    # On 32-bit systems reading / writing is limited to 2GB chunks.
-    # To prevent overflow, read/write 64 MB chunks.
-    block_size = 64 * 1024 * 1024
-    while (size > block_size):
-        contents = in_fh.read(block_size)
-        out_fh.write(contents)
-        size = size - block_size
 
-    contents = in_fh.read(size)
-    out_fh.write(contents)
+def index_typecode(mode_length):
+    """Returns the array typecode for index entries of mode_length bytes."""
+    for typecode in "ILQ":
+        if array.array(typecode).itemsize == mode_length:
+            return typecode
+    raise ValueError("No array type with %d byte items" % mode_length)
+
+
+def index_contents(in_fh, box):
+    """Returns the contents of a stco/co64 box, cached or read from in_fh."""
+    if box.contents:
+        return box.contents
+    in_fh.seek(box.content_start())
+    return in_fh.read(box.content_size)
+
 
+def read_index(in_fh, box, mode_length):
+    """Reads a stco/co64 index table with a single read.
 
-def index_copy(in_fh, out_fh, box, mode, mode_length, delta=0):
+    Args:
+      in_fh: file handle, source to read index table from.
+      box: box, stco/co64 box to read.
+      mode_length: int, number of bytes for index entires.
+
+    Returns:
+      Tuple (header, entries, trailer): int version and flags, array of
+      native index entries and bytes stored after the entries.
+
+    Raises:
+      ValueError: the box is too short for its entry count.
+    """
+    contents = index_contents(in_fh, box)
+    header, values, end = index_layout(contents, box, mode_length)
+    entries = array.array(index_typecode(mode_length))
+    entries.frombytes(memoryview(contents)[8:end])
+    if sys.byteorder == "little":
+        entries.byteswap()
+    return header, entries, contents[end:]
+
+
+def index_layout(contents, box, mode_length):
+    """Returns the version and flags, entry count and end of the entries
+    of a stco/co64 table.
+
+    Raises:
+      ValueError: contents are too short for the entry count.
+    """
+    if len(contents) < 8:
+        raise ValueError("Truncated %s box at %d" % (box.name, box.position))
+    header, values = struct.unpack_from(">II", contents)
+    end = 8 + values * mode_length
+    if end > len(contents):
+        raise ValueError("%s box at %d holds fewer than %d entries" %
+                         (box.name, box.position, values))
+    return header, values, end
+
+
+def shift_entries(data, delta, mode_length):
+    """Adds delta to every big endian index entry stored in data.
+
+    The entries are shifted with a few operations on big integers: data
+    read as one integer plus delta repeated in every entry. An entry leaving
+    the range of its type carries into, or borrows from, the entry before
+    it, which shows in the carry bits at the entry boundaries.
+
+    Args:
+      data: bytes, index entries of mode_length bytes each.
+      delta: int, offset change for index entries.
+      mode_length: int, number of bytes for index entires.
+
+    Returns:
+      Bytes, the shifted entries.
+
+    Raises:
+      OverflowError: a shifted entry does not fit in mode_length bytes.
+    """
+    count = len(data) // mode_length
+    # 1 in the lowest bit of every entry.
+    ones = int.from_bytes(
+        (bytes(mode_length - 1) + b"\x01") * count, "big")
+    entries = int.from_bytes(data, "big")
+    shift = ones * abs(delta)
+    if delta > 0:
+        shifted = entries + shift
+    else:
+        shifted = entries - shift
+    carries = (shifted ^ entries ^ shift) & ones
+    if carries or shifted < 0 or shifted.bit_length() > 8 * len(data):
+        raise OverflowError(
+            "Chunk offset shifted by %d does not fit in %d bytes" %
+            (delta, mode_length))
+    return shifted.to_bytes(len(data), "big")
+
+
+def index_copy(in_fh, out_fh, box, mode_length, delta=0):
     """Update and copy index table for stco/co64 files.
 
     Args:
       in_fh: file handle, source to read index table from.
       out_fh: file handle, destination for index file.
       box: box, stco/co64 box to copy.
-      mode: string, bit packing mode for index entries.
       mode_length: int, number of bytes for index entires.
       delta: int, offset change for index entries.
+
+    Raises:
+      ValueError: the table is shifted and too short for its entry count.
+      OverflowError: a shifted entry does not fit in mode_length bytes.
     """
-    fh = in_fh
-    if not box.contents:
-        fh.seek(box.content_start())
-    else:
-        fh = io.BytesIO(box.contents)
+    contents = index_contents(in_fh, box)
+    if delta:
+        header, values, end = index_layout(contents, box, mode_length)
+        contents = (contents[:8] +
+                    shift_entries(contents[8:end], delta, mode_length) +
+                    contents[end:])
+    out_fh.write(contents)
 
-    header = struct.unpack(">I", fh.read(4))[0]
-    values = struct.unpack(">I", fh.read(4))[0]
 
-    new_contents = []
-    new_contents.append(struct.pack(">I", header))
-    new_contents.append(struct.pack(">I", values))
-    for i in range(values):
-        content = fh.read(mode_length)
-        content = struct.unpack(mode, content)[0] + delta
-        new_contents.append(struct.pack(mode, content))
-    out_fh.write("".encode('latin1').join(new_contents))
+def stco_to_co64(in_fh, box):
+    """Converts a stco box into a co64 box holding the same chunk offsets.
+
+    The converted index table is cached in the box contents.
+
+    Args:
+      in_fh: file handle, source to read index table from.
+      box: box, stco box to convert.
+    """
+    header, entries, trailer = read_index(in_fh, box, 4)
+    entries = array.array(index_typecode(8), entries)
+    if sys.byteorder == "little":
+        entries.byteswap()
+    box.name = constants.TAG_CO64
+    box.contents = (struct.pack(">II", header, len(entries)) +
+                    entries.tobytes() + trailer)
+    box.content_size = len(box.contents)
+    box.mark_dirty()
 
 
 def stco_copy(in_fh, out_fh, box, delta=0):
@@ -186,7 +329,7 @@ def stco_copy(in_fh, out_fh, box, delta=0):
       box: box, stco box to copy.
       delta: int, offset change for index entries.
     """
-    index_copy(in_fh, out_fh, box, ">I", 4, delta)
+    index_copy(in_fh, out_fh, box, 4, delta)
 
 
 def co64_copy(in_fh, out_fh, box, delta=0):
@@ -198,4 +341,4 @@ def co64_copy(in_fh, out_fh, box, delta=0):
       box: box, co64 box to copy.
       delta: int, offset change for index entries.
     """
-    index_copy(in_fh, out_fh, box, ">Q", 8, delta)
+    index_copy(in_fh, out_fh, box, 8, delta)
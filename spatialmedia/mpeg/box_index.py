@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG box index.
+
+Index of the boxes of a file by tag and by path. The path of a box lists the
+names of the boxes from the top level down to it, for example
+"moov/trak/mdia/minf/stbl/stsd/avc1". Queries are a tag, or a path where
+each level may use fnmatch wildcards:
+
+    index.find_all("sv3d")
+    index.find_all("moov/trak/mdia/minf/stbl/stsd/*")
+"""
+
+import fnmatch
+
+from spatialmedia.mpeg import container
+
+WILDCARDS = frozenset("*?[")
+
+
+def box_path(element):
+    """Returns the path of element from the top of its tree."""
+    names = list()
+    while element.parent is not None:
+        names.append(element.name)
+        element = element.parent
+    names.reverse()
+    return "/".join(names)
+
+
+def has_wildcards(pattern):
+    return not WILDCARDS.isdisjoint(pattern)
+
+
+class BoxIndex(object):
+    """Map from tags and paths to the boxes of a tree.
+
+    Boxes are listed in file order as of when the index was built, boxes
+    added later come last. The index is kept up to date by Container.add,
+    remove and replace; contents lists changed directly are not seen.
+    """
+
+    def __init__(self, root):
+        """Indexes all boxes inside root, loading deferred contents.
+
+        Args:
+          root: container, top of the tree.
+        """
+        self.by_tag = dict()
+        self.by_path = dict()
+        for element in root.contents:
+            self.add(element)
+
+    def _walk(self, element, path):
+        """Yields element and the boxes nested inside it with their paths,
+        depth first."""
+        stack = [(element, path)]
+        while stack:
+            element, path = stack.pop()
+            yield element, path
+            if isinstance(element, container.Container):
+                for sub_element in reversed(element.contents):
+                    stack.append(
+                        (sub_element, path + "/" + sub_element.name))
+
+    def add(self, element):
+        """Indexes element and the boxes nested inside it.
+
+        element must already be attached to its parent.
+        """
+        for nested, path in self._walk(element, box_path(element)):
+            key = id(nested)
+            self.by_tag.setdefault(nested.name, dict())[key] = nested
+            self.by_path.setdefault(path, dict())[key] = nested
+
+    def remove(self, element):
+        """Drops element and the boxes nested inside it from the index.
+
+        element must still be attached to its parent.
+        """
+        for nested, path in self._walk(element, box_path(element)):
+            for table, name in ((self.by_tag, nested.name),
+                                (self.by_path, path)):
+                nodes = table.get(name)
+                if nodes is None:
+                    continue
+                nodes.pop(id(nested), None)
+                if not nodes:
+                    del table[name]
+
+    def find_all(self, query):
+        """Returns the boxes matching a tag or path query.
+
+        Args:
+          query: string, tag like "stco" or path like "moov/trak/*/hdlr".
+
+        Returns:
+          List of boxes.
+        """
+        query = query.strip("/")
+        table = self.by_path if "/" in query else self.by_tag
+        if not has_wildcards(query):
+            return list(table.get(query, dict()).values())
+
+        parts = query.split("/")
+        found = list()
+        for key, nodes in table.items():
+            names = key.split("/")
+            if len(names) != len(parts):
+                continue
+            if all(fnmatch.fnmatchcase(name, part)
+                   for name, part in zip(names, parts)):
+                found.extend(nodes.values())
+        return found
+
+    def find(self, query):
+        """Returns the first box matching query, or None."""
+        found = self.find_all(query)
+        return found[0] if found else None
+
+    def __len__(self):
+        return sum(len(nodes) for nodes in self.by_tag.values())
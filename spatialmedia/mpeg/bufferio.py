@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory file handles.
+
+Lets boxes be parsed from a buffer holding part of a file, or from a memory
+map of the whole file, using the same positions as the file itself.
+"""
+
+import io
+import mmap
+
+
+class BufferReader(object):
+    """Read only file handle over a buffer holding part of a file.
+
+    The first byte of the buffer is at file position base. The buffer is
+    accessed through a memoryview and never copied as a whole.
+    """
+
+    def __init__(self, buffer, base=0, fh=None):
+        self.buffer = memoryview(buffer)
+        self.base = base
+        self.position = base
+        self.fh = fh
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def end(self):
+        """File position just after the last byte of the buffer."""
+        return self.base + len(self.buffer)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.end() + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def fileno(self):
+        """Descriptor of the file the buffer maps, if it maps a file."""
+        if self.fh is None:
+            raise io.UnsupportedOperation("Buffer is not backed by a file")
+        return self.fh.fileno()
+
+    def read(self, size=-1):
+        data = self.view(self.position, size)
+        self.position += len(data)
+        return data.tobytes()
+
+    def view(self, position, size=-1):
+        """Returns a memoryview of size bytes at position, without copying.
+
+        Args:
+          position: int, file position of the first byte.
+          size: int, number of bytes, or -1 for the rest of the buffer.
+        """
+        start = position - self.base
+        if start < 0:
+            raise ValueError("Position %d is before the buffer" % position)
+        if size is None or size < 0:
+            return self.buffer[start:]
+        return self.buffer[start:start + size]
+
+
+class MappedFile(object):
+    """Read only memory map of a whole file.
+
+    The map is shared by every reader created with reader(), each reader
+    keeps its own position so several threads can parse the same file at
+    the same time.
+    """
+
+    def __init__(self, filename):
+        self.fh = open(filename, "rb")
+        self.fh.seek(0, io.SEEK_END)
+        if self.fh.tell() > 0:
+            self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def reader(self):
+        """Returns a new file handle over the map."""
+        return BufferReader(self.map, 0, self.fh)
+
+    def view(self, box):
+        """Returns the contents of a leaf box as a memoryview of the map.
+
+        The view keeps the map alive: close() leaves a map with views in
+        use mapped until the last of them is released.
+        """
+        start = box.content_start()
+        return memoryview(self.map)[start:start + box.content_size]
+
+    def close(self):
+        """Closes the file. The map itself stays valid until the last
+        reader or view using it is gone."""
+        if isinstance(self.map, mmap.mmap):
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+        self.map = b""
+        self.fh.close()
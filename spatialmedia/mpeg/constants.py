@@ -23,6 +23,7 @@ TRAK_TYPE_VIDE = "vide"
 TAG_STCO = "stco"
 TAG_CO64 = "co64"
 TAG_FREE = "free"
+TAG_SKIP = "skip"
 TAG_MDAT = "mdat"
 TAG_XML = "xml "
 TAG_HDLR = "hdlr"
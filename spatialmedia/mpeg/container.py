@@ -22,21 +22,45 @@ Functions for loading MPEG files and manipulating boxes.
 
 import io 
 import struct
+import sys
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
 from spatialmedia.mpeg import sa3d
+from spatialmedia.mpeg import schema
 from spatialmedia.mpeg import st3d
 from spatialmedia.mpeg import sv3d
 
-def load(fh, position, end):
+def report(budget, *message):
+    """Prints why a box failed to load, unless budget reports it instead."""
+    if budget is None:
+        print (*message)
+
+
+def load(fh, position, end, budget=None):
+    """Loads the box at position, deferring the contents of containers.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int or None, position of the box.
+      end: int, end position of the enclosing box.
+      budget: parse_limits.ParseBudget or None, with a budget failures are
+          not printed, the caller raises a ParseError instead.
+
+    Returns:
+      The loaded box or None if it failed to load.
+    """
     if position is None:
         position = fh.tell()
 
     fh.seek(position)
     header_size = 8
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4).decode('latin1')
+    header = fh.read(schema.HEADER.size)
+    if len(header) < schema.HEADER.size or position + 8 > end:
+        report(budget, "Error, truncated box header at", position)
+        return None
+    size, name = schema.HEADER.unpack(header)
+    name = sys.intern(name.decode('latin1'))
 
     is_box = False
     if (name not in constants.AUDIO_CONTAINERS_LIST) and \
@@ -53,20 +77,36 @@ def load(fh, position, end):
             return st3d.load(fh, position, end)
         elif name == constants.TAG_SV3D:
             return sv3d.load(fh, position, end)
-        return box.load(fh, position, end)
 
     if size == 1:
-        size = struct.unpack(">Q", fh.read(8))[0]
+        largesize = fh.read(8)
+        if len(largesize) < 8:
+            report(budget, "Error, truncated box header at", position)
+            return None
+        size = struct.unpack(">Q", largesize)[0]
         header_size = 16
 
     if size < 8:
-        print ("Error, invalid size", size, "in", name, "at", position)
+        report(budget, "Error, invalid size", size, "in", name, "at",
+               position)
         return None
 
     if (position + size) > end:
-        print ("Error: Container box size exceeds bounds.")
+        if is_box:
+            report(budget, "Error: Leaf box size exceeds bounds.")
+        else:
+            report(budget, "Error: Container box size exceeds bounds.")
         return None
 
+    if is_box:
+        # Same as box.load, without reading the header again.
+        new_box = box.Box()
+        new_box.name = name
+        new_box.position = position
+        new_box.header_size = header_size
+        new_box.content_size = size - header_size
+        return new_box
+
     padding = 0
     if name == constants.TAG_STSD:
         padding = 8
@@ -103,44 +143,174 @@ def load(fh, position, end):
     new_box.header_size = header_size
     new_box.content_size = size - header_size
     new_box.padding = padding
-    new_box.contents = load_multiple(
+    new_box.defer_contents(
         fh, position + header_size + padding, position + size)
 
-    if new_box.contents is None:
-        return None
-
     return new_box
 
 
-def load_multiple(fh, position=None, end=None):
+def load_multiple(fh, position=None, end=None, budget=None, parent=None):
+    """Loads the boxes stored one after another from position to end.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int, position of the first box.
+      end: int, end position of the last box.
+      budget: parse_limits.ParseBudget or None, counts the loaded boxes.
+      parent: container or None, container the boxes are loaded into.
+
+    Returns:
+      List of boxes or None if a box failed to load.
+
+    Raises:
+      parse_limits.ParseError: a box failed to load, only with a budget.
+    """
     loaded = list()
     while (position < end):
-        new_box = load(fh, position, end)
+        new_box = load(fh, position, end, budget)
         if new_box is None:
+            if budget is not None:
+                budget.reject_invalid(parent)
             print ("Error, failed to load box.")
             return None
+        new_box.parent = parent
+        if budget is not None:
+            budget.count_box(new_box)
         loaded.append(new_box)
         position = new_box.position + new_box.size()
 
     return loaded
 
 
+def load_tree(root, budget):
+    """Loads all deferred contents below root within the limits of budget.
+
+    Containers are visited from an explicit stack, so deeply nested files
+    cannot exhaust the Python stack.
+
+    Args:
+      root: container, top of the tree, its contents are at depth 1.
+      budget: parse_limits.ParseBudget, raises a ParseError when a limit
+          is exceeded or a container fails to load.
+    """
+    stack = [(element, 1) for element in reversed(root.contents)
+             if isinstance(element, Container)]
+    while stack:
+        element, depth = stack.pop()
+        budget.check_time(element)
+        if not element.load_contents(budget):
+            budget.reject_invalid(element)
+        if element.contents:
+            budget.check_depth(depth + 1, element)
+        for sub_element in reversed(element.contents):
+            if isinstance(sub_element, Container):
+                stack.append((sub_element, depth + 1))
+
+
 class Container(box.Box):
     """MPEG4 container box contents / behaviour."""
 
+    __slots__ = ("padding", "_contents", "_source", "_unparsed", "_dirty")
+
     def __init__(self, padding=0):
         self.name = ""
         self.position = 0
         self.header_size = 0
         self.content_size = 0
+        self.parent = None
+        self._dirty = True
         self.contents = list()
         self.padding = padding
 
+    @property
+    def contents(self):
+        """List of boxes inside the container, loaded on first access."""
+        self.load_contents()
+        return self._contents
+
+    @contents.setter
+    def contents(self, contents):
+        self._source = None
+        self._unparsed = False
+        self._contents = contents
+        for element in contents:
+            element.parent = self
+        self.mark_dirty()
+
+    def defer_contents(self, fh, position, end):
+        """Sets where the contents are loaded from when first accessed.
+
+        Args:
+          fh: file handle, input file handle. Must stay open until the
+              contents are loaded.
+          position: int, position of the first box inside the container.
+          end: int, end position of the container.
+        """
+        self._source = (fh, position, end)
+        self._unparsed = False
+        self._contents = list()
+        # The size read from the file is up to date.
+        self._dirty = False
+
+    def is_loaded(self):
+        """Returns whether the contents have been loaded from the file."""
+        return self._source is None
+
+    def load_contents(self, budget=None):
+        """Loads deferred contents.
+
+        Contents that fail to load are left empty and the box is saved
+        unchanged from the source file.
+
+        Args:
+          budget: parse_limits.ParseBudget or None, counts the loaded boxes.
+
+        Returns:
+          Bool, False if the contents could not be loaded.
+        """
+        if self._source is not None:
+            fh, position, end = self._source
+            self._source = None
+            contents = load_multiple(fh, position, end, budget, self)
+            if contents is None:
+                print ("Error, keeping", self.name, "box at", self.position,
+                       "unparsed.")
+                self._unparsed = True
+                contents = list()
+            self._contents = contents
+        return not self._unparsed
+
+    def mark_dirty(self):
+        """Marks this container and the containers holding it for resizing.
+
+        Containers are marked when boxes are added, removed or replaced
+        inside them. Boxes changing their own size call Box.mark_dirty.
+        """
+        element = self
+        # Containers above a dirty container are already dirty.
+        while element is not None and not element._dirty:
+            element._dirty = True
+            element = element.parent
+
+    def is_dirty(self):
+        """Returns whether the size has to be recomputed by resize()."""
+        return self._dirty
+
     def resize(self):
-        """Recomputes the box size and recurses on contents."""
+        """Recomputes the box size of dirty containers.
+
+        Only containers marked dirty, and the dirty containers inside them,
+        are visited; the sizes of the others are up to date.
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        if not self.is_loaded() or self._unparsed:
+            # Saved unchanged from the source file.
+            return
         self.content_size = self.padding
         for element in self.contents:
-            if isinstance(element, Container):
+            if isinstance(element, Container) and element._dirty:
                 element.resize()
             self.content_size += element.size()
 
@@ -167,47 +337,90 @@ class Container(box.Box):
             element.print_structure(next_indent)
 
     def remove(self, tag):
-        """Removes a tag recursively from all containers."""
+        """Removes a tag recursively from all containers.
+
+        Only containers that held the tag get a new contents list and are
+        marked for resizing.
+        """
         new_contents = []
-        self.content_size = 0
         for element in self.contents:
             if element.name != tag:
                 new_contents.append(element)
                 if isinstance(element, Container):
                     element.remove(tag)
-                self.content_size += element.size()
-        self.contents = new_contents
+            else:
+                self.box_removed(element)
+                element.parent = None
+        if len(new_contents) != len(self.contents):
+            self.contents = new_contents
 
     def add(self, element):
         """Adds an element, merging with containers of the same type.
 
         Returns:
-          Int, increased size of container.
+          Bool, False if the element could not be added.
         """
         for content in self.contents:
             if content.name == element.name:
-                if isinstance(content, container_leaf):
+                if (isinstance(content, Container) and
+                        isinstance(element, Container)):
                     return content.merge(element)
                 print ("Error, cannot merge leafs.")
                 return False
 
+        element.parent = self
         self.contents.append(element)
+        self.mark_dirty()
+        self.box_added(element)
         return True
 
     def merge(self, element):
         """Merges structure with container.
 
         Returns:
-          Int, increased size of container.
+          Bool, False if an element could not be added.
         """
         assert(self.name == element.name)
-        assert(isinstance(element, container_box))
-        for sub_element in element.contents:
+        assert(isinstance(element, Container))
+        for sub_element in list(element.contents):
             if not self.add(sub_element):
                 return False
 
         return True
 
+    def replace(self, old_element, new_element):
+        """Replaces an element of the container, keeping its position.
+
+        Returns:
+          Bool, False if old_element is not in the container.
+        """
+        for index, element in enumerate(self.contents):
+            if element is old_element:
+                break
+        else:
+            print ("Error,", old_element.name, "box not found in", self.name)
+            return False
+
+        self.box_removed(old_element)
+        old_element.parent = None
+        new_element.parent = self
+        self.contents[index] = new_element
+        self.mark_dirty()
+        self.box_added(new_element)
+        return True
+
+    def box_added(self, element):
+        """Called when element was attached somewhere below this container,
+        passes the change up to the root."""
+        if self.parent is not None:
+            self.parent.box_added(element)
+
+    def box_removed(self, element):
+        """Called before element is detached from somewhere below this
+        container, passes the change up to the root."""
+        if self.parent is not None:
+            self.parent.box_removed(element)
+
     def save(self, in_fh, out_fh, delta):
         """Saves box to out_fh reading uncached content from in_fh.
 
@@ -216,13 +429,14 @@ class Container(box.Box):
           out_fh: file_hande, destination for saved file.
           delta: int, file change size for updating stco and co64 files.
         """
-        if self.header_size == 16:
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(self.name.encode('latin1'))
-            out_fh.write(struct.pack(">Q", self.size()))
-        elif self.header_size == 8:
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name.encode('latin1'))
+        self.save_header(out_fh)
+
+        # Unchanged contents are copied as they are, unless chunk offsets
+        # inside them need updating.
+        if (not self.is_loaded() and delta == 0) or not self.load_contents():
+            in_fh.seek(self.content_start())
+            box.tag_copy(in_fh, out_fh, self.content_size)
+            return
 
         if self.padding > 0:
             in_fh.seek(self.content_start())
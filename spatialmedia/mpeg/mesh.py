@@ -21,9 +21,12 @@ Enables the injection of an sv3d mesh project box The mesh projection box specif
 conforms to that outlined in docs/spherical-video-v2-rfc.md
 """
 
+import array
 import struct
+import itertools
 import math
 import io
+import sys
 from spatialmedia import metadata_utils
 
 from spatialmedia.mpeg import box
@@ -79,167 +82,232 @@ def load(fh, position=None, end=None):
     
 
 
+    # Counts are checked against the data left in the box before they are
+    # used, so corrupt counts cannot make the loops below run for long.
+    mesh_end = position + new_box.content_size
+
+    def bits_left():
+        return (mesh_end - fh.tell()) * 8
+
     new_box.coordinate_count = struct.unpack(">I", fh.read(4))[0]
-    
-    new_box.coordinates = struct.unpack(">{0}f".format(new_box.coordinate_count), fh.read(4*new_box.coordinate_count))
-    
-    # print (new_box.coordinates)
+    if not 0 < new_box.coordinate_count * 32 <= bits_left():
+        print ("Error: invalid mesh coordinate count.")
+        return None
+
+    new_box.coordinates = array.array("f")
+    new_box.coordinates.frombytes(fh.read(4 * new_box.coordinate_count))
+    if sys.byteorder == "little":
+        new_box.coordinates.byteswap()
 
     ccsb =  int(math.ceil(math.log(new_box.coordinate_count * 2, 2.0)))
 
     new_box.vertex_count = struct.unpack(">I", fh.read(4))[0]
+    if not 0 < new_box.vertex_count * 5 * ccsb <= bits_left():
+        print ("Error: invalid mesh vertex count.")
+        return None
 
-    # print ("coordinate_count:{}".format(new_box.coordinate_count))
-    # print ("vertex_count:{}".format(new_box.vertex_count))
-    # print ("ccsb:{0}".format(ccsb))
+    # x, y, z, u and v coordinate indices of each vertex, one after another.
+    count = new_box.vertex_count * 5
+    new_box.vertex_buffer = array.array("q", decode_deltas(
+        bitwiseio.unpack_bits(fh.read(bitwiseio.packed_size(count, ccsb)),
+                              ccsb, count), 5))
 
+    new_box.vertex_list_count = struct.unpack(">I", fh.read(4))[0]
+    if new_box.vertex_list_count * 6 * 8 > bits_left():
+        print ("Error: invalid mesh vertex list count.")
+        return None
+    ccsb =  int(math.ceil(math.log(new_box.vertex_count * 2, 2.0)))
+
+    # Index lists in the format of the triangles made by the generators.
+    new_box.vertex_list = []
+    for x in range(new_box.vertex_list_count):
+        header = fh.read(6)
+        if len(header) < 6:
+            print ("Error: invalid mesh vertex list count.")
+            return None
+        texture_id, index_type, index_count = struct.unpack(">BBI", header)
+        if index_count * ccsb > bits_left():
+            print ("Error: invalid mesh index count.")
+            return None
+        data = fh.read(bitwiseio.packed_size(index_count, ccsb))
+        indices = array.array("q", decode_deltas(
+            bitwiseio.unpack_bits(data, ccsb, index_count)))
+        new_box.vertex_list.append({'txt': texture_id, 'type': index_type,
+                                    'count': index_count, 'list': indices})
+
+    return new_box
+
+
+def encode_deltas(indices, stride=1):
+    """Returns the coded deltas stored for a list of mesh indices.
+
+    Each index is stored as its delta from the index stride places
+    before it, or from 0 for the first stride indices. Deltas d >= 0 are
+    coded as 2 * d and negative ones as -2 * d + 1.
     """
-       vertex_buffer = fh.read(5*ccsb*new_box.vertex_count);
-    """
+    previous = itertools.chain(itertools.repeat(0, stride), indices)
+    deltas = []
+    for index, previous_index in zip(indices, previous):
+        delta = index - previous_index
+        deltas.append(delta * 2 if delta >= 0 else (-delta * 2) + 1)
+    return deltas
+
+
+def decode_deltas(coded, stride=1):
+    """Returns the mesh indices stored as coded deltas, see encode_deltas."""
+    # Starts with the stride zeros the first deltas are relative to.
+    indices = [0] * stride
+    append = indices.append
+    for position, value in enumerate(coded):
+        delta = value >> 1
+        append(indices[position] + (-delta if value & 1 else delta))
+    return indices[stride:]
+
+
+def compact_coordinates(mesh_details, tolerance=0.0):
+    """Returns mesh details storing each distinct coordinate value once.
+
+    The generators give every vertex its own x, y, z, u and v values
+    although many are shared, such as the y of a row or the u of a
+    column. Values are compared as the float32 stored in the file, so with
+    no tolerance the decoded mesh is unchanged. A smaller coordinate table
+    also narrows the vertex index fields. Values are stored in the order
+    the vertices first use them, keeping index deltas small for deflate.
 
-    bit_read = bitwiseio.BitReader(fh)
+    Args:
+      mesh_details: dict, mesh as returned by the generators.
+      tolerance: float, values are rounded to multiples of tolerance
+          first, 0.0 keeps them exact.
 
-    new_box.vertex_buffer = []
+    Returns:
+      Dict, mesh details with the new coordinates and vertices.
+    """
+    coordinates = mesh_details['coordinates']
+    if tolerance:
+        coordinates = [round(value / tolerance) * tolerance
+                       for value in coordinates]
+    # Rounded to the float32 values process_mesh writes.
+    coordinates = array.array("f", coordinates).tolist()
+
+    table = dict()
+    vertices = []
+    for index in mesh_details['vertices']:
+        vertices.append(table.setdefault(coordinates[index], len(table)))
+    return { 'coordinates':list(table), 'vertices':vertices,
+             'triangles':mesh_details['triangles']}
 
-    """ read in bits, ccsb bits at a time """
-    for vertex_loop in range(new_box.vertex_count):
-        tmp = {'x': bit_read.readbits(ccsb), 'y':bit_read.readbits(ccsb),'z':bit_read.readbits(ccsb), 'u':bit_read.readbits(ccsb), 'v':bit_read.readbits(ccsb) }
-        # print (tmp)
-        new_box.vertex_buffer.append ( tmp )
 
-    new_box.vertex_list_count = struct.unpack(">I", fh.read(4))[0]
-    ccsb =  int(math.ceil(math.log(new_box.vertex_count * 2, 2.0)))
+def steps(start, delta, count):
+    """Returns count values from start in steps of delta.
 
+    The steps are summed one at a time, not computed as start + i * delta,
+    so generated meshes stay byte identical to those of earlier releases.
+    """
+    return list(itertools.accumulate(
+        itertools.chain([start], itertools.repeat(delta, count - 1))))
 
-    # print ("vertex_list_count:{0}".format(new_box.vertex_list_count));
-    # print ("ccsb:{0}".format(ccsb));
 
-    new_box.vertex_list = []
-    bit_read2 = bitwiseio.BitReader(fh)
+def sphere_points(radius, phis, thetas):
+    """Returns the (x, y, z) points of a latitude / longitude grid.
 
+    Sines and cosines are computed once per row and column, not per point.
 
-    for x in range(new_box.vertex_list_count):
-        texture_id = fh.read(1)
-        index_type = fh.read(1)
-        index_count = struct.unpack(">I", fh.read(4))[0]
-        index_as_delta = []
+    Args:
+      radius: float, sphere radius.
+      phis: list of floats, latitude of each row.
+      thetas: list of floats, longitude of each column.
 
-        # print ("texture_id:{0}".format(texture_id));
-        # print ("index_type:{0}".format(index_type));
+    Returns:
+      List of (x, y, z) tuples, row by row.
+    """
+    columns = [(math.cos(theta), math.sin(theta)) for theta in thetas]
+    points = []
+    for phi in phis:
+        radius_cos_phi = radius * math.cos(phi)
+        y = radius * math.sin(phi)
+        points.extend([(radius_cos_phi * cos_theta, y,
+                        radius_cos_phi * sin_theta)
+                       for cos_theta, sin_theta in columns])
+    return points
 
-        # print ("index_count:{0}".format(index_count));
 
-        
-        for y in range(index_count):
-            index_as_delta.append(bit_read2.readbits(ccsb))
-        tmp = {'txt':texture_id, 'type':index_type, 'count':index_count, 'strip':index_as_delta}
-        new_box.vertex_list.append (tmp)
-        # print ("tmp:{0}".format(tmp));
+def normalize(points):
+    """Returns the points scaled to unit length."""
+    normals = []
+    for x, y, z in points:
+        mag = math.sqrt((x*x)+(y*y)+(z*z))
+        normals.append((x/mag, y/mag, z/mag))
+    return normals
 
-    # print ("new_box:{0}".format(new_box));
 
-    return new_box
+def grid_uvs(us, vs):
+    """Returns the (u, v) texture coordinates of a grid, row by row."""
+    return [(u, v) for v in vs for u in us]
 
 
-def gen_flat_mesh(grid, z_dist, x_scale, y_scale):
+def grid_strip(grid):
+    """Returns one triangle strip covering a grid of grid x grid cells.
 
+    Rows run counter-clockwise and are joined by degenerate triangles.
     """
-        Create a hemi-sphere.
-        top and bottom are triangle fans joined at the pole
-        Rest is a grid of triangle strips.
-        
+    point_count = grid + 1
+    strip = []
+    for row_index in range(0, grid):
+        top = row_index * point_count
+        bottom = top + point_count
+        row = [0] * (2 * point_count)
+        row[0::2] = range(top, bottom)
+        row[1::2] = range(bottom, bottom + point_count)
+        strip.extend(row)
+        if row_index < grid - 1:
+            # degenerate
+            strip.extend([grid + bottom, bottom])
+    return strip
+
+
+def grid_mesh(points, uvs, grid):
+    """Returns the mesh details of a grid for meshBox.process_mesh.
+
+    Args:
+      points: list of (x, y, z) tuples, row by row.
+      uvs: list of (u, v) tuples, texture coordinates of the points.
+      grid: int, number of cells per row and column.
     """
-    coordinates = []
-    vertices = []
-    triangles = []
-    triangle_list = []
-    
+    coordinates = [value for (x, y, z), (u, v) in zip(points, uvs)
+                   for value in (x, y, z, u, v)]
+    # Every vertex uses its own coordinates.
+    vertices = list(range(len(coordinates)))
+    strip = grid_strip(grid)
+    triangles = [{'txt': 0, 'type': 1, 'count': len(strip), 'list': strip}]
+    return { 'coordinates':coordinates, 'vertices':vertices, 'triangles':triangles}
+
+
+def gen_flat_mesh(grid, z_dist, x_scale, y_scale):
+    """Creates a flat rectangle at z_dist in front of the viewer, scaled
+    to the x_scale / y_scale aspect ratio."""
     point_count = grid+1
 
     if x_scale > y_scale :
         scale_value = 4.0 / x_scale
-        x_scale *= scale_value
-        y_scale *= scale_value
     else :
         scale_value = 4.0 / y_scale
-        x_scale *= scale_value
-        y_scale *= scale_value
+    x_scale *= scale_value
+    y_scale *= scale_value
 
     x_offset = x_scale / 2
     y_offset = y_scale / 2
 
-    coord_index = 0
     delta = 1.0 / grid
-    
-    for y_index in range(0,point_count):
-        
-        for x_index in range(0,point_count):
-            
-            u = x_index * delta
-            v = y_index * delta
-            z = -z_dist
-            x = (u * x_scale) - x_offset
-            y = (v * y_scale) - y_offset
-            coordinates.append (x)
-            coordinates.append (y)
-            coordinates.append (z)
-            coordinates.append (u)
-            coordinates.append (v)
-            
-            # print ("x {0}, y {1}, z {2}, u {3}, v{4}").format(x,y,z,u, v)
-            
-            
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-    
-    
-    """
-        generate triangles / triangles are counter-clockwise
-    """
-    
-    strip = []
-    
-    for row_index in range(0, grid):
-        for col_index in range(0, point_count):
-            i = col_index + (row_index * point_count)
-            j = col_index + ((row_index + 1)* point_count)
-            strip.extend([i, j])
-        if row_index < grid -1:
-            j = ((row_index + 1) * point_count)
-            i = grid + ((row_index + 1) * point_count)
-            strip.extend([i, j])
-
-    triangles.append ({'txt': 0, 'type': 1, 'count': len(strip), 'list':strip})
-
-
-#    print triangles
-    
-    """
-        encode the indices
-    """
-    return { 'coordinates':coordinates, 'vertices':vertices, 'triangles':triangles}
+    us = [index * delta for index in range(point_count)]
+    vs = us
+    xs = [(u * x_scale) - x_offset for u in us]
+    points = [(x, (v * y_scale) - y_offset, -z_dist) for v in vs for x in xs]
+    return grid_mesh(points, grid_uvs(us, vs), grid)
 
 
 def gen_mesh_flexible(grid, radius, x_scale, y_scale, fisheye_correction, uv_function):
-    """
-        Create a hemi-sphere.
-        top and bottom are triangle fans joined at the pole
-        Rest is a grid of triangle strips.
-        
-        """
-    coordinates = []
-    vertices = []
-    triangles = []
-    triangle_list = []
-    
+    """Creates a part of a sphere covering the x_scale / y_scale aspect
+    ratio, textured from a full fisheye image through uv_function."""
     if x_scale > y_scale:
         y_scale = y_scale / x_scale
         x_scale = 1.0
@@ -247,410 +315,129 @@ def gen_mesh_flexible(grid, radius, x_scale, y_scale, fisheye_correction, uv_fun
         x_scale = x_scale / y_scale
         y_scale = 1.0
 
-    # print (fisheye_correction)
-    
     point_count = grid+1;
-    
+
     theta_delta_grid = (math.pi * x_scale) / grid
     phi_delta_grid = (math.pi * y_scale) / grid
 
     theta_delta_uv = math.pi / grid
     phi_delta_uv = math.pi / grid
-    
-    print ("x: {0} , y: {1}".format(x_scale, y_scale))
-    print ("grid: {0} , uv: {1}".format(theta_delta_grid, theta_delta_uv))
+
     phi_grid = -(math.pi/ 2.0) +  (((1.0 - y_scale) * 0.5) * math.pi)
     phi_uv = -(math.pi/ 2.0)
+    theta_grid = math.pi  +  (((1.0 - x_scale) * 0.5) * math.pi)
+    theta_uv = math.pi
 
-    coord_index = 0
-    
-    for phi_index in range(0,point_count):
-        
-        theta_uv = math.pi
-        theta_grid = math.pi  +  (((1.0 - x_scale) * 0.5) * math.pi)
-
-        for theta_index in range(0,point_count):
-            
-            
-            
-            x = radius * math.cos(phi_grid) * math.cos(theta_grid)
-            z = radius * math.cos(phi_grid) * math.sin(theta_grid)
-            y = radius * math.sin(phi_grid)
-            
-            coordinates.append (x)
-            coordinates.append (y)
-            coordinates.append (z)
-            
-            x = radius * math.cos(phi_uv) * math.cos(theta_uv)
-            z = radius * math.cos(phi_uv) * math.sin(theta_uv)
-            y = radius * math.sin(phi_uv)
-
-            mag = math.sqrt((x*x)+(y*y)+(z*z));
-            
-            tmp = uv_function (x/mag,y/mag,z/mag, 0.0, 1.0, 0.0, 1.0, fisheye_correction)
-            
-            #            print( "x {0}, y {1}, z {2}, u {3}, v{4}".format(x,y,z, tmp[0], tmp [1]))
-            
-            coordinates.extend(tmp)
-            
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            
-            theta_uv += theta_delta_uv
-            theta_grid += theta_delta_grid
-
-        phi_uv += phi_delta_uv
-        phi_grid += phi_delta_grid
-
-    
-    """
-    generate triangles / triangles are counter-clockwise
-    """
-    
-    strip = []
-    
-    for row_index in range(0, grid):
-        for col_index in range(0, point_count):
-            i = col_index + (row_index * point_count)
-            j = col_index + ((row_index + 1)* point_count)
-            strip.extend([i, j])
-        if row_index < grid -1:
-            # degenerate
-            j = ((row_index + 1) * point_count)
-            i = grid + ((row_index + 1) * point_count)
-            strip.extend([i, j])
-
-    triangles.append ({'txt': 0, 'type': 1, 'count': len(strip), 'list':strip})
-
-
-#    print (triangles)
+    points = sphere_points(
+        radius, steps(phi_grid, phi_delta_grid, point_count),
+        steps(theta_grid, theta_delta_grid, point_count))
+    uv_points = sphere_points(
+        radius, steps(phi_uv, phi_delta_uv, point_count),
+        steps(theta_uv, theta_delta_uv, point_count))
+    uvs = [uv_function(x, y, z, 0.0, 1.0, 0.0, 1.0, fisheye_correction)
+           for x, y, z in normalize(uv_points)]
+    return grid_mesh(points, uvs, grid)
 
-    """
-    encode the indices
-    """
-    return { 'coordinates':coordinates, 'vertices':vertices, 'triangles':triangles}
 
 def gen_mesh(grid, radius, u_min, u_scale, v_min, v_scale, fisheye_correction):
-    """
-        Create a hemi-sphere.
-        top and bottom are triangle fans joined at the pole
-        Rest is a grid of triangle strips.
-        
-        """
-    coordinates = []
-    vertices = []
-    triangles = []
-    triangle_list = []
-    
-    # print (fisheye_correction)
-    
+    """Creates a hemi-sphere textured from a fisheye image, see get_uvs."""
     point_count = grid+1;
-    
-    
+
     theta_delta = math.pi / grid
     phi_delta = math.pi / grid
-    
-    
-    
-    phi = -(math.pi/ 2.0)
-    coord_index = 0
-    
-    for phi_index in range(0,point_count):
-        
-        theta = math.pi
-        
-        for theta_index in range(0,point_count):
-            
-            x = radius * math.cos(phi) * math.cos(theta)
-            z = radius * math.cos(phi) * math.sin(theta)
-            y = radius * math.sin(phi)
-            coordinates.append (x)
-            coordinates.append (y)
-            coordinates.append (z)
-            
-            mag = math.sqrt((x*x)+(y*y)+(z*z));
-            
-            tmp = get_uv (x/mag,y/mag,z/mag, u_min, u_scale, v_min, v_scale, fisheye_correction)
-            
-            print( "x {0}, y {1}, z {2}, u {3}, v{4}".format(x,y,z, tmp[0], tmp [1]))
-            
-            coordinates.extend(tmp)
-            
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            
-            theta += theta_delta
-        phi += phi_delta
-    
-    
-    """
-        generate triangles / triangles are counter-clockwise
-        """
-    
-    strip = []
-    
-    for row_index in range(0, grid):
-        for col_index in range(0, point_count):
-            i = col_index + (row_index * point_count)
-            j = col_index + ((row_index + 1)* point_count)
-            strip.extend([i, j])
-        if row_index < grid -1:
-            # degenerate
-            j = ((row_index + 1) * point_count)
-            i = grid + ((row_index + 1) * point_count)
-            strip.extend([i, j])
-
-    triangles.append ({'txt': 0, 'type': 1, 'count': len(strip), 'list':strip})
 
+    points = sphere_points(radius,
+                           steps(-(math.pi/ 2.0), phi_delta, point_count),
+                           steps(math.pi, theta_delta, point_count))
+    uvs = get_uvs(normalize(points), u_min, u_scale, v_min, v_scale,
+                  fisheye_correction)
+    return grid_mesh(points, uvs, grid)
 
-#    print (triangles)
-
-    """
-    encode the indices
-    """
-    return { 'coordinates':coordinates, 'vertices':vertices, 'triangles':triangles}
 
 def gen_mesh_eq(grid, radius, fisheye_correction):
-    """
-        Create a hemi-sphere.
-        top and bottom are triangle fans joined at the pole
-        Rest is a grid of triangle strips.
-        
-    """
-    coordinates = []
-    vertices = []
-    triangles = []
-    triangle_list = []
-    
-    # print (fisheye_correction)
-
+    """Creates a hemi-sphere textured from an equirectangular image."""
     point_count = grid+1;
 
-    
     theta_delta = math.pi / grid
     phi_delta = math.pi / grid
-    
+
     u_delta = 1.0 / grid;
     v_delta = 1.0 / grid;
 
-    
-    phi = -(math.pi/ 2.0)
-    coord_index = 0
-
-    v = 0.0;
-    for phi_index in range(0,point_count):
-
-        theta = math.pi
-        u = 0.0;
-
-        for theta_index in range(0,point_count):
-
-            x = radius * math.cos(phi) * math.cos(theta)
-            z = radius * math.cos(phi) * math.sin(theta)
-            y = radius * math.sin(phi)
-            coordinates.append (x)
-            coordinates.append (y)
-            coordinates.append (z)
-
-            absu =  math.fabs(u-0.5)
-            adju = 0.9 * (absu*absu) + (0.5 * absu)
-
-            if u < 0.5 :
-                adju = 0.5 - adju
-            else :
-                adju = 0.5 + adju
-
-            absv =  math.fabs(v-0.5)
-            adjv = (0.9 * (absv*absv)) + (0.5 * absv)
-
-            if v < 0.5 :
-                adjv = 0.5 - adjv
-            else :
-                adjv = 0.5 + adjv
-
-            coordinates.append(u)
-            coordinates.append(v)
-            #coordinates.append(adju)
-            #coordinates.append(adjv)
-            
-            
-
-            print( "x {0}, y {1}, z {2}, u {3}, v {4}".format(x,y,z, u, v))
-
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-
-            theta += theta_delta
-            u += u_delta
-        
-        phi += phi_delta
-        v += v_delta
-
+    points = sphere_points(radius,
+                           steps(-(math.pi/ 2.0), phi_delta, point_count),
+                           steps(math.pi, theta_delta, point_count))
+    uvs = grid_uvs(steps(0.0, u_delta, point_count),
+                   steps(0.0, v_delta, point_count))
+    return grid_mesh(points, uvs, grid)
 
-    """
-        generate triangles / triangles are counter-clockwise
-    """
-    
-    strip = []
-
-    for row_index in range(0, grid):
-        for col_index in range(0, point_count):
-            i = col_index + (row_index * point_count)
-            j = col_index + ((row_index + 1)* point_count)
-            strip.extend([i, j])
-        if row_index < grid -1:
-            # degenerate
-            j = ((row_index + 1) * point_count)
-            i = grid + ((row_index + 1) * point_count)
-            strip.extend([i, j])
-
-    triangles.append ({'txt': 0, 'type': 1, 'count': len(strip), 'list':strip})
-
-
-#    print (triangles)
-
-    """
-        encode the indices
-    """
-    return { 'coordinates':coordinates, 'vertices':vertices, 'triangles':triangles}
 
 def gen_mesh_fov(grid, radius, fov_x, fov_y):
-    """
-        Create a hemi-sphere.
-        top and bottom are triangle fans joined at the pole
-        Rest is a grid of triangle strips.
-        
-    """
-    coordinates = []
-    vertices = []
-    triangles = []
-    triangle_list = []
-    
+    """Creates the part of a sphere covering a fov_x by fov_y degrees field
+    of view, textured from an equirectangular image."""
     point_count = grid+1;
-    
+
     fov_ratio_theta = fov_x / 180.0
     fov_start_theta = (180.0 - fov_x) * 0.5 * math.pi / 180.0;
-    # print (fov_ratio_theta) 
-    # print (fov_start_theta) 
-    
     theta_delta = (math.pi * fov_ratio_theta) / grid
 
     fov_ratio_phi = fov_y / 180.0
     fov_start_phi = (180.0 - fov_y) * 0.5 * math.pi / 180.0;
-    # print (fov_ratio_phi) 
-    # print (fov_start_phi) 
-    
     phi_delta = (math.pi * fov_ratio_phi) / grid
-    
+
     u_delta = 1.0 / grid
     v_delta = 1.0 / grid
- 
-    phi = -(math.pi/ 2.0) + fov_start_phi 
-    coord_index = 0
-   
-    v = 0; 
-    for phi_index in range(0,point_count):
-        
-        theta = math.pi + fov_start_theta
-        u = 0
-        
-        for theta_index in range(0,point_count):
-            
-            x = radius * math.cos(phi) * math.cos(theta)
-            z = radius * math.cos(phi) * math.sin(theta)
-            y = radius * math.sin(phi)
-            coordinates.append (x)
-            coordinates.append (y)
-            coordinates.append (z)
-            coordinates.append (u)
-            coordinates.append (v)
-            
-            # print( "x {0}, y {1}, z {2}, u {3}, v {4}".format(x,y,z, u, v))
-            
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            vertices.append(coord_index)
-            coord_index += 1
-            
-            theta += theta_delta
-            u += u_delta
- 
-        phi += phi_delta
-        v += v_delta 
-    
-    """
-        generate triangles / triangles are counter-clockwise
-    """
-    
-    strip = []
-    
-    for row_index in range(0, grid):
-        for col_index in range(0, point_count):
-            i = col_index + (row_index * point_count)
-            j = col_index + ((row_index + 1)* point_count)
-            strip.extend([i, j])
-        if row_index < grid -1:
-            # degenerate
-            j = ((row_index + 1) * point_count)
-            i = grid + ((row_index + 1) * point_count)
-            strip.extend([i, j])
 
-    triangles.append ({'txt': 0, 'type': 1, 'count': len(strip), 'list':strip})
+    points = sphere_points(
+        radius, steps(-(math.pi/ 2.0) + fov_start_phi, phi_delta, point_count),
+        steps(math.pi + fov_start_theta, theta_delta, point_count))
+    uvs = grid_uvs(steps(0, u_delta, point_count),
+                   steps(0, v_delta, point_count))
+    return grid_mesh(points, uvs, grid)
 
 
-#    print (triangles)
-
-    """
-    encode the indices
-    """
-    return { 'coordinates':coordinates, 'vertices':vertices, 'triangles':triangles}
-
 def get_uv(x,y,z, u_min, u_scale, v_min, v_scale, fisheye_correction):
+    """Returns the [u, v] fisheye texture coordinates of a unit vector."""
+    return list(get_uvs([(x, y, z)], u_min, u_scale, v_min, v_scale,
+                        fisheye_correction)[0])
 
-    r = math.atan2(math.sqrt((x*x)+(y*y)),-z) / math.pi
-    phi = math.atan2(y,x)
 
-    # test lens correction
-    nr = r + (fisheye_correction[0]*r) - (fisheye_correction[1] * r * r) + (fisheye_correction[2] * r * r * r) + (fisheye_correction[3] * r * r * r * r)
+def get_uvs(normals, u_min, u_scale, v_min, v_scale, fisheye_correction):
+    """Returns the fisheye texture coordinates of unit vectors.
 
-    u = nr * math.cos(phi) + 0.5
-    v = nr * math.sin(phi) + 0.5
-    
-    return [(u *  u_scale) + u_min, (v * v_scale) + v_min]
+    Args:
+      normals: list of (x, y, z) unit vectors.
+      u_min, u_scale, v_min, v_scale: float, area of the texture used.
+      fisheye_correction: list of 4 floats, lens polynomial coefficients.
 
+    Returns:
+      List of (u, v) tuples.
+    """
+    k1, k2, k3, k4 = fisheye_correction[:4]
+    atan2 = math.atan2
+    sqrt = math.sqrt
+    cos = math.cos
+    sin = math.sin
+    pi = math.pi
+    uvs = []
+    for x, y, z in normals:
+        r = atan2(sqrt((x*x)+(y*y)),-z) / pi
+        phi = atan2(y,x)
+
+        # test lens correction
+        nr = r + (k1*r) - (k2 * r * r) + (k3 * r * r * r) + (k4 * r * r * r * r)
+
+        u = nr * cos(phi) + 0.5
+        v = nr * sin(phi) + 0.5
+        uvs.append(((u *  u_scale) + u_min, (v * v_scale) + v_min))
+    return uvs
 
 
 class meshBox(box.Box):
+    __slots__ = ("meshes", "projection", "coordinate_count", "coordinates",
+                 "vertex_count", "vertex_buffer", "vertex_list_count",
+                 "vertex_list")
+
     def __init__(self):
         box.Box.__init__(self)
         self.name = 'mesh'
@@ -663,27 +450,31 @@ class meshBox(box.Box):
         new_box.content_size = 0
         new_box.name = 'mesh'
         new_box.projection = metadata.spherical
+        tolerance = metadata.mesh_tolerance
         
         if new_box.projection == "full-frame":
             if metadata.stereo == 'none':
-                new_box.contents = new_box.process_mesh(gen_flat_mesh(43, 3 , metadata.fov[0], metadata.fov[1]))
+                new_box.contents = new_box.process_mesh(gen_flat_mesh(43, 3 , metadata.fov[0], metadata.fov[1]), tolerance)
                 new_box.meshes = 1
             else:
-                new_box.contents = new_box.process_mesh(gen_flat_mesh(43, 3 , metadata.fov[0], metadata.fov[1])) + new_box.process_mesh(gen_flat_mesh(43, 3 , metadata.fov[0], metadata.fov[1]))
+                # Both eyes use the same mesh, generated once.
+                eye = new_box.process_mesh(gen_flat_mesh(43, 3 , metadata.fov[0], metadata.fov[1]), tolerance)
+                new_box.contents = eye + eye
                 new_box.meshes = 2
         elif new_box.projection == "equi-mesh":
             if metadata.stereo == 'none':
-                new_box.contents = new_box.process_mesh(gen_mesh_fov(39, 1, metadata.fov[0], metadata.fov[1]))
+                new_box.contents = new_box.process_mesh(gen_mesh_fov(39, 1, metadata.fov[0], metadata.fov[1]), tolerance)
                 new_box.meshes = 1
             else:
                 
                 # equi_fov test 
-                new_box.contents = new_box.process_mesh(gen_mesh_fov(39, 1, metadata.fov[0], metadata.fov[1])) + new_box.process_mesh(gen_mesh_fov(39, 1, metadata.fov[0], metadata.fov[1]))
+                eye = new_box.process_mesh(gen_mesh_fov(39, 1, metadata.fov[0], metadata.fov[1]), tolerance)
+                new_box.contents = eye + eye
                 
                 new_box.meshes = 2
         else:
             if metadata.stereo == 'none':
-                new_box.contents = new_box.process_mesh(gen_mesh(39, 1, 0.0, 1.0, 0.0, 0.1, metadata.fisheye_correction))
+                new_box.contents = new_box.process_mesh(gen_mesh(39, 1, 0.0, 1.0, 0.0, 0.1, metadata.fisheye_correction), tolerance)
                 new_box.meshes = 1
             else:
                 # new_box.contents = new_box.process_mesh(gen_mesh_flexible(39, 1.0, 1.0, 1.0, metadata.fisheye_corection)) + new_box.process_mesh(gen_mesh_flexible(39, 1.0, 16.0, 9.0, metadata.fisheye_correction))
@@ -694,15 +485,17 @@ class meshBox(box.Box):
                 # actual VR180 code.
                 #new_box.contents = new_box.process_mesh(gen_mesh(39, 1, 0.0, 0.98, 0.125, 0.75, metadata.fisheye_correction)) + new_box.process_mesh(gen_mesh(39, 1 , 0.01, 0.98, 0.125, 0.75, metadata.fisheye_correction))
                 #new_box.contents = new_box.process_mesh(gen_mesh(39, 1, 0.0, 1, 0, 1, metadata.fisheye_correction)) + new_box.process_mesh(gen_mesh(39, 1, 0, 1, 0, 1, metadata.fisheye_correction))
-                new_box.contents = new_box.process_mesh(gen_mesh(39, 1, metadata.uv_offsets[0], 
-                                                                        metadata.uv_offsets[1], 
-                                                                        metadata.uv_offsets[2],
-                                                                        metadata.uv_offsets[3],
-                                                                        metadata.fisheye_correction)) + new_box.process_mesh(gen_mesh(39, 1, metadata.uv_offsets[4], 
-                                                       metadata.uv_offsets[5], 
-                                                       metadata.uv_offsets[6],
-                                                       metadata.uv_offsets[7],
-                                                       metadata.fisheye_correction))
+                left_uv = list(metadata.uv_offsets[0:4])
+                right_uv = list(metadata.uv_offsets[4:8])
+                left = new_box.process_mesh(gen_mesh(39, 1, left_uv[0], left_uv[1], left_uv[2], left_uv[3],
+                                                     metadata.fisheye_correction), tolerance)
+                # Lenses framed the same way share one mesh.
+                if right_uv == left_uv:
+                    right = left
+                else:
+                    right = new_box.process_mesh(gen_mesh(39, 1, right_uv[0], right_uv[1], right_uv[2], right_uv[3],
+                                                          metadata.fisheye_correction), tolerance)
+                new_box.contents = left + right
                 new_box.meshes = 2
 
         return new_box
@@ -717,7 +510,7 @@ class meshBox(box.Box):
         """ Outputs a concise single line audio metadata string. """
         return self.meshes
     
-    def process_mesh(self, mesh_details):
+    def process_mesh(self, mesh_details, tolerance=None):
         """ mesh box is 4 byte size (include size itself)
             id 'mesh'
             1 bit reserved
@@ -736,7 +529,15 @@ class meshBox(box.Box):
                 31 bit index count
                 index count x ceil(log2(coordinate_count * 2)) encoded index
                 0-7 bits padding to get to byte boundary )
+
+            tolerance: float or None, coordinates closer than tolerance
+                share one value, 0.0 only shares equal values and None
+                stores every coordinate as generated, see
+                compact_coordinates.
         """
+        if tolerance is not None:
+            mesh_details = compact_coordinates(mesh_details, tolerance)
+
         lfh = io.BytesIO(b'')
         
         coords = mesh_details['coordinates']
@@ -751,25 +552,11 @@ class meshBox(box.Box):
         
         lfh.write(struct.pack(">I", num_vertices))
         
-        bit_write = bitwiseio.BitWriter(lfh)
         ccsb =  int(math.ceil(math.log(num_coords * 2, 2.0)))
 
-        previous_vertex = [0,0,0,0,0]
-
-        count_previous = 0
-        for vertex in vertices:
-            delta = vertex - previous_vertex[count_previous]
-            vertex_delta = 0
-            if delta < 0:
-                vertex_delta = (-delta * 2) + 1
-            else:
-                vertex_delta = delta * 2
-            bit_write.writebits(vertex_delta, ccsb)
-            previous_vertex[count_previous] = vertex
-            count_previous += 1
-            count_previous = count_previous % 5
-
-        bit_write.flush()
+        # Each of x, y, z, u and v is a delta from the same field of the
+        # previous vertex.
+        lfh.write(bitwiseio.pack_bits(encode_deltas(vertices, 5), ccsb))
 
 
         tri_lists = mesh_details['triangles']
@@ -789,17 +576,7 @@ class meshBox(box.Box):
             lfh.write(struct.pack(">B", strip['txt']))
             lfh.write(struct.pack(">B", strip['type']))
             lfh.write(struct.pack(">I", strip['count']))
-            previous_list_index = 0
-            for list_index in strip['list']:
-                delta = list_index - previous_list_index
-                list_index_delta = 0
-                if delta < 0:
-                    list_index_delta = (-delta * 2) + 1
-                else:
-                    list_index_delta = delta * 2
-                bit_write.writebits(list_index_delta, ccsb)
-                previous_list_index = list_index
-            bit_write.flush()
+            lfh.write(bitwiseio.pack_bits(encode_deltas(face_indices), ccsb))
 
         lfh.flush()
         lfh.seek(0)
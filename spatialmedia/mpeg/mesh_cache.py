@@ -0,0 +1,296 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of mesh projection payloads.
+
+Generating and deflating the meshes of a mesh projection box is the
+slowest part of injecting a short clip, and clips shot on the same lens
+get the same box. The payload of the box, the encoded meshes and their
+CRC, is cached under a hash of the Metadata fields meshBox.create reads.
+A least recently used set of payloads is kept in memory, in front of an
+optional SQLite store that processes can share:
+
+    cache = mesh_cache.open_cache("meshes.db")
+    payload = cache.get_or_create(metadata, generate)
+"""
+
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+# Part of every key, bump it when the generated meshes change.
+FORMAT_VERSION = 1
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_ENTRIES = 32
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    key TEXT NOT NULL PRIMARY KEY,
+    encoding BLOB NOT NULL,
+    contents BLOB NOT NULL,
+    crc32 INTEGER NOT NULL,
+    meshes INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS payloads_last_used ON payloads (last_used);
+"""
+
+# Caches opened by open_cache, by path.
+_caches = dict()
+_caches_lock = threading.Lock()
+
+
+def payload_crc32(encoding, contents):
+    """Returns the CRC stored in a mesh projection box."""
+    return zlib.crc32(encoding + contents) & 0xffffffff
+
+
+class MeshPayload(object):
+    """Payload of a mesh projection box.
+
+    Attributes:
+      encoding: bytes, mesh encoding, b'dfl8' or b'raw '.
+      contents: bytes, encoded meshes.
+      crc32: int, CRC of encoding and contents.
+      meshes: int, number of meshes, 2 for stereo video.
+    """
+
+    def __init__(self, encoding, contents, meshes, crc32=None):
+        self.encoding = encoding
+        self.contents = contents
+        self.meshes = meshes
+        if crc32 is None:
+            crc32 = payload_crc32(encoding, contents)
+        self.crc32 = crc32
+
+    def size(self):
+        return len(self.encoding) + len(self.contents)
+
+
+def mesh_parameters(metadata):
+    """Returns the fields of metadata that decide the generated meshes.
+
+    Args:
+      metadata: Metadata, injected metadata of a mesh projection.
+
+    Returns:
+      Dict of JSON types, numbers are floats so 180 and 180.0 match.
+    """
+    parameters = {
+        "version": FORMAT_VERSION,
+        "projection": metadata.spherical,
+        "mono": metadata.stereo == "none",
+        "mesh_tolerance": float(metadata.mesh_tolerance),
+        }
+    if metadata.spherical in ("full-frame", "equi-mesh"):
+        parameters["fov"] = [float(value) for value in metadata.fov[:2]]
+    else:
+        parameters["fisheye_correction"] = [
+            float(value) for value in metadata.fisheye_correction[:4]]
+        if not parameters["mono"]:
+            parameters["uv_offsets"] = [
+                float(value) for value in metadata.uv_offsets[:8]]
+    return parameters
+
+
+def cache_key(metadata):
+    """Returns the hex SHA-256 of the canonical mesh parameters."""
+    canonical = json.dumps(mesh_parameters(metadata), sort_keys=True,
+                           separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class MeshCache(object):
+    """Least recently used cache of mesh payloads.
+
+    Payloads are looked up in memory first, then in the SQLite store if
+    the cache has one. The store is evicted, least recently used first,
+    once it holds more than max_bytes. The cache can be shared by threads.
+    """
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES):
+        """Opens a cache.
+
+        Args:
+          path: string or None, path of the SQLite store, None keeps the
+              payloads in memory only.
+          max_bytes: int, size bound for the stored payloads.
+          memory_entries: int, number of payloads kept in memory.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, timeout=30,
+                                              check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            with self.connection:
+                self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Closes the store, the payloads in memory stay available."""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def get(self, key):
+        """Returns the MeshPayload cached under key, or None."""
+        with self.lock:
+            payload = self.memory.get(key)
+            if payload is not None:
+                self.memory.move_to_end(key)
+                return payload
+            if self.connection is None:
+                return None
+
+            row = self.connection.execute(
+                "SELECT encoding, contents, crc32, meshes FROM payloads "
+                "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            encoding, contents, crc32, meshes = row
+            with self.connection:
+                if payload_crc32(encoding, contents) != crc32:
+                    # Damaged, generate it again.
+                    self.connection.execute(
+                        "DELETE FROM payloads WHERE key = ?", (key,))
+                    return None
+                self.connection.execute(
+                    "UPDATE payloads SET last_used = ? WHERE key = ?",
+                    (time.time(), key))
+            payload = MeshPayload(bytes(encoding), bytes(contents), meshes,
+                                  crc32)
+            self._remember(key, payload)
+        return payload
+
+    def put(self, key, payload):
+        """Stores payload under key."""
+        with self.lock:
+            self._remember(key, payload)
+            if self.connection is None:
+                return
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO payloads VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?)",
+                    (key, payload.encoding, payload.contents, payload.crc32,
+                     payload.meshes, payload.size(), time.time()))
+                self._evict()
+
+    def get_or_create(self, metadata, create):
+        """Returns the payload for metadata, creating it on a miss.
+
+        Args:
+          metadata: Metadata, injected metadata of a mesh projection.
+          create: function, returns the MeshPayload for metadata.
+
+        Returns:
+          MeshPayload.
+        """
+        key = cache_key(metadata)
+        try:
+            payload = self.get(key)
+        except sqlite3.Error as error:
+            # The store only saves time, inject without it.
+            print ("Warning, mesh cache", self.path, "failed:", error)
+            payload = None
+        if payload is None:
+            payload = create()
+            try:
+                self.put(key, payload)
+            except sqlite3.Error as error:
+                print ("Warning, mesh cache", self.path, "failed:", error)
+        return payload
+
+    def _remember(self, key, payload):
+        """Keeps payload in memory, dropping the least recently used."""
+        self.memory[key] = payload
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self):
+        """Deletes least recently used payloads beyond the size bound."""
+        total = self.connection.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM payloads").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = list()
+        for key, size in self.connection.execute(
+                "SELECT key, bytes FROM payloads ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            expired.append((key,))
+            total -= size
+        self.connection.executemany(
+            "DELETE FROM payloads WHERE key = ?", expired)
+
+    def clear(self):
+        """Removes all cached payloads."""
+        with self.lock:
+            self.memory.clear()
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute("DELETE FROM payloads")
+
+    def __len__(self):
+        with self.lock:
+            if self.connection is None:
+                return len(self.memory)
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM payloads").fetchone()[0]
+
+
+def open_cache(path=None):
+    """Returns the cache of this process for a store.
+
+    Args:
+      path: string or None, path of the SQLite store, None for the cache
+          kept in memory only.
+
+    Returns:
+      MeshCache. A store that cannot be opened is reported and replaced by
+      the in memory cache.
+    """
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            try:
+                cache = MeshCache(path)
+            except sqlite3.Error as error:
+                print ("Warning, cannot open mesh cache", path, error)
+                cache = _caches.get(None) or MeshCache()
+                _caches[None] = cache
+            _caches[path] = cache
+        return cache
@@ -29,6 +29,12 @@ import zlib
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
 from spatialmedia.mpeg import mesh
+from spatialmedia.mpeg import mesh_cache
+from spatialmedia.mpeg import schema
+
+# Largest decompressed mesh payload accepted. Generated meshes are a few
+# hundred kB, this stops deflate bombs.
+MAX_MESH_DATA_SIZE = 16 * 1024 * 1024
 
 
 def load(fh, position=None, end=None):
@@ -47,8 +53,8 @@ def load(fh, position=None, end=None):
     fh.seek(position)
     new_box = mshpBox()
     new_box.position = position
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4).decode('latin1')
+    size, name = schema.HEADER.unpack(fh.read(schema.HEADER.size))
+    name = name.decode('latin1')
 
     if (name != 'ytmp' and name != 'mshp'):
         print ("Error: box is not an mesh projection box. " + name)
@@ -58,23 +64,47 @@ def load(fh, position=None, end=None):
         print ("Error: mesh projection box size exceeds bounds.")
         return None
 
-    tmp = struct.unpack(">I", fh.read(4))[0]
-    crc32 = struct.unpack(">I", fh.read(4))[0]
-    encoding = fh.read(4).decode('latin1')
+    data = fh.read(max(0, size - schema.HEADER.size))
+    if len(data) < schema.MSHP.size:
+        print ("Error: mesh projection box is truncated.")
+        return None
+    _, new_box.crc32, encoding = schema.MSHP.unpack_from(data)
+    new_box.name = name
+    new_box.encoding = encoding
+    new_box.contents = data[schema.MSHP.size:]
+    new_box.content_size = len(new_box.contents) + 4
+    encoding = encoding.decode('latin1')
 
     if encoding == 'dfl8':
-         mesh_data = zlib.decompress(fh.read(size - 16), -15)
+         decompressor = zlib.decompressobj(-15)
+         try:
+             mesh_data = decompressor.decompress(new_box.contents,
+                                                 MAX_MESH_DATA_SIZE)
+         except zlib.error as error:
+             print ("Error: invalid mesh projection data,", error)
+             return None
+         if decompressor.unconsumed_tail:
+             print ("Error: mesh projection data is larger than",
+                    MAX_MESH_DATA_SIZE, "bytes.")
+             return None
     elif encoding == 'raw ':
-         mesh_data = fh.read(size - 16)
+         mesh_data = new_box.contents
+    else:
+         print ("Error: unknown mesh encoding " + encoding)
+         return None
 
     new_box.meshbox = mesh.meshBox()
 
     meshfh = io.BytesIO(mesh_data)
     meshbox = mesh.load(meshfh, 0,  len(mesh_data))
+    if meshbox is None:
+        return None
     new_box.meshes.append(meshbox)
 
     if meshbox.content_size < len(mesh_data):
         meshbox = mesh.load(meshfh, meshfh.tell(), len(mesh_data))
+        if meshbox is None:
+            return None
         new_box.meshes.append(meshbox)
 
     new_box.meshbox.meshes = len (new_box.meshes)
@@ -83,6 +113,8 @@ def load(fh, position=None, end=None):
 
 
 class mshpBox(box.Box):
+    __slots__ = ("meshes", "crc32", "projection", "meshbox", "encoding")
+
     def __init__(self):
         box.Box.__init__(self)
         self.name = 'mshp'
@@ -100,16 +132,35 @@ class mshpBox(box.Box):
         """
     @staticmethod
     def create(metadata):
+        """Creates the box, reusing the payload of a box created before
+        from the same mesh parameters, see mesh_cache."""
         new_box = mshpBox()
         new_box.projection = metadata.spherical
-        new_box.meshbox = mesh.meshBox.create(metadata);
-        new_box.encoding = b'dfl8';
-        compobj = zlib.compressobj(9, zlib.DEFLATED, -15)
-        new_box.contents = compobj.compress(new_box.meshbox.contents) + compobj.flush(zlib.Z_FINISH)
+        cache = mesh_cache.open_cache(metadata.mesh_cache)
+        payload = cache.get_or_create(
+            metadata, lambda: mshpBox.create_payload(metadata))
+        new_box.meshbox = mesh.meshBox()
+        new_box.meshbox.projection = metadata.spherical
+        new_box.meshbox.meshes = payload.meshes
+        new_box.encoding = payload.encoding
+        new_box.contents = payload.contents
+        new_box.crc32 = payload.crc32
         new_box.content_size = len(new_box.contents) + 4
 
         return new_box
 
+    @staticmethod
+    def create_payload(metadata):
+        """Generates and deflates the meshes for metadata.
+
+        Returns:
+          mesh_cache.MeshPayload.
+        """
+        meshbox = mesh.meshBox.create(metadata)
+        compobj = zlib.compressobj(9, zlib.DEFLATED, -15)
+        contents = compobj.compress(meshbox.contents) + compobj.flush(zlib.Z_FINISH)
+        return mesh_cache.MeshPayload(b'dfl8', contents, meshbox.meshes)
+
     def print_box(self, console):
         """ Prints the contents of this spherical (mshp) box to the
             console.
@@ -121,18 +172,20 @@ class mshpBox(box.Box):
         """ Outputs a concise single line audio metadata string. """
         return "Mesh Projection: " + self.meshbox.get_metadata_string();
 
+    def serialize(self):
+        """Returns the whole box as bytes."""
+        self.crc32 = mesh_cache.payload_crc32(self.encoding, self.contents)
+        return (schema.pack_header(self.name, self.size()) +
+                schema.MSHP.pack((0, self.crc32, self.encoding)) +
+                self.contents)
+
     def save(self, in_fh, out_fh, delta):
         
         """
              just write in a standard projection with oredefined meshes for now
         """
         
-        out_fh.write(struct.pack(">I", self.content_size + self.header_size))
-        out_fh.write(self.name.encode('latin1'))
-        out_fh.write(struct.pack(">I", 0))               # version+flags
-        out_fh.write(struct.pack(">I", zlib.crc32(self.encoding +  self.contents)& 0xffffffff))
-        out_fh.write(self.encoding)
-        out_fh.write(self.contents)
+        out_fh.write(self.serialize())
 
         """
             something like this for future use
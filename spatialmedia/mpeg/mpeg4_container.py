@@ -20,36 +20,171 @@
 Functions for loading MP4/MOV files and manipulating boxes.
 """
 
+import io
+import os
+import struct
+
 from spatialmedia.mpeg import box
+from spatialmedia.mpeg import box_index
+from spatialmedia.mpeg import bufferio
 from spatialmedia.mpeg import constants
 from spatialmedia.mpeg import container
+from spatialmedia.mpeg import parse_limits
+from spatialmedia.mpeg import track
+from spatialmedia.mpeg import transfer
+
+FREE_SPACE_TAGS = frozenset([constants.TAG_FREE, constants.TAG_SKIP])
+
+# Journal of an in place update: magic, position and size of the saved
+# bytes and the file size before the update, followed by the bytes.
+JOURNAL_HEADER = struct.Struct(">4sQQQ")
+JOURNAL_MAGIC = b"smj1"
+
+
+def write_journal(fh, path, position, end):
+    """Saves the bytes of a file that an in place update overwrites.
+
+    The journal is complete once it exists under path: it is written to a
+    temporary file, synced and renamed.
+
+    Args:
+      fh: file handle, file about to be updated.
+      path: string, path of the journal.
+      position: int, first byte that is overwritten.
+      end: int, end of the bytes that are overwritten.
+    """
+    fh.seek(0, 2)
+    file_size = fh.tell()
+    fh.seek(position)
+    data = fh.read(end - position)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as journal_fh:
+        journal_fh.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, position,
+                                             len(data), file_size))
+        journal_fh.write(data)
+        journal_fh.flush()
+        os.fsync(journal_fh.fileno())
+    os.replace(temp_path, path)
+    sync_directory(path)
+
+
+def restore_journal(fh, path):
+    """Undoes an interrupted in place update recorded by write_journal.
+
+    Args:
+      fh: file handle, updated file opened for reading and writing.
+      path: string, path of the journal, removed once restored.
+
+    Returns:
+      Bool, False if the journal is not valid and was left in place.
+    """
+    with open(path, "rb") as journal_fh:
+        header = journal_fh.read(JOURNAL_HEADER.size)
+        data = journal_fh.read()
+    if len(header) < JOURNAL_HEADER.size:
+        print ("Error, invalid journal", path)
+        return False
+    magic, position, size, file_size = JOURNAL_HEADER.unpack(header)
+    if magic != JOURNAL_MAGIC or len(data) != size:
+        print ("Error, invalid journal", path)
+        return False
+    fh.seek(position)
+    fh.write(data)
+    fh.truncate(file_size)
+    fh.flush()
+    os.fsync(fh.fileno())
+    os.remove(path)
+    return True
+
 
+def sync_directory(path):
+    """Makes a rename or removal of path durable, where supported."""
+    try:
+        directory = os.open(os.path.dirname(os.path.abspath(path)),
+                            os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory)
+    except OSError:
+        # Directories cannot be synced on Windows.
+        pass
+    finally:
+        os.close(directory)
 
-def load(fh):
+
+def load(fh, limits=None):
     """Load the mpeg4 file structure of a file.
 
+    Without limits the contents of containers are parsed when they are
+    first accessed. With limits, for untrusted files, the ftyp box is
+    checked before anything else is read and the whole box tree is parsed
+    up front within the limits.
+
     Args:
-      fh: file handle, input file handle.
-      position: int, current file position.
-      size: int, maximum size. This is used to ensure correct box sizes.
+      fh: file handle, input file handle. This can also be a reader over a
+          memory mapped file from bufferio.MappedFile.reader().
+      limits: parse_limits.ParseLimits or None, bounds on the parsing work.
 
     return:
-      mpeg4, the loaded mpeg4 structure.
+      mpeg4, the loaded mpeg4 structure, or None if it failed to load
+      without limits.
+
+    Raises:
+      parse_limits.ParseError: the file was rejected, only with limits.
     """
+    budget = None
+    if limits is not None:
+        parse_limits.check_file_type(fh, limits)
+        budget = limits.budget()
 
     fh.seek(0, 2)
     size = fh.tell()
-    contents = container.load_multiple(fh, 0, size)
+    contents = list()
+    readers = dict()
+    position = 0
+    while position < size:
+        element = container.load(fh, position, size, budget)
+        if element is None:
+            if budget is not None:
+                raise parse_limits.ParseError(
+                    parse_limits.INVALID_BOX, "Failed to load box", position)
+            print ("Error, failed to load box.")
+            print ("Error, failed to load .mp4 file.")
+            return None
 
-    if not contents:
-        print ("Error, failed to load .mp4 file.")
-        return None
-    elif len(contents) == 0:
+        # Top level containers (moov) are read with a single read, or sliced
+        # when fh is already in memory, and their children are parsed from
+        # memory.
+        if isinstance(element, container.Container):
+            if budget is not None:
+                budget.count_bytes(element.content_size, element)
+            if isinstance(fh, bufferio.BufferReader):
+                data = fh.view(element.content_start(), element.content_size)
+            else:
+                fh.seek(element.content_start())
+                data = fh.read(element.content_size)
+            reader = bufferio.BufferReader(data, element.content_start())
+            element.defer_contents(
+                reader, element.content_start() + element.padding,
+                element.position + element.size())
+            readers[element.name] = reader
+
+        if budget is not None:
+            budget.count_box(element)
+        contents.append(element)
+        position = element.position + element.size()
+
+    if len(contents) == 0:
+        if budget is not None:
+            raise parse_limits.ParseError(parse_limits.MISSING_BOX,
+                                          "No boxes found")
         print ("Error, no boxes found.")
         return None
 
     loaded_mpeg4 = Mpeg4Container()
     loaded_mpeg4.contents = contents
+    loaded_mpeg4.moov_reader = readers.get(constants.TAG_MOOV)
 
     for element in loaded_mpeg4.contents:
         if (element.name == "moov"):
@@ -62,13 +197,18 @@ def load(fh):
         if (element.name == "ftyp"):
             loaded_mpeg4.ftyp_box = element
 
-    if not loaded_mpeg4.moov_box:
-        print ("Error, file does not contain moov box.")
-        return None
+    for tag, element in ((constants.TAG_MOOV, loaded_mpeg4.moov_box),
+                         (constants.TAG_MDAT, loaded_mpeg4.first_mdat_box)):
+        if element is None:
+            if budget is not None:
+                raise parse_limits.ParseError(
+                    parse_limits.MISSING_BOX,
+                    "File does not contain %s box" % tag)
+            print ("Error, file does not contain %s box." % tag)
+            return None
 
-    if not loaded_mpeg4.first_mdat_box:
-        print ("Error, file does not contain mdat box.")
-        return None
+    if budget is not None:
+        container.load_tree(loaded_mpeg4, budget)
 
     loaded_mpeg4.first_mdat_position = \
         loaded_mpeg4.first_mdat_box.position
@@ -85,7 +225,12 @@ def load(fh):
 class Mpeg4Container(container.Container):
     """Specialized behaviour for the root mpeg4 container."""
 
+    __slots__ = ("moov_box", "free_box", "first_mdat_box", "ftyp_box",
+                 "first_mdat_position", "moov_reader", "_tracks", "_index")
+
     def __init__(self):
+        self.parent = None
+        self._dirty = True
         self.contents = list()
         self.content_size = 0
         self.header_size = 0
@@ -94,13 +239,65 @@ class Mpeg4Container(container.Container):
         self.first_mdat_box = None
         self.ftyp_box = None
         self.first_mdat_position = None
+        self.moov_reader = None
+        self._tracks = None
         self.padding = 0
+        self._index = None
 
     def merge(self, element):
         """Mpeg4 containers do not support merging."""
         print ("Cannot merge mpeg4 files")
         exit(0)
 
+    @property
+    def tracks(self):
+        """List of track.Track, one per trak box in moov.
+
+        The tracks are indexed on first access, loading only the boxes on
+        the path to the sample descriptions of each track.
+        """
+        if self._tracks is None:
+            if self.moov_box is None:
+                return list()
+            self._tracks = track.index_tracks(self.moov_box,
+                                              self.moov_source(None))
+        return self._tracks
+
+    def box_index(self):
+        """Returns the index of all boxes by tag and path.
+
+        The index is built on first use, loading all deferred contents, and
+        kept up to date by add, remove and replace of the containers in the
+        file.
+        """
+        if self._index is None:
+            self._index = box_index.BoxIndex(self)
+        return self._index
+
+    def find_all(self, query):
+        """Returns all boxes matching a tag or path query.
+
+        Args:
+          query: string, a tag like "sv3d" or a path from the top level like
+              "moov/trak/mdia/minf/stbl/stsd/*", see box_index.
+
+        Returns:
+          List of boxes.
+        """
+        return self.box_index().find_all(query)
+
+    def find(self, query):
+        """Returns the first box matching a tag or path query, or None."""
+        return self.box_index().find(query)
+
+    def box_added(self, element):
+        if self._index is not None:
+            self._index.add(element)
+
+    def box_removed(self, element):
+        if self._index is not None:
+            self._index.remove(element)
+
     def print_structure(self):
         """Print mpeg4 file structure recursively."""
         print ("mpeg4 [", self.content_size, "]")
@@ -113,14 +310,19 @@ class Mpeg4Container(container.Container):
 
             self.contents[i].print_structure(next_indent)
 
-    def save(self, in_fh, out_fh):
+    def save(self, in_fh, out_fh, copy_options=None):
         """Save mpeg4 filecontent to file.
 
         Args:
           in_fh: file handle, source file handle for uncached contents.
           out_fh: file handle, destination file hand for saved file.
+          copy_options: transfer.CopyOptions, settings for copying mdat and
+              other large boxes, or None for the defaults.
         """
         self.resize()
+        # One set of copy buffers is shared by all boxes of the file.
+        if copy_options is None:
+            copy_options = transfer.CopyOptions()
         
         """
             reorder to put the mdat element at the end
@@ -145,13 +347,163 @@ class Mpeg4Container(container.Container):
 
         self.contents.insert(1, self.contents.pop(mdat_index))
 
+        # Chunk offsets that no longer fit in 32 bits after the shift need a
+        # co64 box. Converting grows moov, which increases the shift, so
+        # repeat until no more boxes need converting.
+        delta = self.mdat_delta()
+        while self.promote_stco_boxes(in_fh, delta):
+            self.resize()
+            delta = self.mdat_delta()
+
+        for element in self.contents:
+            if element is self.moov_box:
+                element.save(self.moov_source(in_fh), out_fh, delta)
+            elif type(element) is box.Box and element.contents is None:
+                # Top level leaves hold the media data.
+                element.save_header(out_fh)
+                in_fh.seek(element.content_start())
+                transfer.copy(in_fh, out_fh, element.content_size,
+                              copy_options)
+            else:
+                element.save(in_fh, out_fh, delta)
+
+    def moov_source(self, in_fh):
+        """Returns the handle to read moov contents from.
+
+        This is the in-memory copy of moov read by load(), or in_fh for
+        containers that were built some other way.
+        """
+        if self.moov_reader:
+            return self.moov_reader
+        return in_fh
+
+    def mdat_delta(self):
+        """Returns the shift of the first mdat box's data in the saved file."""
         new_position = 0
         for element in self.contents:
             if element.name == constants.TAG_MDAT:
                 new_position += element.header_size
                 break
             new_position += element.size()
-        delta = new_position - self.first_mdat_position
+        return new_position - self.first_mdat_position
 
-        for element in self.contents:
-            element.save(in_fh, out_fh, delta)
+    def promote_stco_boxes(self, in_fh, delta):
+        """Converts stco boxes into co64 boxes where an entry moved by delta
+        exceeds 32 bits.
+
+        Args:
+          in_fh: file handle, source file handle for uncached contents.
+          delta: int, offset change for index entries.
+
+        Returns:
+          Bool, True if any box was converted.
+        """
+        # Chunk offsets point into the file, nothing can overflow unless the
+        # end of the file does.
+        in_fh.seek(0, 2)
+        if in_fh.tell() + delta <= 0xFFFFFFFF:
+            return False
+
+        moov_fh = self.moov_source(in_fh)
+        promoted = False
+        for element in self.find_all(constants.TAG_STCO):
+            if not box_index.box_path(element).startswith(
+                    constants.TAG_MOOV + "/"):
+                continue
+            header, entries, trailer = box.read_index(moov_fh, element, 4)
+            if entries and max(entries) + delta > 0xFFFFFFFF:
+                # The box is renamed, index it under its new tag.
+                self.box_removed(element)
+                box.stco_to_co64(moov_fh, element)
+                self.box_added(element)
+                promoted = True
+        return promoted
+
+    def save_in_place(self, fh, journal=None):
+        """Rewrites the moov box of the file the container was loaded from.
+
+        The new moov box is written over the old moov box and any free/skip
+        boxes directly before or after it. Space left over in that region is
+        turned into a free box. When the region runs to the end of the file
+        (moov stored after mdat) and the new moov box does not fit, the file
+        is truncated at the old moov position and the new moov box appended.
+        Media data is not moved, so chunk offsets are kept as they are. The
+        container must be reloaded before it is saved again.
+
+        The update is not atomic. With a journal, the overwritten bytes are
+        saved first and restore_journal undoes an update that was
+        interrupted; the journal is removed once the file is synced.
+
+        Args:
+          fh: file handle, file opened for reading and writing.
+          journal: string or None, path to save the overwritten bytes to.
+
+        Returns:
+          Bool, True if the file was updated, False if the new moov box does
+          not fit and the file has to be rewritten with save().
+        """
+        self.resize()
+
+        first = self.contents.index(self.moov_box)
+        while (first > 0 and
+               self.contents[first - 1].name in FREE_SPACE_TAGS):
+            first -= 1
+        last = self.contents.index(self.moov_box)
+        while (last + 1 < len(self.contents) and
+               self.contents[last + 1].name in FREE_SPACE_TAGS):
+            last += 1
+        at_tail = last + 1 == len(self.contents)
+
+        region_start = self.contents[first].position
+        if at_tail:
+            fh.seek(0, 2)
+            region_end = fh.tell()
+        else:
+            region_end = self.contents[last + 1].position
+
+        free_size = region_end - region_start - self.moov_box.size()
+        fits = free_size == 0 or 8 <= free_size <= 0xFFFFFFFF
+        if not fits and not at_tail:
+            return False
+
+        # Render the moov box first, its uncached contents are read from
+        # the region that is about to be overwritten.
+        moov_fh = io.BytesIO()
+        self.moov_box.save(self.moov_source(fh), moov_fh, 0)
+        free_box = None
+        if fits and free_size > 0:
+            free_box = box.Box()
+            free_box.name = constants.TAG_FREE
+            free_box.position = region_start + self.moov_box.size()
+            free_box.header_size = 8
+            free_box.content_size = free_size - free_box.header_size
+            moov_fh.write(struct.pack(">I", free_size))
+            moov_fh.write(free_box.name.encode('latin1'))
+
+        if journal is not None:
+            write_journal(fh, journal, region_start, region_end)
+        fh.seek(region_start)
+        fh.write(moov_fh.getvalue())
+        if not fits:
+            fh.truncate(region_start + self.moov_box.size())
+        fh.flush()
+        if journal is not None:
+            os.fsync(fh.fileno())
+            os.remove(journal)
+            sync_directory(journal)
+
+        self.moov_box.position = region_start
+        for element in self.contents[first:last + 1]:
+            if element is not self.moov_box:
+                self.box_removed(element)
+                element.parent = None
+        self.contents[first:last + 1] = [self.moov_box]
+        if free_box:
+            free_box.parent = self
+            self.contents.insert(first + 1, free_box)
+            self.box_added(free_box)
+            self.free_box = free_box
+        elif self.free_box not in self.contents:
+            self.free_box = None
+        self.mark_dirty()
+        return True
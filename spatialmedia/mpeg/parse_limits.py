@@ -0,0 +1,218 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Limits on the cost of parsing untrusted files.
+
+Loading with limits checks the ftyp box before anything else is read, then
+parses the whole box tree up front and stops with a ParseError as soon as
+a limit is exceeded:
+
+    try:
+        mpeg4 = mpeg.load(fh, parse_limits.ParseLimits(max_seconds=5))
+    except parse_limits.ParseError as error:
+        reject(error.reason, error.position)
+"""
+
+import struct
+import time
+
+from spatialmedia.mpeg import box_index
+
+NOT_MPEG4 = "not_mpeg4"
+UNSUPPORTED_BRAND = "unsupported_brand"
+INVALID_BOX = "invalid_box"
+MISSING_BOX = "missing_box"
+TOO_MANY_BOXES = "too_many_boxes"
+TOO_DEEP = "too_deep"
+TOO_MANY_BYTES = "too_many_bytes"
+TIMEOUT = "timeout"
+
+DEFAULT_MAX_BOXES = 200000
+DEFAULT_MAX_DEPTH = 32
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_SECONDS = 30.0
+
+# Largest ftyp box accepted, room for a few hundred compatible brands.
+MAX_FTYP_SIZE = 4096
+
+# Major and compatible brands of MP4 and MOV files.
+KNOWN_BRANDS = frozenset([
+    "3g2a", "3gp4", "3gp5", "3gp6", "avc1", "av01", "dash", "f4v ", "hev1",
+    "hvc1", "iso2", "iso3", "iso4", "iso5", "iso6", "iso7", "iso8", "iso9",
+    "isom", "M4A ", "M4V ", "M4VH", "M4VP", "mp41", "mp42", "mp71", "MSNV",
+    "NDAS", "qt  ", "XAVC",
+    ])
+
+# Boxes a QuickTime file without a ftyp box can start with.
+QUICKTIME_START_TAGS = frozenset(["free", "mdat", "moov", "pnot", "skip",
+                                  "wide"])
+
+
+class ParseError(Exception):
+    """A file was rejected while it was parsed.
+
+    Attributes:
+      reason: string, machine readable cause, one of the constants above.
+      message: string, description of the error.
+      position: int or None, file position of the box at fault.
+      path: string or None, path of the box at fault, see box_index.
+    """
+
+    def __init__(self, reason, message, position=None, path=None):
+        Exception.__init__(self, message)
+        self.reason = reason
+        self.message = message
+        self.position = position
+        self.path = path
+
+    def __str__(self):
+        if self.path:
+            return "%s (%s at %d)" % (self.message, self.path, self.position)
+        if self.position is not None:
+            return "%s (at %d)" % (self.message, self.position)
+        return self.message
+
+    def to_dict(self):
+        """Returns the error as a dict of JSON types."""
+        return {"reason": self.reason, "message": self.message,
+                "position": self.position, "path": self.path}
+
+
+class ParseLimits(object):
+    """Bounds on the work done parsing one file.
+
+    Attributes:
+      max_boxes: int, number of boxes in the file.
+      max_depth: int, nesting depth of boxes, top level boxes are at 1.
+      max_bytes: int, bytes read from the file into memory for parsing.
+      max_seconds: float or None, wall time spent parsing.
+      brands: set of strings or None, a ftyp box must list one of these as
+          its major or a compatible brand, None accepts any brand.
+      require_ftyp: bool, reject files not starting with a ftyp box.
+          Older QuickTime files have none.
+    """
+
+    def __init__(self, max_boxes=DEFAULT_MAX_BOXES,
+                 max_depth=DEFAULT_MAX_DEPTH, max_bytes=DEFAULT_MAX_BYTES,
+                 max_seconds=DEFAULT_MAX_SECONDS, brands=KNOWN_BRANDS,
+                 require_ftyp=False):
+        self.max_boxes = max_boxes
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.brands = brands
+        self.require_ftyp = require_ftyp
+
+    def budget(self):
+        """Returns a new ParseBudget for parsing one file."""
+        return ParseBudget(self)
+
+
+class ParseBudget(object):
+    """Work done so far parsing one file, checked against ParseLimits."""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.boxes = 0
+        self.bytes = 0
+        self.deadline = None
+        if limits.max_seconds is not None:
+            self.deadline = time.monotonic() + limits.max_seconds
+
+    def count_box(self, element):
+        """Counts a loaded box and checks the box and time limits."""
+        self.boxes += 1
+        if self.boxes > self.limits.max_boxes:
+            raise error_at(TOO_MANY_BOXES, "More than %d boxes" %
+                           self.limits.max_boxes, element)
+        self.check_time(element)
+
+    def count_bytes(self, size, element):
+        """Counts size bytes about to be read for element."""
+        self.bytes += size
+        if self.bytes > self.limits.max_bytes:
+            raise error_at(TOO_MANY_BYTES, "More than %d bytes to parse" %
+                           self.limits.max_bytes, element)
+
+    def check_depth(self, depth, element):
+        """Checks that boxes inside element, at depth, are allowed."""
+        if depth > self.limits.max_depth:
+            raise error_at(TOO_DEEP, "Boxes nested deeper than %d" %
+                           self.limits.max_depth, element)
+
+    def reject_invalid(self, element):
+        """Raises the error for a container whose contents failed to load."""
+        raise error_at(INVALID_BOX, "Invalid box inside %s" % element.name,
+                       element)
+
+    def check_time(self, element=None):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise error_at(TIMEOUT, "Parsing took longer than %g seconds" %
+                           self.limits.max_seconds, element)
+
+
+def error_at(reason, message, element=None):
+    """Returns a ParseError located at element."""
+    if element is None:
+        return ParseError(reason, message)
+    return ParseError(reason, message, element.position,
+                      box_index.box_path(element) or element.name)
+
+
+def check_file_type(fh, limits):
+    """Rejects files that are not MP4/MOV files from their first box.
+
+    Args:
+      fh: file handle, file to check.
+      limits: ParseLimits, accepted brands.
+
+    Returns:
+      String, the major brand, or None for a QuickTime file without ftyp.
+
+    Raises:
+      ParseError: the file is not a supported MP4/MOV file.
+    """
+    fh.seek(0)
+    header = fh.read(8)
+    if len(header) < 8:
+        raise ParseError(NOT_MPEG4, "File is too short", 0)
+    size, name = struct.unpack(">I4s", header)
+    name = name.decode("latin1")
+
+    if name != "ftyp":
+        if limits.require_ftyp or name not in QUICKTIME_START_TAGS:
+            raise ParseError(NOT_MPEG4, "File does not start with a ftyp "
+                             "box", 0)
+        return None
+
+    if size < 16 or size > MAX_FTYP_SIZE:
+        raise ParseError(INVALID_BOX, "Invalid ftyp size %d" % size, 0,
+                         "ftyp")
+    data = fh.read(size - 8)
+    if len(data) < size - 8:
+        raise ParseError(INVALID_BOX, "Truncated ftyp box", 0, "ftyp")
+    major_brand = data[0:4].decode("latin1")
+    if limits.brands is None:
+        return major_brand
+
+    brands = [major_brand]
+    for offset in range(8, len(data) - 3, 4):
+        brands.append(data[offset:offset + 4].decode("latin1"))
+    if limits.brands.isdisjoint(brands):
+        raise ParseError(UNSUPPORTED_BRAND, "Unsupported brand %r" %
+                         major_brand, 0, "ftyp")
+    return major_brand
@@ -25,6 +25,7 @@ import struct
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import schema
 
 
 def load(fh, position=None, end=None):
@@ -43,29 +44,34 @@ def load(fh, position=None, end=None):
     fh.seek(position)
     new_box = SA3DBox()
     new_box.position = position
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4).decode('latin1')
+    size, name = schema.HEADER.unpack(fh.read(schema.HEADER.size))
+    name = name.decode('latin1')
 
     if (name != constants.TAG_SA3D):
         print ("Error: box is not an SA3D box.")
         return None
 
+    if size < new_box.header_size:
+        print ("Error, invalid size", size, "in", name, "at", position)
+        return None
+
     if (position + size > end):
         print ("Error: SA3D box size exceeds bounds.")
         return None
 
     new_box.content_size = size - new_box.header_size
-    new_box.version = struct.unpack(">B", fh.read(1))[0]
-    new_box.ambisonic_type = struct.unpack(">B", fh.read(1))[0]
-    new_box.head_locked_stereo = (new_box.ambisonic_type & int('10000000', 2) != 0)
-    new_box.ambisonic_type = new_box.ambisonic_type & int('01111111', 2)
-    new_box.ambisonic_order = struct.unpack(">I", fh.read(4))[0]
-    new_box.ambisonic_channel_ordering = struct.unpack(">B", fh.read(1))[0]
-    new_box.ambisonic_normalization = struct.unpack(">B", fh.read(1))[0]
-    new_box.num_channels = struct.unpack(">I", fh.read(4))[0]
-    for i in range(0, new_box.num_channels):
-        new_box.channel_map.append(
-            struct.unpack(">I", fh.read(4))[0])
+    data = fh.read(new_box.content_size)
+    try:
+        (new_box.version, ambisonic_type, new_box.ambisonic_order,
+         new_box.ambisonic_channel_ordering, new_box.ambisonic_normalization,
+         new_box.num_channels) = schema.SA3D.unpack_from(data)
+        new_box.channel_map = schema.SA3D.unpack_tail(
+            data, schema.SA3D.size, new_box.num_channels)
+    except struct.error:
+        print ("Error: SA3D box is truncated.")
+        return None
+    new_box.head_locked_stereo = (ambisonic_type & int('10000000', 2) != 0)
+    new_box.ambisonic_type = ambisonic_type & int('01111111', 2)
     return new_box
 
 
@@ -74,6 +80,10 @@ class SA3DBox(box.Box):
     ambisonic_orderings = {'ACN': 0}
     ambisonic_normalizations = {'SN3D': 0}
 
+    __slots__ = ("version", "ambisonic_type", "head_locked_stereo",
+                 "ambisonic_order", "ambisonic_channel_ordering",
+                 "ambisonic_normalization", "num_channels", "channel_map")
+
     def __init__(self):
         box.Box.__init__(self)
         self.name = constants.TAG_SA3D
@@ -153,25 +163,19 @@ class SA3DBox(box.Box):
                str(self.channel_map))
         return metadata
 
-    def save(self, in_fh, out_fh, delta):
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name.encode('latin1'))
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name.encode('latin1'))
-
+    def serialize(self):
+        """Returns the whole box as bytes."""
         ambisonic_type = (
             self.ambisonic_type | int('10000000', 2) if
             self.head_locked_stereo else self.ambisonic_type & int('01111111', 2))
 
-        out_fh.write(struct.pack(">B", self.version))
-        out_fh.write(struct.pack(">B", ambisonic_type))
-        out_fh.write(struct.pack(">I", self.ambisonic_order))
-        out_fh.write(struct.pack(">B", self.ambisonic_channel_ordering))
-        out_fh.write(struct.pack(">B", self.ambisonic_normalization))
-        out_fh.write(struct.pack(">I", self.num_channels))
-        for i in self.channel_map:
-            if (i != None):
-                out_fh.write(struct.pack(">I", int(i)))
+        data = schema.SA3D.pack(
+            (self.version, ambisonic_type, self.ambisonic_order,
+             self.ambisonic_channel_ordering, self.ambisonic_normalization,
+             self.num_channels),
+            [int(i) for i in self.channel_map if i is not None])
+        return schema.pack_header(self.name, self.size(),
+                                  self.header_size) + data
+
+    def save(self, in_fh, out_fh, delta):
+        out_fh.write(self.serialize())
@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG box field layouts.
+
+The fields stored after the header of each box type are declared once and
+compiled into a struct.Struct. Boxes are parsed with one unpack_from over
+their contents and serialized into one bytes object:
+
+    version, stereo_mode = schema.ST3D.unpack_from(data)
+    out_fh.write(schema.ST3D.pack_box((version, stereo_mode)))
+"""
+
+import struct
+
+HEADER = struct.Struct(">I4s")
+LARGE_HEADER = struct.Struct(">I4sQ")
+
+# Box schemas by box name.
+REGISTRY = dict()
+
+
+def pack_header(name, size, header_size=8):
+    """Returns the header of a box.
+
+    Args:
+      name: string, box name.
+      size: int, total size of the box.
+      header_size: int, 16 stores size as a 64 bit largesize, 0 writes no
+          header.
+
+    Returns:
+      Bytes, the box header.
+    """
+    if header_size == 16:
+        return LARGE_HEADER.pack(1, name.encode('latin1'), size)
+    if header_size == 8:
+        return HEADER.pack(size, name.encode('latin1'))
+    return b""
+
+
+class BoxSchema(object):
+    """Layout of the fields of a box type.
+
+    Attributes:
+      name: string, box name.
+      fields: tuple of strings, names of the fixed fields in file order.
+      struct: struct.Struct, compiled layout of the fixed fields.
+      tail: string or None, struct format of each item of the variable
+          length list stored after the fixed fields.
+    """
+
+    def __init__(self, name, fields, tail=None):
+        self.name = name
+        self.fields = tuple(field for field, _ in fields)
+        self.struct = struct.Struct(
+            ">" + "".join(field_format for _, field_format in fields))
+        self.tail = tail
+
+    @property
+    def size(self):
+        """Size in bytes of the fixed fields."""
+        return self.struct.size
+
+    def unpack_from(self, data, offset=0):
+        """Returns the tuple of fixed field values stored at offset."""
+        return self.struct.unpack_from(data, offset)
+
+    def unpack_tail(self, data, offset, count):
+        """Returns the list of count tail items stored at offset."""
+        return list(struct.unpack_from(">%d%s" % (count, self.tail), data,
+                                       offset))
+
+    def pack(self, values, tail=()):
+        """Returns the fixed field values followed by the tail items."""
+        data = self.struct.pack(*values)
+        if tail:
+            data += struct.pack(">%d%s" % (len(tail), self.tail), *tail)
+        return data
+
+    def pack_box(self, values, tail=(), header_size=8):
+        """Returns the whole box, header, fixed fields and tail items."""
+        data = self.pack(values, tail)
+        return pack_header(self.name, header_size + len(data),
+                           header_size) + data
+
+
+def register(name, fields, tail=None):
+    """Compiles and registers the layout of a box type.
+
+    Args:
+      name: string, box name.
+      fields: list of (field name, struct format) pairs in file order.
+      tail: string or None, struct format of each tail item.
+
+    Returns:
+      BoxSchema, the compiled layout.
+    """
+    schema = BoxSchema(name, fields, tail)
+    REGISTRY[name] = schema
+    return schema
+
+
+def get(name):
+    """Returns the BoxSchema registered for name, or None."""
+    return REGISTRY.get(name)
+
+
+SA3D = register("SA3D", [
+    ("version", "B"),
+    ("ambisonic_type", "B"),         # bit 7 is head_locked_stereo
+    ("ambisonic_order", "I"),
+    ("ambisonic_channel_ordering", "B"),
+    ("ambisonic_normalization", "B"),
+    ("num_channels", "I"),
+    ], tail="I")                     # channel map
+
+ST3D = register("st3d", [
+    ("version", "I"),                # version + flags
+    ("stereo_mode", "B"),
+    ])
+
+SVHD = register("svhd", [
+    ("version", "I"),
+    ("metadata_source", "B"),        # empty string
+    ])
+
+PRHD = register("prhd", [
+    ("version", "I"),
+    ("yaw", "I"),                    # 16.16 fixed point
+    ("pitch", "I"),
+    ("roll", "I"),
+    ])
+
+EQUI = register("equi", [
+    ("version", "I"),
+    ("clip_top", "I"),
+    ("clip_bottom", "I"),
+    ("clip_left", "I"),
+    ("clip_right", "I"),
+    ])
+
+CBMP = register("cbmp", [
+    ("version", "I"),
+    ("layout", "I"),
+    ("padding", "I"),
+    ])
+
+MSHP = register("mshp", [
+    ("version", "I"),
+    ("crc32", "I"),
+    ("encoding", "4s"),              # followed by the encoded meshes
+    ])
@@ -25,6 +25,7 @@ import struct
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import schema
 
 
 def load(fh, position=None, end=None):
@@ -43,26 +44,36 @@ def load(fh, position=None, end=None):
     fh.seek(position)
     new_box = st3dBox()
     new_box.position = position
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4).decode('latin1')
+    size, name = schema.HEADER.unpack(fh.read(schema.HEADER.size))
+    name = name.decode('latin1')
 
     if (name != constants.TAG_ST3D):
         print ("Error: box is not an st3d box.")
         return None
 
+    if size < new_box.header_size:
+        print ("Error, invalid size", size, "in", name, "at", position)
+        return None
+
     if (position + size > end):
         print ("Error: st3d box size exceeds bounds.")
         return None
 
     new_box.content_size = size - new_box.header_size
-    new_box.version = struct.unpack(">I", fh.read(4))[0]
-    new_box.stereo_mode = struct.unpack(">B", fh.read(1))[0]
+    try:
+        new_box.version, new_box.stereo_mode = schema.ST3D.unpack_from(
+            fh.read(new_box.content_size))
+    except struct.error:
+        print ("Error: st3d box is truncated.")
+        return None
     return new_box
 
 
 class st3dBox(box.Box):
     stereo_modes = {'none': 0, 'top-bottom': 1, 'left-right': 2, 'custom': 3, 'right-left': 4}
 
+    __slots__ = ("version", "stereo_mode")
+
     def __init__(self):
         box.Box.__init__(self)
         self.name = constants.TAG_ST3D
@@ -97,14 +108,10 @@ class st3dBox(box.Box):
         """ Outputs a concise single line stereo metadata string. """
         return "Stereo mode: %s" % (self.stereo_mode_name())
 
+    def serialize(self):
+        """Returns the whole box as bytes."""
+        return schema.pack_header(self.name, self.size(), self.header_size) + \
+            schema.ST3D.pack((self.version, self.stereo_mode))
+
     def save(self, in_fh, out_fh, delta):
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name.encode('latin1'))
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name.encode('latin1'))
-
-        out_fh.write(struct.pack(">I", self.version))
-        out_fh.write(struct.pack(">B", self.stereo_mode))
+        out_fh.write(self.serialize())
@@ -26,6 +26,7 @@ import struct
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
 from spatialmedia.mpeg import mesh_projection
+from spatialmedia.mpeg import schema
 
 
 def load(fh, position=None, end=None):
@@ -44,53 +45,86 @@ def load(fh, position=None, end=None):
     fh.seek(position)
     new_box = sv3dBox()
     new_box.position = position
-    size = struct.unpack(">I", fh.read(4))[0]
-    name = fh.read(4).decode('latin1')
+    size, name = schema.HEADER.unpack(fh.read(schema.HEADER.size))
+    name = name.decode('latin1')
 
     if (name != constants.TAG_SV3D):
         print ("Error: box is not an sv3d box.")
         return None
 
+    if size < new_box.header_size:
+        print ("Error, invalid size", size, "in", name, "at", position)
+        return None
+
     if (position + size > end):
         print ("Error: sv3d box size exceeds bounds.")
         return None
 
-    size = struct.unpack(">I", fh.read(4))[0]
-    fh.read(size - 4) #svhd
-
-    fh.read(4 + 4) #proj
-    fh.read(4 + 4 + 4) #prhd
-    new_box.yaw = struct.unpack(">I", fh.read(4))[0] / 65536
-    new_box.pitch = struct.unpack(">I", fh.read(4))[0] / 65536
-    new_box.roll = struct.unpack(">I", fh.read(4))[0] / 65536
-
-    projection_position = fh.tell()
-
-    fh.read(4) #size
-    proj = fh.read(4).decode('latin1')
-    if proj == "equi":
-        new_box.projection = "equirectangular"
-        tmp = struct.unpack(">I", fh.read(4))[0]
-        new_box.clip_top = struct.unpack(">I", fh.read(4))[0]
-        new_box.clip_bottom = struct.unpack(">I", fh.read(4))[0]
-        new_box.clip_left_right = struct.unpack(">I", fh.read(4))[0]
-        new_box.clip_right = struct.unpack(">I", fh.read(4))[0]
-    elif proj == "cbmp":
+    new_box.content_size = size - new_box.header_size
+    data = fh.read(new_box.content_size)
+    if len(data) < new_box.content_size:
+        print ("Error: sv3d box is truncated.")
+        return None
+    # Saved back unchanged, svhd and proj can hold more than the boxes
+    # generated by create, e.g. a metadata source string.
+    new_box.raw_contents = data
+
+    proj = None
+    try:
+        svhd_size = schema.HEADER.unpack_from(data)[0]
+        new_box.proj_size, name = schema.HEADER.unpack_from(data, svhd_size)
+        if name != b"proj" or new_box.proj_size < schema.HEADER.size:
+            print ("Error: sv3d box has no proj box.")
+            return None
+        # The proj box holds prhd and the projection box, in any order
+        # and possibly with other boxes.
+        child = svhd_size + schema.HEADER.size
+        proj_end = min(svhd_size + new_box.proj_size, len(data))
+        while child + schema.HEADER.size <= proj_end:
+            child_size, name = schema.HEADER.unpack_from(data, child)
+            name = name.decode('latin1')
+            if child_size < schema.HEADER.size:
+                print ("Error, invalid size", child_size, "in", name, "at",
+                       position + new_box.header_size + child)
+                return None
+            if name == "prhd":
+                _, yaw, pitch, roll = schema.PRHD.unpack_from(
+                    data, child + schema.HEADER.size)
+                new_box.yaw = yaw / 65536
+                new_box.pitch = pitch / 65536
+                new_box.roll = roll / 65536
+            elif name == "equi":
+                new_box.projection = "equirectangular"
+                (_, new_box.clip_top, new_box.clip_bottom,
+                 new_box.clip_left_right, new_box.clip_right) = \
+                    schema.EQUI.unpack_from(data, child + schema.HEADER.size)
+                proj = name
+            elif name in ("cbmp", "ytmp", "mshp"):
+                projection = child
+                proj = name
+            child += child_size
+    except struct.error:
+        print ("Error: sv3d box is truncated.")
+        return None
+
+    if proj == "cbmp":
         new_box.projection = "cubemap"
-    elif proj == "ytmp":
-        new_box.projection = "mesh"
-        new_box.projection_box = mesh_projection.load(fh, projection_position, end)
-    elif proj == "mshp":
+    elif proj == "ytmp" or proj == "mshp":
         new_box.projection = "mesh"
-        new_box.projection_box = mesh_projection.load(fh, projection_position, end)
-    else:
-        print ("Unknown projection type. " + new_box.projection)
+        new_box.projection_box = mesh_projection.load(
+            fh, position + new_box.header_size + projection, end)
+    elif proj != "equi":
+        print ("Unknown projection type.")
         return None
 
     return new_box
 
 
 class sv3dBox(box.Box):
+    __slots__ = ("proj_size", "projection", "yaw", "pitch", "roll",
+                 "clip_left_right", "clip_right", "clip_top", "clip_bottom",
+                 "projection_box", "raw_contents")
+
     def __init__(self):
         box.Box.__init__(self)
         self.name = constants.TAG_SV3D
@@ -106,6 +140,7 @@ class sv3dBox(box.Box):
         self.clip_top = 0;
         self.clip_bottom = 0;
         self.projection_box=None;
+        self.raw_contents = None
 
     @staticmethod
     def create(metadata):
@@ -113,16 +148,8 @@ class sv3dBox(box.Box):
         new_box.header_size = 8
         new_box.name = constants.TAG_SV3D
         new_box.projection = metadata.spherical
-        if new_box.projection == "equirectangular":
-            new_box.content_size = 81 - new_box.header_size
-            new_box.proj_size = 60
-        elif new_box.projection == "cubemap":
-            new_box.content_size = 73 - new_box.header_size
-            new_box.proj_size = 52
         if new_box.projection == "mesh" or new_box.projection == "full-frame" or new_box.projection == "equi-mesh" :
             new_box.projection_box = mesh_projection.mshpBox.create(metadata)
-            new_box.proj_size = new_box.projection_box.content_size + new_box.projection_box.header_size + 8 + 24 # mesh projection, proj and  prhd boxes
-            new_box.content_size = new_box.proj_size + 21 - new_box.header_size  # 21 is size of svhd & proj boxes
         else:
             new_box.projection_box=None;
         new_box.yaw = float(metadata.orientation["yaw"])
@@ -131,6 +158,10 @@ class sv3dBox(box.Box):
         new_box.clip_left_right = metadata.clip_left_right;
         new_box.clip_right = metadata.clip_left_right;
 
+        # Sizes of the generated svhd and proj boxes.
+        new_box.proj_size = len(new_box.serialize_proj())
+        new_box.content_size = schema.SVHD.size + 8 + new_box.proj_size
+
         return new_box
 
     def print_box(self, console):
@@ -147,50 +178,35 @@ class sv3dBox(box.Box):
         """ Outputs a concise single line audio metadata string. """
         return "Spherical mode: %s (%f,%f,%f) (%d,%d,%d,%d)" % (self.projection, self.yaw, self.pitch, self.roll, self.clip_top, self.clip_bottom, self.clip_left_right, self.clip_right)
 
-    def save(self, in_fh, out_fh, delta):
-
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name.encode('latin1'))
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.content_size + self.header_size))
-            out_fh.write(self.name.encode('latin1'))
-
-        #svhd
-        out_fh.write(struct.pack(">I", 13))     # size
-        out_fh.write("svhd".encode('latin1'))           # tag
-        out_fh.write(struct.pack(">I", 0))      # version+flags
-        out_fh.write(struct.pack(">B", 0))      # metadata
-
-        #proj
-        out_fh.write(struct.pack(">I", self.proj_size)) #size
-        out_fh.write("proj".encode('latin1'))                   # proj
-
-        #prhd
-        out_fh.write(struct.pack(">I", 24))     # size
-        out_fh.write("prhd".encode('latin1'))           # tag
-        out_fh.write(struct.pack(">I", 0))      # version+flags
-        out_fh.write(struct.pack(">I", int(self.yaw * 65536)))   # yaw
-        out_fh.write(struct.pack(">I", int(self.pitch * 65536))) # pitch
-        out_fh.write(struct.pack(">I", int(self.roll * 65536)))  # roll
+    def serialize_proj(self):
+        """Returns the generated proj box, prhd followed by the projection
+        box."""
+        data = [schema.PRHD.pack_box((0, int(self.yaw * 65536),
+                                      int(self.pitch * 65536),
+                                      int(self.roll * 65536)))]
 
         #cmbp or equi
         if self.projection == "equirectangular":
-            out_fh.write(struct.pack(">I", 28)) # size
-            out_fh.write("equi".encode('latin1'))       # tag
-            out_fh.write(struct.pack(">I", 0))  # version+flags
-            out_fh.write(struct.pack(">I", 0))
-            out_fh.write(struct.pack(">I", 0))
-            out_fh.write(struct.pack(">I", self.clip_left_right))
-            out_fh.write(struct.pack(">I", self.clip_left_right))
+            data.append(schema.EQUI.pack_box(
+                (0, 0, 0, self.clip_left_right, self.clip_left_right)))
         elif self.projection == "cubemap":
-            out_fh.write(struct.pack(">I", 20)) # size
-            out_fh.write("cbmp".encode('latin1'))       # tag
-            out_fh.write(struct.pack(">I", 0))  # version+flags
-            out_fh.write(struct.pack(">I", 0))  # layout
-            out_fh.write(struct.pack(">I", 0))  # padding
+            data.append(schema.CBMP.pack_box((0, 0, 0)))
         elif self.projection == "mesh" or self.projection == "full-frame" or self.projection == "equi-mesh" :
-            self.projection_box.save(in_fh, out_fh, delta)
+            data.append(self.projection_box.serialize())
+        data = b"".join(data)
+        return schema.pack_header("proj", 8 + len(data)) + data
 
+    def serialize(self):
+        """Returns the whole box as bytes.
 
+        Loaded boxes are returned unchanged, boxes made by create are
+        generated.
+        """
+        header = schema.pack_header(self.name, self.size(), self.header_size)
+        if self.raw_contents is not None:
+            return header + self.raw_contents
+        return (header + schema.SVHD.pack_box((0, 0)) +
+                self.serialize_proj())
+
+    def save(self, in_fh, out_fh, delta):
+        out_fh.write(self.serialize())
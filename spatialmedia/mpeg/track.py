@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG track index.
+
+Index of the tracks of a movie, built once when the file is loaded.
+"""
+
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import container
+
+
+def index_tracks(moov_box, fh):
+    """Builds the index of the tracks in a moov box.
+
+    Args:
+      moov_box: container, moov box of the movie.
+      fh: file handle, source of the uncached box contents.
+
+    Returns:
+      List of Track, one per trak box in file order.
+    """
+    tracks = list()
+    for element in moov_box.contents:
+        if element.name == constants.TAG_TRAK:
+            tracks.append(Track(element, len(tracks), fh))
+    return tracks
+
+
+def read_handler_type(hdlr, fh):
+    """Reads the handler type of a hdlr box.
+
+    Args:
+      hdlr: box, hdlr box.
+      fh: file handle, source of the uncached box contents.
+
+    Returns:
+      String, four character handler type such as "vide" or "soun".
+    """
+    if hdlr.contents:
+        return hdlr.contents[8:12].decode("latin1")
+    fh.seek(hdlr.content_start() + 8)
+    return fh.read(4).decode("latin1")
+
+
+def first_child(element, name):
+    """Returns the first box called name inside element, or None."""
+    if not isinstance(element, container.Container):
+        return None
+    for sub_element in element.contents:
+        if sub_element.name == name:
+            return sub_element
+    return None
+
+
+class Track(object):
+    """A trak box and direct references to the boxes inside it.
+
+    Attributes:
+      trak: container, the trak box.
+      number: int, index of the track in the movie.
+      name: string, name the track is reported under, "Track <number>".
+      handler_type: string, handler type of the media or None.
+      mdia, minf, stbl, stsd: containers on the path to the sample
+          descriptions, or None when missing.
+      sample_entries: list of containers, the sample descriptions in stsd.
+    """
+
+    def __init__(self, trak, number, fh):
+        self.trak = trak
+        self.number = number
+        self.name = "Track %d" % number
+        self.mdia = first_child(trak, constants.TAG_MDIA)
+        hdlr = first_child(self.mdia, constants.TAG_HDLR)
+        self.handler_type = read_handler_type(hdlr, fh) if hdlr else None
+        self.minf = first_child(self.mdia, constants.TAG_MINF)
+        self.stbl = first_child(self.minf, constants.TAG_STBL)
+        self.stsd = first_child(self.stbl, constants.TAG_STSD)
+        self.sample_entries = list(self.stsd.contents) if self.stsd else []
+
+    def is_video(self):
+        return self.handler_type == constants.TAG_VIDE
+
+    def is_audio(self):
+        return self.handler_type == constants.TAG_SOUN
+
+    def video_entries(self):
+        """Returns the video sample descriptions of the track."""
+        return [entry for entry in self.sample_entries
+                if entry.name in constants.VIDEO_SAMPLE_DESCRIPTIONS]
+
+    def audio_entries(self):
+        """Returns the sound sample descriptions of the track."""
+        return [entry for entry in self.sample_entries
+                if entry.name in constants.SOUND_SAMPLE_DESCRIPTIONS]
+
+    def find(self, name):
+        """Returns the first box called name in a sample description."""
+        for entry in self.sample_entries:
+            found = first_child(entry, name)
+            if found is not None:
+                return found
+        return None
+
+    @property
+    def st3d(self):
+        return self.find(constants.TAG_ST3D)
+
+    @property
+    def sv3d(self):
+        return self.find(constants.TAG_SV3D)
+
+    @property
+    def sa3d(self):
+        return self.find(constants.TAG_SA3D)
+
+    def set_sample_entry_box(self, sample_entry, new_box):
+        """Replaces the box named like new_box in a sample description, or
+        appends new_box if there is none.
+
+        Args:
+          sample_entry: container, sample description of this track.
+          new_box: box, box to store.
+        """
+        old_box = None
+        for element in sample_entry.contents:
+            if element.name == new_box.name:
+                old_box = element
+        if old_box is not None:
+            sample_entry.replace(old_box, new_box)
+        else:
+            sample_entry.add(new_box)
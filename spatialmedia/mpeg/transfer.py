@@ -0,0 +1,616 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Copying of box contents between files.
+
+Large boxes such as mdat are copied inside the kernel where possible, or
+through a pipeline of reusable buffers with reading and writing running
+on separate threads. Block sizes follow the preferred I/O size of the
+files and copied pages are dropped from the page cache behind the copy.
+"""
+
+import concurrent.futures
+import errno
+import io
+import os
+import queue
+import stat
+import sys
+import threading
+
+from spatialmedia.mpeg import bufferio
+
+
+# Bounds for block sizes derived from the preferred I/O size of a file.
+MIN_BLOCK_SIZE = 1024 * 1024
+MAX_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Size of the ranges copied concurrently by parallel copies.
+DEFAULT_RANGE_SIZE = 32 * 1024 * 1024
+
+# Written pages can only be dropped from the page cache once they have been
+# written back, so they are advised again for this many blocks.
+WRITE_BEHIND_BLOCKS = 4
+
+
+class CopyCancelled(Exception):
+    """Raised by copies that were cancelled through CopyOptions.cancel."""
+
+
+class BufferPool(object):
+    """Reusable copy buffers.
+
+    Copies take their buffers from the pool and hand them back when done,
+    so copying many boxes allocates the buffers once.
+    """
+
+    def __init__(self):
+        self.buffers = list()
+        self.lock = threading.Lock()
+
+    def get(self, size):
+        """Returns a buffer of at least size bytes."""
+        with self.lock:
+            for index, buffer in enumerate(self.buffers):
+                if len(buffer) >= size:
+                    return self.buffers.pop(index)
+            # Buffers that are too small would never be used again.
+            del self.buffers[:]
+        return bytearray(size)
+
+    def put(self, buffer):
+        """Returns a buffer taken with get() to the pool."""
+        with self.lock:
+            self.buffers.append(buffer)
+
+    def clear(self):
+        """Releases all pooled buffers."""
+        with self.lock:
+            del self.buffers[:]
+
+
+class CopyOptions(object):
+    """Settings for copying box contents.
+
+    Attributes:
+      buffer_count: int, number of buffers in flight between the reading
+          and the writing thread. 1 disables the pipeline.
+      buffer_size: int, size in bytes of each buffer, or None to derive it
+          from the preferred I/O size of the files.
+      kernel_copy: bool, copy inside the kernel where the platform and the
+          file handles allow it.
+      drop_cache: bool, advise the kernel that the data is read sequentially
+          and drop copied pages from the page cache.
+      threads: int, number of ranges copied concurrently with positioned
+          reads and writes. 1 copies sequentially.
+      range_size: int, size in bytes of the ranges copied concurrently.
+      cancel: threading.Event or None, copies raise CopyCancelled at the
+          next block once it is set.
+      pool: BufferPool, buffers shared by all copies using these options.
+    """
+
+    def __init__(self, buffer_count=4, buffer_size=None, kernel_copy=True,
+                 drop_cache=True, threads=1, range_size=DEFAULT_RANGE_SIZE,
+                 cancel=None):
+        self.buffer_count = buffer_count
+        self.buffer_size = buffer_size
+        self.kernel_copy = kernel_copy
+        self.drop_cache = drop_cache
+        self.threads = threads
+        self.range_size = range_size
+        self.cancel = cancel
+        self.pool = BufferPool()
+
+    def block_size(self, in_fh, out_fh):
+        """Returns the size of the blocks to copy between two files.
+
+        Blocks are a multiple of the preferred I/O size of both files.
+
+        Args:
+          in_fh: file handle, source of uncached file contents.
+          out_fh: file handle, destination for saved file.
+
+        Returns:
+          Int, block size in bytes.
+        """
+        preferred = max(preferred_block_size(in_fh),
+                        preferred_block_size(out_fh))
+        preferred = min(preferred, MAX_BLOCK_SIZE)
+        if self.buffer_size:
+            return max(self.buffer_size // preferred, 1) * preferred
+        return min(max(preferred * 256, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def copy(in_fh, out_fh, size, options=None):
+    """Copies a block of data from in_fh to out_fh.
+
+    With several threads configured, ranges of the data are copied
+    concurrently. Otherwise, when both handles are regular files on Linux,
+    the data is copied by the kernel with copy_file_range (or sendfile) and
+    holes in a sparse source are kept as holes. Anything the kernel does not
+    copy is copied through Python, pipelined over several buffers when it is
+    larger than one. That is all of the data on other platforms and for
+    handles that are not regular files, such as pipes, and the rest of the
+    data when a kernel copy stops part way, e.g. at the end of a source
+    that is being written.
+
+    Args:
+      in_fh: file handle, source of uncached file contents.
+      out_fh: file handle, destination for saved file.
+      size: int, amount of data to copy.
+      options: CopyOptions or None for the defaults.
+    """
+    if options is None:
+        options = CopyOptions()
+    _check_cancelled(options.cancel)
+    if (options.threads > 1 and size > options.range_size and
+            parallel_copy(in_fh, out_fh, size, options)):
+        return
+    if options.kernel_copy:
+        size = size - kernel_copy(in_fh, out_fh, size, options.drop_cache,
+                                  options.cancel)
+    if size <= 0:
+        return
+    if (options.buffer_count > 1 and hasattr(in_fh, "readinto") and
+            not isinstance(in_fh, bufferio.BufferReader) and
+            size > options.block_size(in_fh, out_fh)):
+        pipelined_copy(in_fh, out_fh, size, options)
+    else:
+        buffered_copy(in_fh, out_fh, size, options)
+
+
+def parallel_copy(in_fh, out_fh, size, options):
+    """Copies a block of data as ranges copied concurrently.
+
+    Every range is copied by a worker thread with positioned reads and
+    writes (or copy_file_range) at offsets computed up front, so several
+    I/Os are in flight at once. Copying starts at the current position of
+    both handles and both are left positioned after the copied data.
+
+    Args:
+      in_fh: file handle, source of uncached file contents.
+      out_fh: file handle, destination for saved file.
+      size: int, amount of data to copy.
+      options: CopyOptions, thread count, range size and pool to use.
+
+    Returns:
+      Bool, False if the handles do not support positioned I/O (or the
+      source is too short), nothing was copied then.
+    """
+    if not hasattr(os, "pwrite"):
+        return False
+    try:
+        in_fd = in_fh.fileno()
+        out_fd = out_fh.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        return False
+    if not (stat.S_ISREG(os.fstat(in_fd).st_mode) and
+            stat.S_ISREG(os.fstat(out_fd).st_mode)):
+        return False
+
+    in_position = in_fh.tell()
+    if in_position + size > os.fstat(in_fd).st_size:
+        return False
+    out_fh.flush()
+    out_position = out_fh.tell()
+
+    block_size = options.block_size(in_fh, out_fh)
+    range_size = max(options.range_size // block_size, 1) * block_size
+    use_copy_file_range = [options.kernel_copy and
+                           hasattr(os, "copy_file_range")]
+
+    def copy_range(start):
+        end = min(start + range_size, size)
+        offset = start
+        if use_copy_file_range[0]:
+            try:
+                while offset < end:
+                    _check_cancelled(options.cancel)
+                    count = os.copy_file_range(in_fd, out_fd, end - offset,
+                                               in_position + offset,
+                                               out_position + offset)
+                    if not count:
+                        break
+                    offset += count
+            except OSError:
+                # Cross filesystem copies are refused by older kernels.
+                use_copy_file_range[0] = False
+        if offset < end:
+            _positioned_copy(in_fd, out_fd, in_position + offset,
+                             out_position + offset, end - offset, block_size,
+                             options.pool, options.cancel)
+        if options.drop_cache and hasattr(os, "posix_fadvise"):
+            for fd, position in ((in_fd, in_position), (out_fd, out_position)):
+                try:
+                    os.posix_fadvise(fd, position + start, end - start,
+                                     os.POSIX_FADV_DONTNEED)
+                except OSError:
+                    pass
+
+    with concurrent.futures.ThreadPoolExecutor(options.threads) as executor:
+        futures = [executor.submit(copy_range, offset)
+                   for offset in range(0, size, range_size)]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    if os.fstat(out_fd).st_size < out_position + size:
+        os.ftruncate(out_fd, out_position + size)
+    in_fh.seek(in_position + size)
+    out_fh.seek(out_position + size)
+    return True
+
+
+def _positioned_copy(in_fd, out_fd, in_offset, out_offset, size, block_size,
+                     pool, cancel=None):
+    """Copies a range between file descriptors with pread and pwrite."""
+    buffer = pool.get(min(size, block_size))
+    try:
+        with memoryview(buffer) as view:
+            copied = 0
+            while copied < size:
+                _check_cancelled(cancel)
+                block = view[:min(size - copied, len(view))]
+                if hasattr(os, "preadv"):
+                    count = os.preadv(in_fd, [block], in_offset + copied)
+                else:
+                    data = os.pread(in_fd, len(block), in_offset + copied)
+                    count = len(data)
+                    block[:count] = data
+                if not count:
+                    raise IOError("Unexpected end of file at %d" %
+                                  (in_offset + copied))
+                written = 0
+                while written < count:
+                    written += os.pwrite(out_fd, block[written:count],
+                                         out_offset + copied + written)
+                copied += count
+    finally:
+        pool.put(buffer)
+
+
+def pipelined_copy(in_fh, out_fh, size, options):
+    """Copies a block of data with reads and writes overlapping.
+
+    A reading thread fills a fixed ring of pooled buffers with readinto
+    while the calling thread writes filled buffers out.
+
+    Args:
+      in_fh: file handle, source of uncached file contents.
+      out_fh: file handle, destination for saved file.
+      size: int, amount of data to copy.
+      options: CopyOptions, buffer count, size and pool to use.
+    """
+    block_size = options.block_size(in_fh, out_fh)
+    buffers = [options.pool.get(block_size)
+               for i in range(options.buffer_count)]
+    in_cache = _DropBehind(in_fh, block_size, options.drop_cache)
+    out_cache = _DropBehind(out_fh, block_size, options.drop_cache,
+                            WRITE_BEHIND_BLOCKS)
+    in_cache.sequential(size)
+    empty = queue.Queue()
+    filled = queue.Queue()
+    for buffer in buffers:
+        empty.put(buffer)
+    errors = []
+
+    def read():
+        remaining = size
+        try:
+            while remaining > 0:
+                buffer = empty.get()
+                if buffer is None:
+                    # The writer stopped.
+                    return
+                with memoryview(buffer) as view:
+                    count = in_fh.readinto(view[:min(remaining, block_size)])
+                if not count:
+                    return
+                filled.put((buffer, count))
+                remaining -= count
+                in_cache.advance(size - remaining)
+        except BaseException as error:
+            errors.append(error)
+        finally:
+            filled.put(None)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        written = 0
+        while True:
+            item = filled.get()
+            if item is None:
+                break
+            buffer, count = item
+            _check_cancelled(options.cancel)
+            with memoryview(buffer) as view:
+                out_fh.write(view[:count])
+            empty.put(buffer)
+            written += count
+            out_cache.advance(written)
+    finally:
+        empty.put(None)
+        reader.join()
+        for buffer in buffers:
+            options.pool.put(buffer)
+
+    if errors:
+        raise errors[0]
+
+
+def buffered_copy(in_fh, out_fh, size, options=None):
+    """Copies a block of data from in_fh to out_fh through Python.
+
+    Args:
+      in_fh: file handle, source of uncached file contents.
+      out_fh: file handle, destination for saved file.
+      size: int, amount of data to copy.
+      options: CopyOptions or None for the defaults.
+    """
+    if options is None:
+        options = CopyOptions()
+
+    # In-memory sources are written straight from their buffer.
+    if isinstance(in_fh, bufferio.BufferReader):
+        # On 32-bit systems reading / writing is limited to 2GB chunks.
+        # To prevent overflow, write 64 MB chunks.
+        block_size = MAX_BLOCK_SIZE
+        position = in_fh.tell()
+        while size > 0:
+            _check_cancelled(options.cancel)
+            contents = in_fh.view(position, min(size, block_size))
+            if not contents:
+                break
+            out_fh.write(contents)
+            position += len(contents)
+            size -= len(contents)
+        in_fh.seek(position)
+        return
+
+    block_size = options.block_size(in_fh, out_fh)
+    if not hasattr(in_fh, "readinto"):
+        while (size > block_size):
+            _check_cancelled(options.cancel)
+            contents = in_fh.read(block_size)
+            out_fh.write(contents)
+            size = size - block_size
+
+        contents = in_fh.read(size)
+        out_fh.write(contents)
+        return
+
+    in_cache = _DropBehind(in_fh, block_size, options.drop_cache)
+    out_cache = _DropBehind(out_fh, block_size, options.drop_cache,
+                            WRITE_BEHIND_BLOCKS)
+    in_cache.sequential(size)
+    buffer = options.pool.get(min(size, block_size))
+    try:
+        with memoryview(buffer) as view:
+            copied = 0
+            while copied < size:
+                _check_cancelled(options.cancel)
+                count = in_fh.readinto(view[:min(size - copied, len(view))])
+                if not count:
+                    break
+                out_fh.write(view[:count])
+                copied += count
+                in_cache.advance(copied)
+                out_cache.advance(copied)
+    finally:
+        options.pool.put(buffer)
+
+
+def _check_cancelled(cancel):
+    """Raises CopyCancelled if the cancel event is set."""
+    if cancel is not None and cancel.is_set():
+        raise CopyCancelled("Copy cancelled")
+
+
+def preferred_block_size(fh):
+    """Returns the preferred I/O size of the file system holding fh."""
+    try:
+        return os.fstat(fh.fileno()).st_blksize or io.DEFAULT_BUFFER_SIZE
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return io.DEFAULT_BUFFER_SIZE
+
+
+class _DropBehind(object):
+    """Drops the pages of a file range from the page cache while it is
+    being copied.
+
+    Read pages are dropped as soon as they have been read. Written pages
+    can only be dropped once they have been written back, so the last
+    window_blocks blocks are advised again each time, the first advice
+    starting the writeback.
+    """
+
+    def __init__(self, fh, block_size, enabled=True, window_blocks=0):
+        self.fd = None
+        if enabled and hasattr(os, "posix_fadvise"):
+            try:
+                self.fd = fh.fileno()
+                self.start = fh.tell()
+            except (AttributeError, OSError, ValueError,
+                    io.UnsupportedOperation):
+                self.fd = None
+        self.window = block_size * window_blocks
+        self.dropped = 0
+
+    def sequential(self, size):
+        """Advises the kernel that size bytes will be read in order."""
+        self.advise(0, size, getattr(os, "POSIX_FADV_SEQUENTIAL", None))
+
+    def advance(self, copied):
+        """Drops the pages of the first copied bytes."""
+        begin = max(0, min(self.dropped, copied - self.window))
+        self.advise(begin, copied - begin,
+                    getattr(os, "POSIX_FADV_DONTNEED", None))
+        self.dropped = copied
+
+    def advise(self, offset, length, advice):
+        if self.fd is None or advice is None or length <= 0:
+            return
+        try:
+            os.posix_fadvise(self.fd, self.start + offset, length, advice)
+        except OSError:
+            # Pipes and some file systems do not take advice.
+            self.fd = None
+
+
+def kernel_copy(in_fh, out_fh, size, drop_cache=False, cancel=None):
+    """Copies a block of data between two files inside the kernel.
+
+    Copying starts at the current position of both handles and both are
+    left positioned after the copied data.
+
+    Args:
+      in_fh: file handle, source of uncached file contents.
+      out_fh: file handle, destination for saved file.
+      size: int, amount of data to copy.
+      drop_cache: bool, drop copied pages from the page cache.
+      cancel: threading.Event or None, raises CopyCancelled at the next
+          block once it is set.
+
+    Returns:
+      Int, amount of data copied. Zero when the handles do not support
+      kernel copies, the caller copies the remaining data itself.
+    """
+    if size <= 0 or not sys.platform.startswith("linux"):
+        return 0
+    try:
+        in_fd = in_fh.fileno()
+        out_fd = out_fh.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        return 0
+    if not (stat.S_ISREG(os.fstat(in_fd).st_mode) and
+            stat.S_ISREG(os.fstat(out_fd).st_mode)):
+        return 0
+
+    in_position = in_fh.tell()
+    out_fh.flush()
+    out_position = out_fh.tell()
+
+    # Holes are only skipped when writing past the end of the output, where
+    # anything not written reads back as zeros.
+    keep_holes = os.fstat(out_fd).st_size <= out_position
+
+    block_size = MAX_BLOCK_SIZE
+    in_cache = _DropBehind(in_fh, block_size, drop_cache)
+    out_cache = _DropBehind(out_fh, block_size, drop_cache,
+                            WRITE_BEHIND_BLOCKS)
+    in_cache.sequential(size)
+
+    def progress(offset):
+        _check_cancelled(cancel)
+        in_cache.advance(offset)
+        out_cache.advance(offset)
+
+    # Probing for holes and sendfile move the raw descriptor offsets behind
+    # the back of the buffered handles, restore them before seeking.
+    raw_in_position = os.lseek(in_fd, 0, os.SEEK_CUR)
+    raw_out_position = os.lseek(out_fd, 0, os.SEEK_CUR)
+    copied = 0
+    try:
+        if keep_holes:
+            ranges = _data_ranges(in_fd, in_position, in_position + size)
+        else:
+            ranges = [(in_position, in_position + size)]
+        for data_start, data_end in ranges:
+            offset = data_start - in_position
+            count = _kernel_copy_range(
+                in_fd, out_fd, data_start, out_position + offset,
+                data_end - data_start,
+                lambda copied: progress(offset + copied))
+            if count < data_end - data_start:
+                copied = offset + count
+                break
+        else:
+            copied = size
+            if os.fstat(out_fd).st_size < out_position + size:
+                os.ftruncate(out_fd, out_position + size)
+    finally:
+        os.lseek(in_fd, raw_in_position, os.SEEK_SET)
+        os.lseek(out_fd, raw_out_position, os.SEEK_SET)
+
+    in_fh.seek(in_position + copied)
+    out_fh.seek(out_position + copied)
+    return copied
+
+
+def _kernel_copy_range(in_fd, out_fd, in_offset, out_offset, size,
+                       progress=None):
+    """Copies a range between file descriptors, returns the amount copied.
+
+    progress is called with the amount copied so far after every block.
+    """
+    block_size = MAX_BLOCK_SIZE
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    copied = 0
+    while copied < size:
+        count = min(size - copied, block_size)
+        try:
+            if use_copy_file_range:
+                count = os.copy_file_range(in_fd, out_fd, count,
+                                           in_offset + copied,
+                                           out_offset + copied)
+            else:
+                os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+                count = os.sendfile(out_fd, in_fd, in_offset + copied, count)
+        except OSError:
+            if not use_copy_file_range:
+                break
+            # Older kernels refuse cross filesystem copies, retry the same
+            # range with sendfile.
+            use_copy_file_range = False
+            continue
+        if count == 0:
+            break
+        copied += count
+        if progress:
+            progress(copied)
+    return copied
+
+
+def _data_ranges(fd, start, end):
+    """Yields the (start, end) ranges of fd between start and end that hold
+    data, skipping holes of sparse files."""
+    if not hasattr(os, "SEEK_DATA"):
+        yield start, end
+        return
+
+    position = start
+    while position < end:
+        try:
+            data_start = os.lseek(fd, position, os.SEEK_DATA)
+            data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+        except OSError as error:
+            if error.errno != errno.ENXIO:
+                yield position, end
+            # ENXIO: no data after position, the rest is a hole.
+            return
+        if data_start >= end:
+            return
+        yield data_start, min(data_end, end)
+        position = data_end
+
+
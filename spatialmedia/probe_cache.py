@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of probe results.
+
+Results of parsing the spatial media metadata of a file are stored in a
+SQLite database keyed by the identity of the file: device, inode, size and
+modification time. Files that did not change since they were parsed are
+answered from the cache without being opened:
+
+    with probe_cache.ProbeCache("probes.db") as cache:
+        metadata = metadata_utils.parse_metadata(path, console, cache)
+
+Parsed metadata is stored pickled, only open cache files you trust.
+"""
+
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from spatialmedia import metadata_utils
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    metadata BLOB NOT NULL,
+    tracks TEXT NOT NULL,
+    console TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (device, inode));
+CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used);
+CREATE INDEX IF NOT EXISTS probes_path ON probes (path);
+"""
+
+
+def file_key(stat):
+    """Returns the (device, inode, size, mtime_ns) identity of a file."""
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ProbeResult(object):
+    """Cached result of parsing a file.
+
+    Attributes:
+      metadata: ParsedMetadata, parsed spatial media metadata.
+      tracks: list of dicts, handler type and spatial media boxes of each
+          track, see metadata_utils.get_track_summary.
+      console: list of strings, messages printed while parsing.
+    """
+
+    def __init__(self, metadata, tracks, console):
+        self.metadata = metadata
+        self.tracks = tracks
+        self.console = console
+
+    def replay(self, console):
+        """Prints the messages printed while parsing to console."""
+        for line in self.console:
+            console(line)
+
+
+class ProbeCache(object):
+    """SQLite backed cache of probe results.
+
+    The cache can be shared by threads. Entries are evicted, least
+    recently used first, once the stored results exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        """Opens or creates a cache.
+
+        Args:
+          path: string, path of the SQLite database.
+          max_bytes: int, size bound for the stored results.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30,
+                                          check_same_thread=False)
+        # Hits update the last use time, keep those commits cheap.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Closes the database."""
+        with self.lock:
+            self.connection.close()
+
+    def get(self, filename):
+        """Returns the cached result for a file.
+
+        Args:
+          filename: string, path of the file.
+
+        Returns:
+          ProbeResult or None if the file changed since it was cached, was
+          never cached or does not exist.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, metadata, tracks, console "
+                "FROM probes WHERE device = ? AND inode = ?",
+                (stat.st_dev, stat.st_ino)).fetchone()
+            if row is None or tuple(row[:2]) != file_key(stat)[2:]:
+                return None
+            try:
+                result = ProbeResult(pickle.loads(row[2]),
+                                     json.loads(row[3]), json.loads(row[4]))
+            except Exception:
+                # Written by an incompatible version.
+                result = None
+            with self.connection:
+                if result is None:
+                    self.connection.execute(
+                        "DELETE FROM probes WHERE device = ? AND inode = ?",
+                        (stat.st_dev, stat.st_ino))
+                else:
+                    self.connection.execute(
+                        "UPDATE probes SET last_used = ? "
+                        "WHERE device = ? AND inode = ?",
+                        (time.time(), stat.st_dev, stat.st_ino))
+        return result
+
+    def probe(self, filename, console, limits=None):
+        """Parses a file and caches the result.
+
+        Args:
+          filename: string, path of the mp4/mov file.
+          console: function, receives messages.
+          limits: mpeg.ParseLimits or None, bounds on parsing the file.
+
+        Returns:
+          ParsedMetadata or None if the file could not be parsed, as
+          parse_metadata without a cache.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            console("Error: " + filename +
+                    " does not exist or we do not have permission")
+            return None
+        lines = list()
+
+        def record(message):
+            lines.append(str(message))
+            console(message)
+
+        metadata, tracks = metadata_utils.probe_mpeg4(filename, record,
+                                                      limits)
+        if metadata is None:
+            return None
+        # Files modified or removed while they were parsed are not cached.
+        try:
+            unchanged = file_key(os.stat(filename)) == file_key(stat)
+        except OSError:
+            unchanged = False
+        if unchanged:
+            self.put(filename, stat, ProbeResult(metadata, tracks, lines))
+        return metadata
+
+    def put(self, filename, stat, result):
+        """Stores the result for a file.
+
+        Args:
+          filename: string, path of the file.
+          stat: os.stat_result, stat of the file when it was parsed.
+          result: ProbeResult, result to store.
+        """
+        metadata = pickle.dumps(result.metadata, pickle.HIGHEST_PROTOCOL)
+        tracks = json.dumps(result.tracks)
+        console = json.dumps(result.console)
+        size = len(metadata) + len(tracks) + len(console)
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO probes VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    file_key(stat) + (os.path.abspath(filename), metadata,
+                                      tracks, console, size, time.time()))
+                self._evict()
+
+    def _evict(self):
+        """Deletes least recently used entries beyond the size bound."""
+        total = self.connection.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM probes").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = list()
+        for rowid, size in self.connection.execute(
+                "SELECT rowid, bytes FROM probes ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            expired.append((rowid,))
+            total -= size
+        self.connection.executemany(
+            "DELETE FROM probes WHERE rowid = ?", expired)
+
+    def invalidate(self, filename):
+        """Removes the cached result for a file.
+
+        Args:
+          filename: string, path of the file. Results for files that no
+              longer exist are found by path.
+
+        Returns:
+          Bool, True if a result was removed.
+        """
+        with self.lock:
+            with self.connection:
+                removed = self.connection.execute(
+                    "DELETE FROM probes WHERE path = ?",
+                    (os.path.abspath(filename),)).rowcount
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    return removed > 0
+                removed += self.connection.execute(
+                    "DELETE FROM probes WHERE device = ? AND inode = ?",
+                    (stat.st_dev, stat.st_ino)).rowcount
+        return removed > 0
+
+    def clear(self):
+        """Removes all cached results."""
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM probes")
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM probes").fetchone()[0]
@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Builds small MP4 files for the tests and checks saved files.
+
+The files hold a video track and optionally a 4 channel AAC audio track
+whose chunks point into one mdat box. The checks walk the saved file
+without the spatialmedia package and read the chunks back through the
+chunk offset tables, so a moved mdat with stale offsets is caught.
+"""
+
+import struct
+
+from spatialmedia import metadata_utils
+
+CONTAINERS = frozenset(["moov", "trak", "mdia", "minf", "stbl", "udta",
+                        "dinf", "edts"])
+# Bytes between the header of a sample entry and its child boxes.
+SAMPLE_ENTRY_PADDING = {"stsd": 8, "avc1": 78, "mp4a": 28}
+CHUNK_SIZE = 16
+
+
+def box(name, payload):
+    return struct.pack(">I", 8 + len(payload)) + name.encode("latin1") + payload
+
+
+def full_box(name, payload, version=0, flags=0):
+    return box(name, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def chunk_offset_box(offsets, co64=False):
+    if co64:
+        return full_box("co64", struct.pack(">I%dQ" % len(offsets),
+                                            len(offsets), *offsets))
+    return full_box("stco", struct.pack(">I%dI" % len(offsets),
+                                        len(offsets), *offsets))
+
+
+def sample_table(sample_entry, offsets, co64=False):
+    count = len(offsets)
+    return box("stbl",
+               full_box("stsd", struct.pack(">I", 1) + sample_entry) +
+               full_box("stts", struct.pack(">III", 1, count, 1000)) +
+               full_box("stsc", struct.pack(">IIII", 1, 1, 1, 1)) +
+               full_box("stsz", struct.pack(">II", CHUNK_SIZE, count)) +
+               chunk_offset_box(offsets, co64))
+
+
+def video_track(offsets, co64=False, sv3d=b""):
+    entry = (b"\0" * 6 + struct.pack(">H", 1) + b"\0" * 16 +
+             struct.pack(">HHII", 1920, 1080, 0x480000, 0x480000) +
+             b"\0" * 4 + struct.pack(">H", 1) + b"\0" * 32 +
+             struct.pack(">Hh", 24, -1))
+    avc1 = box("avc1", entry + box("avcC", b"\x01\x64\x00\x28\xff\xe1\0\0") +
+               sv3d)
+    handler = full_box("hdlr", b"\0" * 4 + b"vide" + b"\0" * 12 +
+                       b"VideoHandler\0")
+    minf = box("minf", full_box("vmhd", b"\0" * 8, flags=1) +
+               box("dinf", full_box("dref", struct.pack(">I", 1) +
+                                    full_box("url ", b"", flags=1))) +
+               sample_table(avc1, offsets, co64))
+    return box("trak", full_box("tkhd", b"\0" * 80) +
+               box("mdia", full_box("mdhd", b"\0" * 20) + handler + minf))
+
+
+def audio_track(offsets, channels=4):
+    entry = (b"\0" * 6 + struct.pack(">H", 1) + b"\0" * 8 +
+             struct.pack(">hhhhI", channels, 16, 0, 0, 48000 << 16))
+    specific_config = b"\x05\x02" + struct.pack(
+        ">H", (2 << 11) | (3 << 7) | (channels << 3))
+    config = (b"\x04" + bytes([13 + len(specific_config)]) + b"\x40\x15" +
+              b"\0" * 11 + specific_config)
+    descriptor = b"\x03" + bytes([3 + len(config)]) + b"\0\0\0" + config
+    mp4a = box("mp4a", entry + full_box("esds", descriptor))
+    handler = full_box("hdlr", b"\0" * 4 + b"soun" + b"\0" * 12 +
+                       b"SoundHandler\0")
+    minf = box("minf", full_box("smhd", b"\0" * 4) +
+               sample_table(mp4a, offsets))
+    return box("trak", full_box("tkhd", b"\0" * 80) +
+               box("mdia", full_box("mdhd", b"\0" * 20) + handler + minf))
+
+
+def media_data(size):
+    return bytes((i * 7 + 3) & 0xff for i in range(size))
+
+
+def build(path, layout="end", mdat_size=4096, chunks=32, audio=True,
+          free_size=256, co64=False, sv3d=b""):
+    """Writes a test file.
+
+    Args:
+      path: string, file to write.
+      layout: string, order of the top level boxes, "end" for ftyp mdat
+          moov, "front" for ftyp moov free mdat, "freefront" for ftyp free
+          mdat moov and "endfree" for ftyp mdat moov free.
+      mdat_size: int, bytes of media data.
+      chunks: int, number of chunks of each track.
+      audio: bool, whether to add the audio track.
+      free_size: int, size of the free box.
+      co64: bool, whether the video track uses a co64 box.
+      sv3d: bytes, box added to the video sample entry.
+    """
+    ftyp = box("ftyp", b"isom" + struct.pack(">I", 512) + b"isomiso2avc1mp41")
+    free = box("free", b"\0" * (free_size - 8))
+    mdat = box("mdat", media_data(mdat_size))
+
+    def movie(mdat_start):
+        data_start = mdat_start + 8
+        step = max(1, mdat_size // (2 * chunks))
+        tracks = video_track([data_start + i * step for i in range(chunks)],
+                             co64, sv3d)
+        if audio:
+            tracks += audio_track([data_start + mdat_size - CHUNK_SIZE -
+                                   i * CHUNK_SIZE for i in range(chunks)])
+        return box("moov", full_box("mvhd", b"\0" * 96) + tracks)
+
+    if layout == "end":
+        boxes = [ftyp, mdat, movie(len(ftyp))]
+    elif layout == "endfree":
+        boxes = [ftyp, mdat, movie(len(ftyp)), free]
+    elif layout == "front":
+        moov_size = len(movie(0))
+        boxes = [ftyp, movie(len(ftyp) + moov_size + len(free)), free, mdat]
+    elif layout == "freefront":
+        boxes = [ftyp, free, mdat, movie(len(ftyp) + len(free))]
+    else:
+        raise ValueError("Unknown layout %s" % layout)
+    with open(path, "wb") as fh:
+        fh.write(b"".join(boxes))
+
+
+def walk(fh, position, end, path=""):
+    """Returns (path, position, header size, size) of every box, checking
+    that the boxes exactly fill each container."""
+    boxes = list()
+    while position < end:
+        fh.seek(position)
+        header = fh.read(16)
+        size, name = struct.unpack(">I4s", header[:8])
+        name = name.decode("latin1")
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        if size < 8 or position + size > end:
+            raise AssertionError("Invalid %s%s box at %d" %
+                                 (path, name, position))
+        box_path = path + name
+        boxes.append((box_path, position, header_size, size))
+        start = position + header_size
+        if name in CONTAINERS:
+            boxes.extend(walk(fh, start, position + size, box_path + "/"))
+        elif name in SAMPLE_ENTRY_PADDING:
+            boxes.extend(walk(fh, start + SAMPLE_ENTRY_PADDING[name],
+                              position + size, box_path + "/"))
+        position += size
+    if position != end:
+        raise AssertionError("Boxes overrun %s by %d" % (path, position - end))
+    return boxes
+
+
+def read_chunks(path):
+    """Returns the box paths and the chunk data of every track of a file."""
+    with open(path, "rb") as fh:
+        fh.seek(0, 2)
+        boxes = walk(fh, 0, fh.tell())
+        chunk_data = list()
+        for box_path, position, header_size, size in boxes:
+            name = box_path.rsplit("/", 1)[-1]
+            if name not in ("stco", "co64"):
+                continue
+            fh.seek(position + header_size + 4)
+            count = struct.unpack(">I", fh.read(4))[0]
+            entry = "I" if name == "stco" else "Q"
+            offsets = struct.unpack(">%d%s" % (count, entry),
+                                    fh.read(count * struct.calcsize(entry)))
+            track = list()
+            for offset in offsets:
+                fh.seek(offset)
+                track.append(fh.read(CHUNK_SIZE))
+            chunk_data.append(track)
+    return [box_path for box_path, _, _, _ in boxes], chunk_data
+
+
+def metadata(spherical="equirectangular", stereo="none", audio=False):
+    """Returns Metadata to inject, as built by the command line."""
+    new_metadata = metadata_utils.Metadata()
+    new_metadata.spherical = spherical
+    new_metadata.stereo = stereo
+    new_metadata.orientation = {"yaw": 0, "pitch": 0, "roll": 0}
+    new_metadata.fov = [16.0, 9.0] if spherical == "full-frame" else [180, 180]
+    new_metadata.fisheye_correction = [0.1, -0.05, 0.02, 0.0]
+    new_metadata.uv_offsets = [0.0, 0.5, 0.0, 1.0, 0.5, 0.5, 0.0, 1.0]
+    if audio:
+        new_metadata.audio = metadata_utils.get_spatial_audio_metadata(
+            1, False)
+    return new_metadata
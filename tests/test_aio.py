@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the asyncio entry points."""
+
+import asyncio
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import mp4_builder
+from spatialmedia import aio
+from spatialmedia import metadata_utils
+from spatialmedia.mpeg import transfer
+
+
+class AioTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = self.path("src.mp4")
+        mp4_builder.build(self.src)
+        self.executor = concurrent.futures.ThreadPoolExecutor(16)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def probe_all(self, paths, concurrency):
+        async def collect():
+            return [result async for result in aio.probe_many(
+                paths, concurrency, executor=self.executor)]
+        return asyncio.run(collect())
+
+    def test_inject(self):
+        messages = list()
+        injected = asyncio.run(aio.inject(
+            self.src, self.path("dest.mp4"), mp4_builder.metadata(),
+            messages.append, executor=self.executor))
+        self.assertTrue(injected)
+        self.assertIn("Saved file settings", messages)
+        self.assertEqual(mp4_builder.read_chunks(self.path("dest.mp4"))[1],
+                         mp4_builder.read_chunks(self.src)[1])
+
+    def test_cancel_inject_mid_copy(self):
+        started = threading.Event()
+        copy = transfer.copy
+
+        def blocked_copy(in_fh, out_fh, size, options=None):
+            # Holds the copy until the task is cancelled.
+            started.set()
+            options.cancel.wait(10)
+            return copy(in_fh, out_fh, size, options)
+
+        async def cancel():
+            task = asyncio.ensure_future(aio.inject(
+                self.src, self.path("dest.mp4"), mp4_builder.metadata(),
+                executor=self.executor))
+            await asyncio.get_running_loop().run_in_executor(
+                None, started.wait, 10)
+            task.cancel()
+            await task
+
+        with mock.patch.object(transfer, "copy", blocked_copy):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(cancel())
+        self.assertTrue(started.is_set())
+        self.assertEqual(os.listdir(self.directory), ["src.mp4"])
+
+    def test_probe_many_bounds_concurrency(self):
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def parse(path, console, cache=None, limits=None):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return path
+
+        paths = ["%d.mp4" % index for index in range(20)]
+        with mock.patch.object(metadata_utils, "parse_metadata", parse):
+            results = self.probe_all(paths, 3)
+        self.assertEqual(sorted(result.metadata for result in results),
+                         sorted(paths))
+        self.assertEqual(most[0], 3)
+
+    def test_probe_many_yields_in_completion_order(self):
+        # Each file finishes, then lets the next one in finish_order go.
+        finish_order = ["c.mp4", "a.mp4", "d.mp4", "b.mp4"]
+        events = dict((path, threading.Event()) for path in finish_order)
+
+        def parse(path, console, cache=None, limits=None):
+            events[path].wait(10)
+            index = finish_order.index(path) + 1
+            if index < len(finish_order):
+                time.sleep(0.05)
+                events[finish_order[index]].set()
+            return path
+
+        events[finish_order[0]].set()
+        with mock.patch.object(metadata_utils, "parse_metadata", parse):
+            results = self.probe_all(sorted(finish_order), 4)
+        self.assertEqual([result.path for result in results], finish_order)
+
+    def test_probe_many_reports_failures(self):
+        parse_metadata = metadata_utils.parse_metadata
+
+        def parse(path, console, cache=None, limits=None):
+            if path.endswith("raises.mp4"):
+                raise RuntimeError("boom")
+            return parse_metadata(path, console, cache, limits)
+
+        paths = [self.path("missing.mp4"), self.path("raises.mp4"), self.src]
+        with mock.patch.object(metadata_utils, "parse_metadata", parse):
+            results = dict((result.path, result)
+                           for result in self.probe_all(paths, 2))
+        missing = results[self.path("missing.mp4")]
+        self.assertIsNone(missing.metadata)
+        self.assertIsNone(missing.error)
+        self.assertIn("does not exist", missing.messages[0])
+        raised = results[self.path("raises.mp4")]
+        self.assertIsInstance(raised.error, RuntimeError)
+        self.assertIsNone(raised.metadata)
+        parsed = results[self.src]
+        self.assertIsNone(parsed.error)
+        self.assertIsInstance(parsed.metadata, metadata_utils.ParsedMetadata)
+
+
+if __name__ == "__main__":
+    unittest.main()
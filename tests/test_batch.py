@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of batch injection and its error reporting."""
+
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import mp4_builder
+from spatialmedia import batch
+from spatialmedia import metadata_utils
+
+FIELDS = {"spherical": "equirectangular", "stereo": "top-bottom"}
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = self.path("src.mp4")
+        mp4_builder.build(self.src)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def record(self, src, dest, **fields):
+        record = dict(FIELDS, src=src, dest=dest)
+        record.update(fields)
+        return record
+
+    def test_results(self):
+        with open(self.path("broken.mp4"), "wb") as fh:
+            fh.write(b"\0\0\0\x20moov")
+        records = [self.record(self.src, self.path("ok.mp4")),
+                   self.record(self.path("missing.mp4"), self.path("a.mp4")),
+                   self.record(self.path("broken.mp4"), self.path("b.mp4")),
+                   self.record(self.src, self.path("c.mp4"),
+                               spherical=None, stereo=None),
+                   {"line": 5, "status": "error",
+                    "error": "Error, invalid manifest line"}]
+        results = list()
+        failures = batch.run(records, 2, results.append)
+        self.assertEqual(failures, 4)
+        by_dest = dict((result.get("dest"), result) for result in results)
+        ok = by_dest[self.path("ok.mp4")]
+        self.assertEqual(ok["status"], "ok")
+        self.assertEqual(ok["bytes"], os.path.getsize(self.path("ok.mp4")))
+        self.assertNotIn("error", ok)
+
+        missing = by_dest[self.path("a.mp4")]
+        self.assertEqual(missing["status"], "error")
+        self.assertIn("does not exist", missing["error"])
+        self.assertEqual(by_dest[self.path("b.mp4")]["status"], "error")
+        self.assertEqual(by_dest[self.path("c.mp4")]["error"],
+                         "Error, failed to generate metadata.")
+        self.assertEqual(by_dest[None]["line"], 5)
+
+    def test_printed_errors_do_not_fail_injected_files(self):
+        def inject(src, dest, metadata, console, *args):
+            print("Error: failed to read elementary stream descriptor")
+            shutil.copy(src, dest)
+            return True
+
+        with mock.patch.object(metadata_utils, "inject_metadata", inject):
+            result = batch.inject_record(
+                self.record(self.src, self.path("out.mp4")))
+        self.assertEqual(result["status"], "ok")
+        self.assertIn("Error: failed to read elementary stream descriptor",
+                      result["log"])
+
+    def test_failed_injection_reports_its_error(self):
+        def inject(src, dest, metadata, console, *args):
+            print("Error: failed to read elementary stream descriptor")
+            console("Error failed to insert spatial audio data")
+            return False
+
+        with mock.patch.object(metadata_utils, "inject_metadata", inject):
+            result = batch.inject_record(
+                self.record(self.src, self.path("out.mp4")))
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(result["error"],
+                         "Error failed to insert spatial audio data")
+
+    def test_exceptions_are_reported(self):
+        with mock.patch.object(metadata_utils, "inject_metadata",
+                               side_effect=RuntimeError("boom")):
+            result = batch.inject_record(
+                self.record(self.src, self.path("out.mp4")))
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(result["error"], "Error, RuntimeError: boom")
+        self.assertIn("traceback", result)
+
+    def test_results_stream_while_records_are_read(self):
+        read = [0]
+        first_result = list()
+
+        def records():
+            for index in range(12):
+                read[0] += 1
+                yield self.record(self.src, self.path("%d.mp4" % index))
+
+        def emit(result):
+            if not first_result:
+                first_result.append(read[0])
+
+        self.assertEqual(batch.run(records(), 1, emit), 0)
+        self.assertEqual(read[0], 12)
+        # One worker keeps at most two records queued.
+        self.assertLessEqual(first_result[0], 3)
+
+    def test_glob_keeps_directory_layout(self):
+        for directory in ("a", "b"):
+            os.makedirs(self.path("in", directory))
+            shutil.copy(self.src, self.path("in", directory, "clip.mp4"))
+        output = io.StringIO()
+        with mock.patch("sys.stdout", output):
+            status = batch.main([
+                "--glob", self.path("in", "**", "*.mp4"),
+                "--output-dir", self.path("out"), "--fields",
+                json.dumps(FIELDS), "--jobs", "2", "--copy-buffers", "2",
+                "--copy-buffer-mb", "1"])
+        self.assertEqual(status, 0)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(sorted(result["dest"] for result in results),
+                         [self.path("out", "a", "clip.mp4"),
+                          self.path("out", "b", "clip.mp4")])
+        for result in results:
+            self.assertEqual(mp4_builder.read_chunks(result["dest"])[1],
+                             mp4_builder.read_chunks(self.src)[1])
+
+    def test_command_line_flag(self):
+        main = importlib.import_module("spatialmedia.__main__")
+        with mock.patch.object(batch, "main", return_value=3) as batch_main:
+            with mock.patch("sys.argv", ["spatialmedia", "--batch",
+                                         "manifest.jsonl", "--jobs", "2"]):
+                with self.assertRaises(SystemExit) as exit:
+                    main.main()
+        self.assertEqual(exit.exception.code, 3)
+        batch_main.assert_called_once_with(["manifest.jsonl", "--jobs", "2"])
+
+    def test_command_line_flag_alone(self):
+        main = importlib.import_module("spatialmedia.__main__")
+        for argv in (["-i", "--copy-threads", "4", "--batch", "-g", "*.mp4"],
+                     ["in.mp4", "--batch", "manifest.jsonl"]):
+            with mock.patch.object(batch, "main") as batch_main:
+                with mock.patch("sys.argv", ["spatialmedia"] + argv):
+                    with mock.patch("sys.stderr", io.StringIO()) as error:
+                        with self.assertRaises(SystemExit) as exit:
+                            main.main()
+            self.assertEqual(exit.exception.code, 2)
+            self.assertIn("--batch cannot be combined", error.getvalue())
+            self.assertFalse(batch_main.called)
+
+    def test_glob_needs_output_dir_or_in_place(self):
+        with open(self.src, "rb") as fh:
+            original = fh.read()
+        chunks = mp4_builder.read_chunks(self.src)[1]
+        glob_args = ["--glob", self.path("*.mp4"), "--fields",
+                     json.dumps(FIELDS)]
+        for extra in ([], ["--in-place", "--output-dir", self.path("out")]):
+            with mock.patch("sys.stderr", io.StringIO()):
+                with self.assertRaises(SystemExit) as exit:
+                    batch.main(glob_args + extra)
+            self.assertEqual(exit.exception.code, 2)
+        with open(self.src, "rb") as fh:
+            self.assertEqual(fh.read(), original)
+
+        output = io.StringIO()
+        with mock.patch("sys.stdout", output):
+            self.assertEqual(batch.main(glob_args + ["--in-place"]), 0)
+        result, = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(result["dest"], self.src)
+        self.assertEqual(mp4_builder.read_chunks(self.src)[1], chunks)
+        self.assertNotEqual(os.path.getsize(self.src), len(original))
+
+    def test_glob_root(self):
+        self.assertEqual(batch.glob_root("in/**/*.mp4"), "in")
+        self.assertEqual(batch.glob_root("in/a*/b/*.mp4"), "in")
+        self.assertEqual(batch.glob_root("/media/*.mp4"), "/media")
+        self.assertEqual(batch.glob_root("*.mp4"), os.curdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the box index and its updates."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mp4_builder
+from spatialmedia import mpeg
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import box_index
+from spatialmedia.mpeg import container
+
+
+def leaf(name, size=8):
+    new_box = box.Box()
+    new_box.name = name
+    new_box.header_size = 8
+    new_box.content_size = size
+    new_box.contents = b"\0" * size
+    return new_box
+
+
+def tables(index):
+    """Returns the tag and path tables of index with sets of box ids."""
+    return [dict((key, set(nodes)) for key, nodes in table.items())
+            for table in (index.by_tag, index.by_path)]
+
+
+class BoxIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "src.mp4")
+        mp4_builder.build(path)
+        with open(path, "rb") as fh:
+            self.mpeg4_file = mpeg.load(fh)
+        self.index = self.mpeg4_file.box_index()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_up_to_date(self):
+        """Checks the kept index against one built from scratch."""
+        self.assertIs(self.mpeg4_file.box_index(), self.index)
+        self.assertEqual(tables(self.index),
+                         tables(box_index.BoxIndex(self.mpeg4_file)))
+
+    def names(self, query):
+        return sorted(box_index.box_path(element)
+                      for element in self.mpeg4_file.find_all(query))
+
+    def test_queries(self):
+        self.assertEqual(self.names("hdlr"),
+                         ["moov/trak/mdia/hdlr"] * 2)
+        self.assertEqual(self.names("moov/trak/*/hdlr"),
+                         ["moov/trak/mdia/hdlr"] * 2)
+        self.assertEqual(self.names("/moov/trak/mdia/minf/stbl/stsd/*"),
+                         ["moov/trak/mdia/minf/stbl/stsd/avc1",
+                          "moov/trak/mdia/minf/stbl/stsd/mp4a"])
+        self.assertEqual(self.names("st?o"), ["moov/trak/mdia/minf/stbl/stco"]
+                         * 2)
+        self.assertEqual(self.names("*/mvhd"), ["moov/mvhd"])
+        self.assertEqual(self.names("moov/*/hdlr"), [])
+        self.assertEqual(self.names("sv3d"), [])
+        self.assertIsNone(self.mpeg4_file.find("moov/trak/sv3d"))
+        self.assertEqual(self.mpeg4_file.find("mvhd").name, "mvhd")
+        self.assert_up_to_date()
+
+    def test_add(self):
+        avc1 = self.mpeg4_file.find("avc1")
+        self.assertTrue(avc1.add(leaf("st3d")))
+        udta = container.Container()
+        udta.name = "udta"
+        udta.header_size = 8
+        udta.contents = [leaf("meta"), leaf("hdlr")]
+        self.assertTrue(self.mpeg4_file.moov_box.add(udta))
+        self.assertEqual(self.names("st3d"),
+                         ["moov/trak/mdia/minf/stbl/stsd/avc1/st3d"])
+        self.assertEqual(self.names("moov/udta/*"),
+                         ["moov/udta/hdlr", "moov/udta/meta"])
+        self.assertEqual(len(self.names("hdlr")), 3)
+        self.assert_up_to_date()
+
+    def test_replace(self):
+        stsd = self.mpeg4_file.find("moov/trak/mdia/minf/stbl/stsd")
+        avc1 = self.mpeg4_file.find("avc1")
+        hvc1 = container.Container()
+        hvc1.name = "hvc1"
+        hvc1.header_size = 8
+        hvc1.contents = [leaf("hvcC")]
+        self.assertTrue(stsd.replace(avc1, hvc1))
+        self.assertEqual(self.names("avc1"), [])
+        self.assertEqual(self.names("avcC"), [])
+        self.assertEqual(self.names("moov/trak/*/*/*/stsd/*/hvcC"),
+                         ["moov/trak/mdia/minf/stbl/stsd/hvc1/hvcC"])
+        self.assert_up_to_date()
+
+    def test_remove_prunes_empty_keys(self):
+        self.mpeg4_file.moov_box.remove("stco")
+        self.assertNotIn("stco", self.index.by_tag)
+        self.assertFalse([path for path in self.index.by_path
+                          if path.endswith("stco")])
+        self.assertEqual(self.names("stco"), [])
+        self.mpeg4_file.moov_box.remove("trak")
+        self.assertEqual(sorted(self.index.by_tag),
+                         ["ftyp", "mdat", "moov", "mvhd"])
+        self.assertEqual(sorted(self.index.by_path),
+                         ["ftyp", "mdat", "moov", "moov/mvhd"])
+        self.assertEqual(len(self.index), 4)
+        self.assert_up_to_date()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of loading and saving through memory mapped files."""
+
+import concurrent.futures
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import mp4_builder
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+from spatialmedia.mpeg import bufferio
+
+THREADS = 8
+
+
+def save_stereo(in_fh):
+    """Loads a file from in_fh, adds stereo metadata and returns the saved
+    bytes. moov grows in front of mdat, so the chunk offsets shift."""
+    mpeg4_file = mpeg.load(in_fh)
+    metadata_utils.mpeg4_add_stereo(mpeg4_file, in_fh, "top-bottom",
+                                    list().append)
+    out_fh = io.BytesIO()
+    mpeg4_file.save(in_fh, out_fh)
+    return out_fh.getvalue()
+
+
+class MappedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, "src.mp4")
+        mp4_builder.build(self.src, "front", mdat_size=256 * 1024)
+        with open(self.src, "rb") as fh:
+            self.expected = save_stereo(fh)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_readers_save_like_a_file(self):
+        with bufferio.MappedFile(self.src) as mapped:
+            with concurrent.futures.ThreadPoolExecutor(THREADS) as executor:
+                saved = list(executor.map(
+                    lambda _: save_stereo(mapped.reader()), range(THREADS)))
+        self.assertEqual(len(saved), THREADS)
+        for data in saved:
+            self.assertEqual(data, self.expected)
+        dest = os.path.join(self.directory, "dest.mp4")
+        with open(dest, "wb") as fh:
+            fh.write(saved[0])
+        self.assertEqual(mp4_builder.read_chunks(dest)[1],
+                         mp4_builder.read_chunks(self.src)[1])
+
+    def test_view(self):
+        with open(self.src, "rb") as fh:
+            data = fh.read()
+        with bufferio.MappedFile(self.src) as mapped:
+            mpeg4_file = mpeg.load(mapped.reader())
+            for element in mpeg4_file.find_all("stco"):
+                view = mapped.view(element)
+                start = element.content_start()
+                self.assertEqual(view.tobytes(),
+                                 data[start:start + element.content_size])
+                view.release()
+
+    def test_reader_positions_are_independent(self):
+        with bufferio.MappedFile(self.src) as mapped:
+            first = mapped.reader()
+            second = mapped.reader()
+            first.seek(8)
+            self.assertEqual(second.read(8)[4:], b"ftyp")
+            self.assertEqual(first.tell(), 8)
+            self.assertEqual(second.tell(), 8)
+            self.assertEqual(first.fileno(), mapped.fh.fileno())
+
+    def test_empty_file(self):
+        empty = os.path.join(self.directory, "empty.mp4")
+        open(empty, "wb").close()
+        with bufferio.MappedFile(empty) as mapped:
+            self.assertEqual(mapped.reader().read(), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
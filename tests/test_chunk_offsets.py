@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the stco/co64 chunk offset tables."""
+
+import io
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+import mp4_builder
+from spatialmedia import mpeg
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import constants
+
+
+def index_box(name, entries, trailer=b""):
+    entry = "I" if name == "stco" else "Q"
+    new_box = box.Box()
+    new_box.name = name
+    new_box.header_size = 8
+    new_box.contents = (struct.pack(">II%d%s" % (len(entries), entry), 7,
+                                    len(entries), *entries) + trailer)
+    new_box.content_size = len(new_box.contents)
+    return new_box
+
+
+def copy(index, mode_length, delta):
+    out_fh = io.BytesIO()
+    box.index_copy(None, out_fh, index, mode_length, delta)
+    return out_fh.getvalue()
+
+
+class IndexCopyTest(unittest.TestCase):
+
+    def test_shift_matches_entry_loop(self):
+        generator = random.Random(4)
+        for name, mode_length in (("stco", 4), ("co64", 8)):
+            limit = 1 << (8 * mode_length)
+            for delta in (1, 4096, -1, -4096, 0x7fffffff):
+                entries = [generator.randrange(abs(delta), limit - abs(delta))
+                           for _ in range(1000)]
+                entries += [abs(delta), limit - 1 - abs(delta)]
+                expected = index_box(name, [entry + delta
+                                            for entry in entries], b"tail")
+                self.assertEqual(
+                    copy(index_box(name, entries, b"tail"), mode_length,
+                         delta),
+                    expected.contents)
+
+    def test_unshifted_table_is_copied_unchanged(self):
+        index = index_box("stco", [1, 2, 3], b"\xff")
+        self.assertEqual(copy(index, 4, 0), index.contents)
+
+    def test_empty_table(self):
+        index = index_box("co64", [])
+        self.assertEqual(copy(index, 8, 100), index.contents)
+
+    def test_truncated_table(self):
+        index = index_box("stco", [1, 2, 3])
+        # Claims four entries but holds three.
+        index.contents = index.contents[:4] + struct.pack(
+            ">I", 4) + index.contents[8:]
+        with self.assertRaises(ValueError):
+            copy(index, 4, 16)
+        with self.assertRaises(ValueError):
+            box.read_index(None, index, 4)
+        # Unshifted tables are copied as they are, whatever they hold.
+        self.assertEqual(copy(index, 4, 0), index.contents)
+
+    def test_overflow(self):
+        # Each entry leaving the range alone, the others cannot hide it.
+        for entries, delta in (([5, 0xfffffff0, 7], 0x20),
+                               ([0xffffffff], 1),
+                               ([5, 3, 7], -4),
+                               ([0], -1)):
+            with self.assertRaises(OverflowError):
+                copy(index_box("stco", entries), 4, delta)
+        with self.assertRaises(OverflowError):
+            copy(index_box("co64", [1, 0xffffffffffffffff, 1]), 8, 1)
+
+
+class PromotionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stco_promoted_to_co64(self):
+        path = os.path.join(self.directory, "src.mp4")
+        mp4_builder.build(path, "end")
+        with open(path, "rb") as fh:
+            mpeg4_file = mpeg.load(fh)
+            moov_fh = mpeg4_file.moov_source(fh)
+            before = [box.read_index(moov_fh, element, 4)[1].tolist()
+                      for element in mpeg4_file.find_all(constants.TAG_STCO)]
+            # Offsets shifted beyond 4 GiB, as if moov grew that much.
+            delta = 1 << 32
+            self.assertTrue(mpeg4_file.promote_stco_boxes(fh, delta))
+            self.assertEqual(mpeg4_file.find_all(constants.TAG_STCO), [])
+            promoted = mpeg4_file.find_all(constants.TAG_CO64)
+            self.assertEqual(len(promoted), len(before))
+            for element, entries in zip(promoted, before):
+                self.assertEqual(
+                    box.read_index(moov_fh, element, 8)[1].tolist(), entries)
+                self.assertEqual(element.content_size, 8 + 8 * len(entries))
+                saved = io.BytesIO()
+                element.save(moov_fh, saved, delta)
+                saved = saved.getvalue()
+                self.assertEqual(saved[4:8], b"co64")
+                self.assertEqual(
+                    list(struct.unpack_from(">%dQ" % len(entries), saved, 16)),
+                    [entry + delta for entry in entries])
+            # Nothing left that overflows.
+            self.assertFalse(mpeg4_file.promote_stco_boxes(fh, delta))
+
+    def test_small_shift_keeps_stco(self):
+        path = os.path.join(self.directory, "src.mp4")
+        mp4_builder.build(path, "end")
+        with open(path, "rb") as fh:
+            mpeg4_file = mpeg.load(fh)
+            self.assertFalse(mpeg4_file.promote_stco_boxes(fh, 1 << 20))
+            self.assertEqual(len(mpeg4_file.find_all(constants.TAG_STCO)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
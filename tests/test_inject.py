@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Round trip tests of metadata injection."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mp4_builder
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+
+class InjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.messages = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def parse(self, path):
+        messages = list()
+        parsed = metadata_utils.parse_metadata(path, messages.append)
+        self.assertIsNotNone(parsed, messages)
+        return parsed
+
+    def assert_injected(self, src, dest, spherical="equirectangular",
+                        stereo="none"):
+        """Checks dest holds the chunks of src and the injected metadata."""
+        src_boxes, src_chunks = mp4_builder.read_chunks(src)
+        dest_boxes, dest_chunks = mp4_builder.read_chunks(dest)
+        self.assertEqual(src_chunks, dest_chunks)
+        parsed = self.parse(dest)
+        sv3d, = parsed.video.values()
+        st3d, = parsed.stereo.values()
+        if spherical not in ("equirectangular", "cubemap"):
+            # All mesh projections are read back as meshes.
+            spherical = "mesh"
+        self.assertEqual(sv3d.projection, spherical)
+        self.assertEqual(st3d.stereo_mode, ["none", "top-bottom",
+                                            "left-right"].index(stereo))
+        return dest_boxes
+
+    def test_copy(self):
+        for layout in ("end", "front", "freefront", "endfree"):
+            src = self.path("src_%s.mp4" % layout)
+            dest = self.path("dest_%s.mp4" % layout)
+            mp4_builder.build(src, layout)
+            with open(src, "rb") as fh:
+                original = fh.read()
+            metadata_utils.inject_metadata(src, dest, mp4_builder.metadata(),
+                                           self.messages.append)
+            self.assert_injected(src, dest)
+            with open(src, "rb") as fh:
+                self.assertEqual(fh.read(), original)
+
+    def test_copy_projections(self):
+        src = self.path("src.mp4")
+        mp4_builder.build(src)
+        for spherical, stereo in (("cubemap", "top-bottom"),
+                                  ("mesh", "left-right"),
+                                  ("full-frame", "none"),
+                                  ("equi-mesh", "left-right")):
+            dest = self.path("%s.mp4" % spherical)
+            metadata_utils.inject_metadata(
+                src, dest, mp4_builder.metadata(spherical, stereo),
+                self.messages.append)
+            self.assert_injected(src, dest, spherical, stereo)
+
+    def test_in_place_fits_free_space(self):
+        src = self.path("src.mp4")
+        dest = self.path("dest.mp4")
+        mp4_builder.build(src, "front")
+        shutil.copy(src, dest)
+        metadata_utils.inject_metadata(dest, dest, mp4_builder.metadata(),
+                                       self.messages.append)
+        self.assertIn("Updated file in place", self.messages)
+        self.assertEqual(os.path.getsize(src), os.path.getsize(dest))
+        self.assert_injected(src, dest)
+        self.assertFalse(os.path.exists(dest + metadata_utils.JOURNAL_SUFFIX))
+
+    def test_in_place_appends_trailing_moov(self):
+        src = self.path("src.mp4")
+        dest = self.path("dest.mp4")
+        mp4_builder.build(src, "end")
+        shutil.copy(src, dest)
+        metadata_utils.inject_metadata(dest, dest, mp4_builder.metadata(),
+                                       self.messages.append)
+        self.assertIn("Updated file in place", self.messages)
+        self.assert_injected(src, dest)
+
+    def test_in_place_rewrites_when_not_fitting(self):
+        src = self.path("src.mp4")
+        dest = self.path("dest.mp4")
+        mp4_builder.build(src, "front", free_size=8)
+        shutil.copy(src, dest)
+        metadata_utils.inject_metadata(dest, dest, mp4_builder.metadata(),
+                                       self.messages.append)
+        self.assertIn("Metadata does not fit in place, rewriting file",
+                      self.messages)
+        self.assert_injected(src, dest)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["dest.mp4", "src.mp4"])
+
+    def test_in_place_restores_interrupted_update(self):
+        src = self.path("src.mp4")
+        dest = self.path("dest.mp4")
+        mp4_builder.build(src, "end")
+        shutil.copy(src, dest)
+        with open(dest, "r+b") as fh:
+            mpeg4_file = mpeg.load(fh)
+            moov = mpeg4_file.moov_box
+            mpeg.mpeg4_container.write_journal(
+                fh, dest + metadata_utils.JOURNAL_SUFFIX, moov.position,
+                os.path.getsize(dest))
+            # Interrupted half way through the new moov box.
+            fh.seek(moov.position + moov.size() // 2)
+            fh.write(b"\xff" * 64)
+            fh.truncate()
+
+        metadata_utils.inject_metadata(dest, dest, mp4_builder.metadata(),
+                                       self.messages.append)
+        self.assertIn("Restoring \"%s\" from an interrupted in place update" %
+                      dest, self.messages)
+        self.assert_injected(src, dest)
+        self.assertFalse(os.path.exists(dest + metadata_utils.JOURNAL_SUFFIX))
+
+    def test_same_file_under_other_name(self):
+        src = self.path("src.mp4")
+        link = self.path("link.mp4")
+        mp4_builder.build(src)
+        os.link(src, link)
+        with open(src, "rb") as fh:
+            original = fh.read()
+        metadata_utils.inject_metadata(src, link, mp4_builder.metadata(),
+                                       self.messages.append)
+        self.assertIn("Error, input and output cannot be the same",
+                      self.messages)
+        with open(src, "rb") as fh:
+            self.assertEqual(fh.read(), original)
+
+
+if __name__ == "__main__":
+    unittest.main()
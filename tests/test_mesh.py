@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the mesh encoding."""
+
+import array
+import io
+import random
+import unittest
+
+from spatialmedia.mpeg import bitwiseio
+from spatialmedia.mpeg import mesh
+
+FISHEYE_CORRECTION = [0.1, -0.05, 0.02, 0.0]
+
+
+def load_mesh(data):
+    """Loads a mesh box serialized by meshBox.process_mesh."""
+    return mesh.load(io.BytesIO(data), 0, len(data))
+
+
+def bit_writer_bytes(values, width):
+    """Returns the bytes BitWriter writes for values."""
+    out_fh = io.BytesIO()
+    with bitwiseio.BitWriter(out_fh) as writer:
+        for value in values:
+            writer.writebits(value, width)
+    return out_fh.getvalue()
+
+
+class PackBitsTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        generator = random.Random(22)
+        for width in (1, 3, 7, 8, 12, 31):
+            for count in (0, 1, 7, 63, 64, 65, 200):
+                values = [generator.getrandbits(width) for _ in range(count)]
+                packed = bitwiseio.pack_bits(values, width)
+                self.assertEqual(len(packed),
+                                 bitwiseio.packed_size(count, width))
+                self.assertEqual(bitwiseio.unpack_bits(packed, width, count),
+                                 values)
+
+    def test_matches_bit_writer(self):
+        generator = random.Random(23)
+        for width in (1, 5, 9, 16):
+            for count in (1, 13, 64, 100):
+                values = [generator.getrandbits(width) for _ in range(count)]
+                self.assertEqual(bitwiseio.pack_bits(values, width),
+                                 bit_writer_bytes(values, width))
+
+    def test_high_bits_are_dropped(self):
+        self.assertEqual(bitwiseio.pack_bits([0x1f, 0x12], 4), b"\xf2")
+
+    def test_empty(self):
+        self.assertEqual(bitwiseio.pack_bits([], 5), b"\0")
+        self.assertEqual(bitwiseio.unpack_bits(b"\0", 5, 0), [])
+
+    def test_short_data(self):
+        with self.assertRaises(ValueError):
+            bitwiseio.unpack_bits(b"\0", 5, 2)
+
+
+class DeltaTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        generator = random.Random(5)
+        indices = [generator.randrange(1000) for _ in range(500)]
+        for stride in (1, 5):
+            coded = mesh.encode_deltas(indices, stride)
+            self.assertTrue(all(value >= 0 for value in coded))
+            self.assertEqual(mesh.decode_deltas(coded, stride), indices)
+
+    def test_coding(self):
+        self.assertEqual(mesh.encode_deltas([3, 1, 1, 4]), [6, 5, 0, 6])
+        self.assertEqual(mesh.encode_deltas([3, 1, 4, 2], 2), [6, 2, 2, 2])
+
+
+class MeshLoadTest(unittest.TestCase):
+
+    def test_load_decodes_generated_mesh(self):
+        details = mesh.gen_mesh(39, 1, 0.0, 1.0, 0.0, 0.1, FISHEYE_CORRECTION)
+        loaded = load_mesh(mesh.meshBox().process_mesh(details))
+        self.assertEqual(loaded.coordinates.tolist(),
+                         array.array("f", details["coordinates"]).tolist())
+        self.assertEqual(loaded.vertex_buffer.tolist(), details["vertices"])
+        self.assertEqual(len(loaded.vertex_list), len(details["triangles"]))
+        for indices, triangles in zip(loaded.vertex_list,
+                                      details["triangles"]):
+            self.assertEqual(indices["list"].tolist(), triangles["list"])
+            self.assertEqual((indices["txt"], indices["type"]),
+                             (triangles["txt"], triangles["type"]))
+
+
+class CompactCoordinatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.details = mesh.gen_mesh(39, 1, 0.0, 1.0, 0.0, 0.1,
+                                     FISHEYE_CORRECTION)
+
+    def geometry(self, details):
+        """Returns the float32 coordinate values of every vertex field."""
+        coordinates = array.array("f", details["coordinates"]).tolist()
+        return [coordinates[index] for index in details["vertices"]]
+
+    def test_exact_round_trip(self):
+        compacted = mesh.compact_coordinates(self.details)
+        self.assertLess(len(compacted["coordinates"]),
+                        len(self.details["coordinates"]))
+        self.assertEqual(len(set(compacted["coordinates"])),
+                         len(compacted["coordinates"]))
+        self.assertEqual(self.geometry(compacted),
+                         self.geometry(self.details))
+        self.assertIs(compacted["triangles"], self.details["triangles"])
+
+    def test_tolerance(self):
+        tolerance = 1e-3
+        exact = mesh.compact_coordinates(self.details)
+        rounded = mesh.compact_coordinates(self.details, tolerance)
+        self.assertLessEqual(len(rounded["coordinates"]),
+                             len(exact["coordinates"]))
+        for value, original in zip(self.geometry(rounded),
+                                   self.geometry(self.details)):
+            self.assertLessEqual(abs(value - original), tolerance)
+
+    def test_saved_mesh_keeps_geometry(self):
+        loaded = load_mesh(mesh.meshBox().process_mesh(self.details, 0.0))
+        self.assertEqual(
+            [loaded.coordinates[index] for index in loaded.vertex_buffer],
+            self.geometry(self.details))
+        self.assertEqual([indices["list"].tolist()
+                          for indices in loaded.vertex_list],
+                         [triangles["list"]
+                          for triangles in self.details["triangles"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the mesh payload cache."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import mp4_builder
+from spatialmedia.mpeg import mesh_cache
+from spatialmedia.mpeg import mesh_projection
+
+
+class MeshCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = os.path.join(self.directory, "meshes.sqlite")
+        self.metadata = mp4_builder.metadata("mesh", "left-right")
+        self.created = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self):
+        payload = mesh_projection.mshpBox.create_payload(self.metadata)
+        self.created.append(payload)
+        return payload
+
+    def test_hit_returns_payload(self):
+        with mesh_cache.MeshCache(self.store) as cache:
+            first = cache.get_or_create(self.metadata, self.create)
+            second = cache.get_or_create(self.metadata, self.create)
+        self.assertEqual(len(self.created), 1)
+        self.assertIs(second, first)
+        self.assertEqual(first.crc32, mesh_cache.payload_crc32(
+            first.encoding, first.contents))
+
+    def test_store_is_shared(self):
+        with mesh_cache.MeshCache(self.store) as cache:
+            first = cache.get_or_create(self.metadata, self.create)
+        with mesh_cache.MeshCache(self.store) as cache:
+            second = cache.get_or_create(self.metadata, self.create)
+            self.assertEqual(len(cache), 1)
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual((second.encoding, second.contents, second.crc32,
+                          second.meshes),
+                         (first.encoding, first.contents, first.crc32,
+                          first.meshes))
+
+    def test_damaged_payload_is_generated_again(self):
+        with mesh_cache.MeshCache(self.store) as cache:
+            first = cache.get_or_create(self.metadata, self.create)
+            with cache.connection:
+                cache.connection.execute(
+                    "UPDATE payloads SET contents = ?", (b"damaged",))
+        with mesh_cache.MeshCache(self.store) as cache:
+            self.assertIsNone(cache.get(mesh_cache.cache_key(self.metadata)))
+            self.assertEqual(len(cache), 0)
+            second = cache.get_or_create(self.metadata, self.create)
+        self.assertEqual(len(self.created), 2)
+        self.assertEqual(second.contents, first.contents)
+
+    def test_key_follows_mesh_parameters(self):
+        key = mesh_cache.cache_key(self.metadata)
+        self.metadata.fov = [90, 90]
+        # The fov is not used by mesh projections.
+        self.assertEqual(mesh_cache.cache_key(self.metadata), key)
+        for field, value in (("fisheye_correction", [0.0, 0.0, 0.0, 0.0]),
+                             ("uv_offsets", [0.0] * 8),
+                             ("mesh_tolerance", 0.5),
+                             ("stereo", "none"),
+                             ("spherical", "full-frame")):
+            setattr(self.metadata, field, value)
+            changed = mesh_cache.cache_key(self.metadata)
+            self.assertNotEqual(changed, key, field)
+            key = changed
+
+    def test_store_is_evicted(self):
+        payloads = [mesh_cache.MeshPayload(b"raw ", bytes([index]) * 100, 1)
+                    for index in range(5)]
+        with mesh_cache.MeshCache(self.store, max_bytes=250,
+                                  memory_entries=1) as cache:
+            for index, payload in enumerate(payloads):
+                cache.put(str(index), payload)
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get("0"))
+            self.assertEqual(cache.get("3").contents, payloads[3].contents)
+
+    def test_memory_only(self):
+        cache = mesh_cache.MeshCache(memory_entries=2)
+        for key in ("a", "b", "c"):
+            cache.put(key, mesh_cache.MeshPayload(b"raw ", b"x", 1))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_unopenable_store_falls_back_to_memory(self):
+        path = os.path.join(self.directory, "missing", "meshes.sqlite")
+        with mock.patch.dict(mesh_cache._caches, clear=True):
+            cache = mesh_cache.open_cache(path)
+            self.assertIsNone(cache.connection)
+            self.assertIs(mesh_cache.open_cache(None), cache)
+            self.assertIs(mesh_cache.open_cache(path), cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
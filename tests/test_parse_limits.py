@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of parsing untrusted files within limits."""
+
+import io
+import struct
+import unittest
+from unittest import mock
+
+import mp4_builder
+from spatialmedia import mpeg
+from spatialmedia.mpeg import parse_limits
+
+box = mp4_builder.box
+full_box = mp4_builder.full_box
+
+FTYP = box("ftyp", b"isom" + struct.pack(">I", 512) + b"isomiso2avc1mp41")
+MDAT = box("mdat", b"\0" * 64)
+MVHD = full_box("mvhd", b"\0" * 96)
+TKHD = full_box("tkhd", b"\0" * 80)
+
+
+def movie(*boxes):
+    return io.BytesIO(b"".join(boxes))
+
+
+class ParseLimitsTest(unittest.TestCase):
+
+    def load(self, fh, **limits):
+        return mpeg.load(fh, parse_limits.ParseLimits(**limits))
+
+    def assert_rejected(self, fh, reason, position=None, path=None,
+                        **limits):
+        """Checks that loading fh with limits fails for reason."""
+        output = io.StringIO()
+        with mock.patch("sys.stdout", output):
+            with self.assertRaises(parse_limits.ParseError) as raised:
+                self.load(fh, **limits)
+        error = raised.exception.to_dict()
+        self.assertEqual(error["reason"], reason)
+        self.assertEqual(error["position"], position)
+        self.assertEqual(error["path"], path)
+        self.assertTrue(error["message"])
+        # Rejected files are reported by the error alone.
+        self.assertEqual(output.getvalue(), "")
+        return error
+
+    def test_accepts_valid_file(self):
+        mpeg4_file = self.load(movie(FTYP, MDAT, box("moov", MVHD)))
+        self.assertEqual([element.name for element in mpeg4_file.contents],
+                         ["ftyp", "mdat", "moov"])
+        self.assertTrue(mpeg4_file.moov_box.is_loaded())
+
+    def test_too_deep(self):
+        nested = box("trak", TKHD)
+        for _ in range(4):
+            nested = box("trak", nested)
+        moov_position = len(FTYP) + len(MDAT)
+        # moov at depth 1 holds traks at depths 2 to 6 and tkhd at 7.
+        self.assert_rejected(
+            movie(FTYP, MDAT, box("moov", nested)), parse_limits.TOO_DEEP,
+            moov_position + 8 * 4, "moov/trak/trak/trak/trak", max_depth=5)
+        self.load(movie(FTYP, MDAT, box("moov", nested)), max_depth=7)
+
+    def test_too_many_boxes(self):
+        traks = b"".join(box("trak", TKHD) for _ in range(10))
+        moov = box("moov", MVHD + traks)
+        # ftyp, mdat, moov, then the boxes in moov before those in trak.
+        position = len(FTYP) + len(MDAT) + 8 + len(MVHD) + 3 * len(box(
+            "trak", TKHD))
+        self.assert_rejected(movie(FTYP, MDAT, moov),
+                             parse_limits.TOO_MANY_BOXES, position,
+                             "moov/trak", max_boxes=7)
+        self.load(movie(FTYP, MDAT, moov), max_boxes=24)
+
+    def test_too_many_bytes(self):
+        moov = box("moov", MVHD + box("trak", TKHD))
+        self.assert_rejected(movie(FTYP, MDAT, moov),
+                             parse_limits.TOO_MANY_BYTES,
+                             len(FTYP) + len(MDAT), "moov",
+                             max_bytes=len(moov) - 9)
+
+    def test_timeout(self):
+        clock = iter([0.0, 0.0, 0.0, 100.0])
+        with mock.patch("time.monotonic", lambda: next(clock, 100.0)):
+            error = self.assert_rejected(
+                movie(FTYP, MDAT, box("moov", MVHD)), parse_limits.TIMEOUT,
+                len(FTYP) + len(MDAT), "moov", max_seconds=10)
+        self.assertIn("10 seconds", error["message"])
+
+    def test_unsupported_brand(self):
+        ftyp = box("ftyp", b"abcd" + struct.pack(">I", 0) + b"wxyz")
+        self.assert_rejected(movie(ftyp, MDAT), parse_limits.UNSUPPORTED_BRAND,
+                             0, "ftyp")
+        # A known compatible brand is enough.
+        ftyp = box("ftyp", b"abcd" + struct.pack(">I", 0) + b"mp42")
+        self.load(movie(ftyp, MDAT, box("moov", MVHD)))
+        self.load(movie(box("ftyp", b"abcd\0\0\0\0"), MDAT,
+                        box("moov", MVHD)), brands=None)
+
+    def test_not_mpeg4(self):
+        self.assert_rejected(movie(b"\x89PNG\r\n\x1a\n" + b"\0" * 32),
+                             parse_limits.NOT_MPEG4, 0)
+        self.assert_rejected(movie(b"\0\0"), parse_limits.NOT_MPEG4, 0)
+        # QuickTime files may start without ftyp, unless it is required.
+        self.assert_rejected(movie(MDAT, box("moov", MVHD)),
+                             parse_limits.NOT_MPEG4, 0, require_ftyp=True)
+        self.load(movie(MDAT, box("moov", MVHD)))
+
+    def test_truncated_box_in_trak(self):
+        # The mdia header claims more than is left in trak.
+        mdia = struct.pack(">I", 4096) + b"mdia" + b"\0" * 16
+        trak = box("trak", TKHD + mdia)
+        trak_position = len(FTYP) + len(MDAT) + 8 + len(MVHD)
+        self.assert_rejected(movie(FTYP, MDAT, box("moov", MVHD + trak)),
+                             parse_limits.INVALID_BOX, trak_position,
+                             "moov/trak")
+
+    def test_truncated_top_level_box(self):
+        self.assert_rejected(movie(FTYP, MDAT, struct.pack(">I", 4096) +
+                                   b"moov" + MVHD),
+                             parse_limits.INVALID_BOX, len(FTYP) + len(MDAT))
+
+    def test_missing_box(self):
+        self.assert_rejected(movie(FTYP, MDAT), parse_limits.MISSING_BOX)
+        self.assert_rejected(movie(FTYP, box("moov", MVHD)),
+                             parse_limits.MISSING_BOX)
+
+    def test_without_limits_contents_are_deferred(self):
+        mpeg4_file = mpeg.load(movie(FTYP, MDAT, box("moov", MVHD)))
+        self.assertFalse(mpeg4_file.moov_box.is_loaded())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the probe cache and its invalidation."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import mp4_builder
+from spatialmedia import metadata_utils
+from spatialmedia import probe_cache
+
+
+class ProbeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, "src.mp4")
+        self.missing = os.path.join(self.directory, "missing.mp4")
+        mp4_builder.build(self.src)
+        metadata_utils.inject_metadata(
+            self.src, os.path.join(self.directory, "spherical.mp4"),
+            mp4_builder.metadata(audio=True), list().append)
+        self.src = os.path.join(self.directory, "spherical.mp4")
+        self.cache = probe_cache.ProbeCache(
+            os.path.join(self.directory, "probe.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def parse(self, path, cache):
+        messages = list()
+        return metadata_utils.parse_metadata(path, messages.append,
+                                             cache), messages
+
+    def test_missing_file(self):
+        error = ("Error: %s does not exist or we do not have permission" %
+                 self.missing)
+        for cache in (None, self.cache):
+            parsed, messages = self.parse(self.missing, cache)
+            self.assertIsNone(parsed)
+            self.assertEqual(messages, [error])
+        messages = list()
+        self.assertIsNone(self.cache.probe(self.missing, messages.append))
+        self.assertEqual(messages, [error])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_hit_replays_messages(self):
+        parsed, messages = self.parse(self.src, self.cache)
+        self.assertEqual(len(self.cache), 1)
+        with mock.patch.object(metadata_utils, "probe_mpeg4") as probe:
+            cached, cached_messages = self.parse(self.src, self.cache)
+        self.assertFalse(probe.called)
+        self.assertEqual(cached_messages, messages)
+        self.assertEqual(list(cached.video.values())[0].projection,
+                         list(parsed.video.values())[0].projection)
+        # The sa3d box is stored without the tree it was loaded in.
+        self.assertIsInstance(cached, metadata_utils.ParsedMetadata)
+        self.assertIsNotNone(cached.audio)
+        self.assertIsNone(cached.audio.parent)
+        self.assertEqual(cached.audio.num_channels, 4)
+        self.assertEqual(cached.audio.num_channels,
+                         parsed.audio.num_channels)
+        self.assertEqual(cached.num_audio_channels, 4)
+
+    def test_changed_file_is_parsed_again(self):
+        self.parse(self.src, self.cache)
+        stat = os.stat(self.src)
+        os.utime(self.src, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNone(self.cache.get(self.src))
+        with open(self.src, "ab") as fh:
+            fh.write(b"\0\0\0\x08free")
+        self.assertIsNone(self.cache.get(self.src))
+        self.parse(self.src, self.cache)
+        self.assertIsNotNone(self.cache.get(self.src))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_invalidate(self):
+        self.parse(self.src, self.cache)
+        self.assertTrue(self.cache.invalidate(self.src))
+        self.assertIsNone(self.cache.get(self.src))
+        self.assertFalse(self.cache.invalidate(self.src))
+        # Results of removed files are found by path.
+        self.parse(self.src, self.cache)
+        os.remove(self.src)
+        self.assertTrue(self.cache.invalidate(self.src))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_unreadable_row_is_removed(self):
+        self.parse(self.src, self.cache)
+        with self.cache.connection:
+            self.cache.connection.execute(
+                "UPDATE probes SET metadata = ?", (b"not a pickle",))
+        self.assertIsNone(self.cache.get(self.src))
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of loading and saving spherical video (sv3d) boxes."""
+
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import mp4_builder
+from spatialmedia import metadata_utils
+from spatialmedia.mpeg import mesh_cache
+from spatialmedia.mpeg import mesh_projection
+from spatialmedia.mpeg import sv3d
+
+box = mp4_builder.box
+full_box = mp4_builder.full_box
+
+# As written by other muxers: svhd names the muxer, equi comes before
+# prhd and proj holds a box this tool does not know.
+FOREIGN_SV3D = box(
+    "sv3d",
+    full_box("svhd", b"Lavf58.29.100\0") +
+    box("proj",
+        full_box("equi", struct.pack(">IIII", 10, 20, 30, 40)) +
+        box("xtra", b"vendor data") +
+        full_box("prhd", struct.pack(">III", 90 << 16, 45 << 16, 0))))
+
+
+def find_box(path, name):
+    """Returns the bytes of the first box called name in a file."""
+    with open(path, "rb") as fh:
+        fh.seek(0, 2)
+        boxes = mp4_builder.walk(fh, 0, fh.tell())
+        for box_path, position, _, size in boxes:
+            if box_path.rsplit("/", 1)[-1] == name:
+                fh.seek(position)
+                return fh.read(size)
+    return None
+
+
+class Sv3dTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.messages = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_load_foreign_box(self):
+        loaded = sv3d.load(io.BytesIO(FOREIGN_SV3D), 0, len(FOREIGN_SV3D))
+        self.assertEqual(loaded.projection, "equirectangular")
+        self.assertEqual((loaded.yaw, loaded.pitch, loaded.roll),
+                         (90, 45, 0))
+        self.assertEqual((loaded.clip_top, loaded.clip_bottom,
+                          loaded.clip_left_right, loaded.clip_right),
+                         (10, 20, 30, 40))
+        self.assertEqual(loaded.serialize(), FOREIGN_SV3D)
+
+    def test_resave_keeps_foreign_box(self):
+        src = self.path("src.mp4")
+        mp4_builder.build(src, "front", sv3d=FOREIGN_SV3D)
+        stereo_only = mp4_builder.metadata(None, "top-bottom")
+        copied = self.path("copied.mp4")
+        metadata_utils.inject_metadata(src, copied, stereo_only,
+                                       self.messages.append)
+        in_place = self.path("in_place.mp4")
+        shutil.copy(src, in_place)
+        metadata_utils.inject_metadata(in_place, in_place, stereo_only,
+                                       self.messages.append)
+        self.assertIn("Updated file in place", self.messages)
+        for dest in (copied, in_place):
+            self.assertEqual(find_box(dest, "sv3d"), FOREIGN_SV3D)
+            self.assertEqual(mp4_builder.read_chunks(dest)[1],
+                             mp4_builder.read_chunks(src)[1])
+            self.assertIsNotNone(find_box(dest, "st3d"))
+
+    def test_created_box_sizes(self):
+        for spherical in ("equirectangular", "cubemap", "mesh"):
+            created = sv3d.sv3dBox.create(mp4_builder.metadata(spherical))
+            data = created.serialize()
+            self.assertEqual(len(data), created.size())
+            reloaded = sv3d.load(io.BytesIO(data), 0, len(data))
+            self.assertEqual(reloaded.proj_size, created.proj_size)
+            self.assertEqual(reloaded.serialize(), data)
+
+    def test_mesh_crc_follows_contents(self):
+        created = mesh_projection.mshpBox.create(
+            mp4_builder.metadata("mesh"))
+        created.crc32 = 0
+        created.contents = created.contents + b"\0"
+        data = created.serialize()
+        crc32, encoding = struct.unpack_from(">I4s", data, 12)
+        self.assertEqual(encoding, b"dfl8")
+        self.assertEqual(crc32, mesh_cache.payload_crc32(encoding,
+                                                         data[20:]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the track index of loaded files."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mp4_builder
+from spatialmedia import mpeg
+from spatialmedia.mpeg import constants
+
+
+class TracksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, "src.mp4")
+        mp4_builder.build(self.src, audio=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tracks_are_indexed_on_first_access(self):
+        with open(self.src, "rb") as fh:
+            mpeg4_file = mpeg.load(fh)
+        moov = mpeg4_file.moov_box
+        self.assertFalse(moov.is_loaded())
+
+        tracks = mpeg4_file.tracks
+        self.assertIs(mpeg4_file.tracks, tracks)
+        self.assertEqual([track.handler_type for track in tracks],
+                         [constants.TAG_VIDE, constants.TAG_SOUN])
+        self.assertEqual([track.trak for track in tracks],
+                         [element for element in moov.contents
+                          if element.name == constants.TAG_TRAK])
+        for track in tracks:
+            self.assertTrue(track.stbl.is_loaded())
+            self.assertEqual(len(track.sample_entries), 1)
+
+    def test_empty_container_has_no_tracks(self):
+        self.assertEqual(mpeg.Mpeg4Container().tracks, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests that every copy path of transfer copies the same bytes."""
+
+import hashlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from spatialmedia.mpeg import bufferio
+from spatialmedia.mpeg import transfer
+
+SIZE = 3 * 1024 * 1024 + 1234
+# Copies start and end inside the file, not on block boundaries.
+OFFSET = 4097
+PREFIX = b"header"
+BLOCK = 64 * 1024
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_sparse(path):
+    """Returns whether most of a file is not allocated on disk."""
+    stat = os.stat(path)
+    return stat.st_blocks * 512 < stat.st_size // 2
+
+
+class ReadOnlyFile(object):
+    """File handle with read only, no readinto or fileno."""
+
+    def __init__(self, data):
+        self.fh = io.BytesIO(data)
+        self.read = self.fh.read
+        self.seek = self.fh.seek
+        self.tell = self.fh.tell
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fh.close()
+
+
+class CopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "source")
+        self.destination = os.path.join(self.directory, "destination")
+        generator = random.Random(9)
+        self.data = bytes(generator.getrandbits(8)
+                          for _ in range(4096)) * ((SIZE + 2 * OFFSET) // 4096)
+        with open(self.source, "wb") as fh:
+            fh.write(self.data)
+        self.expected = digest(PREFIX + self.data[OFFSET:OFFSET + SIZE])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, options, in_fh=None):
+        """Copies SIZE bytes at OFFSET after a prefix, returns the hash."""
+        if in_fh is None:
+            in_fh = open(self.source, "rb")
+        with in_fh, open(self.destination, "wb") as out_fh:
+            in_fh.seek(OFFSET)
+            out_fh.write(PREFIX)
+            transfer.copy(in_fh, out_fh, SIZE, options)
+            self.assertEqual(in_fh.tell(), OFFSET + SIZE)
+            self.assertEqual(out_fh.tell(), len(PREFIX) + SIZE)
+        with open(self.destination, "rb") as fh:
+            return digest(fh.read())
+
+    def assert_path(self, path, options, in_fh=None):
+        """Checks that the copy goes through path and copies the data."""
+        with mock.patch.object(transfer, path,
+                               wraps=getattr(transfer, path)) as function:
+            self.assertEqual(self.copy(options, in_fh), self.expected)
+        self.assertTrue(function.called, path)
+
+    def test_kernel_copy(self):
+        self.assert_path("kernel_copy", transfer.CopyOptions())
+
+    def test_pipelined_copy(self):
+        self.assert_path("pipelined_copy", transfer.CopyOptions(
+            buffer_count=3, buffer_size=BLOCK, kernel_copy=False))
+
+    def test_buffered_copy(self):
+        self.assert_path("buffered_copy", transfer.CopyOptions(
+            buffer_count=1, buffer_size=BLOCK, kernel_copy=False))
+
+    def test_buffered_copy_without_readinto(self):
+        in_fh = ReadOnlyFile(self.data)
+        self.assert_path("buffered_copy", transfer.CopyOptions(
+            buffer_size=BLOCK, kernel_copy=False), in_fh)
+
+    def test_buffer_reader_copy(self):
+        in_fh = bufferio.BufferReader(self.data)
+        self.assert_path("buffered_copy", transfer.CopyOptions(), in_fh)
+
+    def test_parallel_copy(self):
+        for kernel_copy in (True, False):
+            self.assert_path("parallel_copy", transfer.CopyOptions(
+                threads=4, range_size=256 * 1024, buffer_size=BLOCK,
+                kernel_copy=kernel_copy))
+
+    def test_kernel_copy_falls_back_part_way(self):
+        # The kernel stops after the first block, the rest is pipelined.
+        def short_copy(in_fd, out_fd, in_offset, out_offset, size,
+                       progress=None):
+            return copy_range(in_fd, out_fd, in_offset, out_offset,
+                              min(size, BLOCK), progress)
+
+        copy_range = transfer._kernel_copy_range
+        with mock.patch.object(transfer, "_kernel_copy_range", short_copy):
+            self.assert_path("pipelined_copy", transfer.CopyOptions(
+                buffer_size=BLOCK))
+
+    def test_sparse_source(self):
+        with open(self.source, "r+b") as fh:
+            fh.truncate(OFFSET)
+            fh.seek(OFFSET + SIZE - len(PREFIX))
+            fh.write(PREFIX)
+        self.expected = digest(PREFIX + bytes(SIZE - len(PREFIX)) + PREFIX)
+        if not hasattr(os, "SEEK_HOLE") or not is_sparse(self.source):
+            self.skipTest("The filesystem does not support holes")
+
+        # The kernel copy keeps the hole a hole.
+        self.assertEqual(self.copy(transfer.CopyOptions()), self.expected)
+        self.assertTrue(is_sparse(self.destination))
+        with open(self.destination, "rb") as fh:
+            hole = os.lseek(fh.fileno(), 0, os.SEEK_HOLE)
+        self.assertLess(hole, len(PREFIX) + SIZE // 2)
+
+        # Copies through Python write the zeros out.
+        self.assertEqual(self.copy(transfer.CopyOptions(
+            kernel_copy=False, buffer_size=BLOCK)), self.expected)
+
+    def test_pool_reuses_buffers(self):
+        options = transfer.CopyOptions(buffer_count=2, buffer_size=BLOCK,
+                                       kernel_copy=False)
+        self.assertEqual(self.copy(options), self.expected)
+        buffers = [id(buffer) for buffer in options.pool.buffers]
+        self.assertEqual(len(buffers), 2)
+        self.assertEqual(self.copy(options), self.expected)
+        self.assertEqual(sorted(id(buffer) for buffer in options.pool.buffers),
+                         sorted(buffers))
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        cancel.set()
+        for options in (transfer.CopyOptions(cancel=cancel),
+                        transfer.CopyOptions(cancel=cancel, kernel_copy=False),
+                        transfer.CopyOptions(cancel=cancel, threads=2,
+                                             range_size=BLOCK)):
+            with self.assertRaises(transfer.CopyCancelled):
+                self.copy(options)
+
+
+if __name__ == "__main__":
+    unittest.main()